@@ -0,0 +1,177 @@
+"""Library for classifying many word images in a pipeline.
+
+Classifying all of the word images involves three stages of work: loading
+(decoding) images, running classifiers on them, and committing the resulting
+labels to a label database. This library overlaps the stages so that none waits
+on the others more than it must:
+
+    decode threads  --(ready chunks)-->  main thread  --(labels)-->  writer
+      (a pool)                           (inference)               (a thread)
+
+Images are loaded into a fixed ring of reusable chunk buffers. A decode thread
+must claim a free buffer before it can load a chunk, and the main thread only
+returns a buffer to the ring once inference on its chunk is done, so the memory
+taken up by images never exceeds the size of the ring. Labels waiting to be
+written sit in a queue of bounded depth.
+
+Each stage keeps counters of the images it has handled and the time it has
+spent busy. They're printed when classification finishes: the stage with the
+lowest throughput is the bottleneck.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import concurrent.futures
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class StageCounters(object):
+  """Thread-safe counters of images handled and time spent by a stage."""
+
+  def __init__(self, name):
+    self.name = name
+    self.images = 0
+    self.busy_seconds = 0.0
+    self._lock = threading.Lock()
+
+  def add(self, images, busy_seconds):
+    with self._lock:
+      self.images += images
+      self.busy_seconds += busy_seconds
+
+  def throughput(self):
+    """Images per busy second (summed across threads, for the decode stage)."""
+    with self._lock:
+      return self.images / self.busy_seconds if self.busy_seconds else 0.0
+
+  def __str__(self):
+    return '{:>8}: {:9d} images, {:8.1f} s busy, {:9.0f} images/s'.format(
+        self.name, self.images, self.busy_seconds, self.throughput())
+
+
+def classify(filenames, image_shape, load, predict, write, chunk_size=4096,
+             decode_threads=4, decode_queue_depth=4, write_queue_depth=4):
+  """Classify images in a decode/predict/write pipeline.
+
+  Args:
+    filenames: list of filenames of the images to classify.
+    image_shape: shape of each (uint8) image as loaded by `load`.
+    load: callable `load(start, end, out)` that loads images for
+        `filenames[start:end]` into the uint8 array `out`. Called from the
+        decode threads.
+    predict: callable `predict(start, end, images)` that returns a list of
+        labels for `images`, a KxRxC... uint8 array of the images for
+        `filenames[start:end]`. Called from the calling thread only.
+    write: callable `write(start, end, labels)` that commits `labels` for
+        `filenames[start:end]`. Called from the writer thread only.
+    chunk_size: number of images in each chunk.
+    decode_threads: number of threads loading images.
+    decode_queue_depth: number of chunk buffers in the ring, which caps the
+        number of chunks loaded ahead of inference.
+    write_queue_depth: number of chunks of labels that may be waiting for the
+        writer.
+
+  Returns:
+    A list of `StageCounters` for the decode, predict, and write stages.
+  """
+  counters = [StageCounters(n) for n in ('decode', 'predict', 'write')]
+  decode_counters, predict_counters, write_counters = counters
+  chunks = [(start, min(start + chunk_size, len(filenames)))
+            for start in range(0, len(filenames), chunk_size)]
+
+  # The ring of chunk buffers, and queues for passing work between stages.
+  buffers = [np.empty((chunk_size,) + tuple(image_shape), dtype=np.uint8)
+             for _ in range(max(1, decode_queue_depth))]
+  free_buffers = queue.Queue()
+  for i in range(len(buffers)): free_buffers.put(i)
+  ready_chunks = queue.Queue()
+  label_chunks = queue.Queue(maxsize=max(1, write_queue_depth))
+  stop = threading.Event()
+
+  # Decode stage: claim a free buffer, load a chunk into it, pass it on. A
+  # thread that gives up because the pipeline is stopping passes on a chunk
+  # with no buffer, so that the main thread never waits for it in vain.
+  def decode_chunk(start, end):
+    try:
+      while not stop.is_set():
+        try:
+          i = free_buffers.get(timeout=0.1)
+          break
+        except queue.Empty:
+          pass
+      else:
+        ready_chunks.put((start, end, None, None))
+        return
+      t0 = time.perf_counter()
+      load(start, end, buffers[i][:end-start])
+      decode_counters.add(end - start, time.perf_counter() - t0)
+      ready_chunks.put((start, end, i, None))
+    except BaseException as e:
+      ready_chunks.put((start, end, None, e))
+
+  # Write stage: commit labels until told to stop with None.
+  write_errors = []
+  def write_chunks():
+    try:
+      while True:
+        item = label_chunks.get()
+        if item is None: return
+        t0 = time.perf_counter()
+        write(*item)
+        write_counters.add(item[1] - item[0], time.perf_counter() - t0)
+    except BaseException as e:
+      write_errors.append(e)
+      stop.set()
+      while label_chunks.get() is not None: pass  # Unblock the main thread.
+
+  writer = threading.Thread(target=write_chunks, daemon=True)
+  writer.start()
+  executor = concurrent.futures.ThreadPoolExecutor(max(1, decode_threads))
+  try:
+    for start, end in chunks: executor.submit(decode_chunk, start, end)
+
+    # Predict stage, in this thread.
+    label = 'XXXX'  # Early first value for progress indicator.
+    for done in range(len(chunks)):
+      # Display percentage progress indicator.
+      sys.stdout.write('   {}% '.format(round(100 * done / len(chunks))))
+      sys.stdout.write('{} '.format(label))  # This display should look cool :-)
+      sys.stdout.write('[{}]'.format(', '.join(
+          '{} {:.0f}/s'.format(c.name, c.throughput()) for c in counters)))
+      sys.stdout.flush()
+
+      start, end, i, error = ready_chunks.get()
+      if error is not None: raise error
+      if stop.is_set() or i is None: break
+
+      t0 = time.perf_counter()
+      labels = predict(start, end, buffers[i][:end-start])
+      predict_counters.add(end - start, time.perf_counter() - t0)
+      free_buffers.put(i)
+      label_chunks.put((start, end, labels))
+      if labels: label = labels[-1]
+
+      # Clear away progress indicator.
+      sys.stdout.write('\r\x1b[K')
+      sys.stdout.flush()
+
+  finally:
+    # Clear away progress indicator, stop all threads.
+    sys.stdout.write('\r\x1b[K')
+    sys.stdout.flush()
+    stop.set()
+    executor.shutdown(wait=True, cancel_futures=True)
+    label_chunks.put(None)
+    writer.join()
+
+  if write_errors: raise write_errors[0]
+  return counters
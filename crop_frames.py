@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""Coarsely crop and grayscale the per-frame .png files dumped from a movie.
+
+A program for performing step 2 of the image preparation: it takes the
+per-frame .png files in a directory like `00_originals`, crops the same
+rectangle out of each one, converts the crops to grayscale, and saves them with
+the same filenames in a directory like `01_cropped`, where `crop_words.py` and
+`crop_all_words.sh` expect to find them. Frames are processed in parallel.
+
+The grayscale conversion mimics the ImageMagick command this program replaces:
+
+    convert -crop 350x75+39+151 +repage -colorspace RGB -colorspace Gray
+
+which is to say that sRGB pixel values are linearised, then combined with
+Rec. 709 luma weights, and the result is stored without gamma encoding.
+
+The crop rectangle can be given with the --crop flag in the same WxH+X+Y form
+that ImageMagick uses. Alternatively, given a reference image that was cropped
+from another movie (any image from some other `01_cropped` directory will do),
+this program can find the rectangle by itself: it averages a sample of frames
+from the movie and looks for the location where the average best matches the
+reference. The rectangle is chosen once and then applied to every frame.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import functools
+import logging
+import multiprocessing
+import os
+import pathlib
+import re
+import sys
+
+import imageio
+import numpy as np
+from scipy import signal
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Coarsely crop and grayscale all .png frames from a movie.')
+
+  flags.add_argument('input_dir', type=str,
+                     help='Directory of per-frame .png files (00_originals)')
+  flags.add_argument('output_dir', type=str,
+                     help=('Write cropped .png files here, e.g. 01_cropped. '
+                           'Will be created if necessary.'))
+
+  flags.add_argument('--crop', type=str,
+                     help=('Crop rectangle in ImageMagick geometry form: '
+                           '"350x75+39+151" is 350 pixels wide, 75 pixels '
+                           'high, with top-left corner at x=39, y=151.'))
+  flags.add_argument('--reference', type=str,
+                     help=('If --crop is not specified, locate the crop '
+                           'rectangle by matching frames against this '
+                           'already-cropped grayscale image, which also sets '
+                           'the size of the rectangle.'))
+  flags.add_argument('--reference-frames', default=25, type=int,
+                     help=('Number of frames, evenly spaced through the movie, '
+                           'to average when locating the crop rectangle.'))
+
+  flags.add_argument('-j', '--processes', default=os.cpu_count(), type=int,
+                     help='Number of frames to crop in parallel.')
+  flags.add_argument('--overwrite', action='store_true',
+                     help='Crop frames even if their output file exists.')
+
+  flags.add_argument('-v', '--verbose', action='store_true',
+                     help='Log debug information.')
+
+  return flags
+
+
+def main(FLAGS):
+  # Verbose logging if desired.
+  if FLAGS.verbose: logging.getLogger().setLevel(logging.INFO)
+
+  frames = sorted(pathlib.Path(FLAGS.input_dir).glob('*.png'))
+  if not frames: raise ValueError(
+      'Found no .png files in {}.'.format(FLAGS.input_dir))
+
+  # Settle on the crop rectangle.
+  if FLAGS.crop:
+    rect = parse_geometry(FLAGS.crop)
+  elif FLAGS.reference:
+    print('Locating crop rectangle...')
+    reference = imageio.imread(FLAGS.reference, ignoregamma=True)
+    rect = locate_rectangle(frames, reference, FLAGS.reference_frames)
+  else:
+    raise ValueError('One of --crop or --reference must be specified.')
+  print('Cropping {} frames with rectangle {}...'.format(
+      len(frames), format_geometry(rect)))
+
+  # Skip frames that have already been cropped, unless told otherwise.
+  output_dir = pathlib.Path(FLAGS.output_dir)
+  output_dir.mkdir(parents=True, exist_ok=True)
+  if not FLAGS.overwrite:
+    frames = [f for f in frames if not (output_dir / f.name).exists()]
+
+  # Crop all the frames.
+  crop = functools.partial(crop_frame, output_dir=output_dir, rect=rect)
+  with multiprocessing.Pool(FLAGS.processes) as pool:
+    for i, _ in enumerate(pool.imap_unordered(crop, frames, chunksize=16)):
+      # Display percentage progress indicator.
+      sys.stdout.write('\r\x1b[K   {}% '.format(round(100 * i / len(frames))))
+      sys.stdout.flush()
+
+  # Clear away progress indicator.
+  sys.stdout.write('\r\x1b[K')
+  sys.stdout.flush()
+  print('   ...done.')
+
+
+#### CROPPING ####
+
+
+def crop_frame(frame, output_dir, rect):
+  """Crop and grayscale one frame, saving the result in `output_dir`."""
+  image = imageio.imread(frame, ignoregamma=True)
+  cropped = to_gray(crop(image, rect))
+  imageio.imwrite(pathlib.Path(output_dir) / pathlib.Path(frame).name, cropped)
+  logging.info('Cropped {}'.format(frame))
+
+
+def crop(image, rect):
+  """Crop `rect`, a (width, height, x, y) tuple, from `image`."""
+  width, height, x, y = rect
+  if y + height > image.shape[0] or x + width > image.shape[1]:
+    raise ValueError('Crop rectangle {} exceeds image bounds {}x{}'.format(
+        format_geometry(rect), image.shape[1], image.shape[0]))
+  return image[y:y+height, x:x+width]
+
+
+# Linearised values of all 8-bit sRGB intensities.
+_SRGB_TO_LINEAR = np.where(
+    np.arange(256) / 255.0 <= 0.04045,
+    np.arange(256) / 255.0 / 12.92,
+    ((np.arange(256) / 255.0 + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+# Rec. 709 luma weights, applied to linear RGB values.
+_REC709_LUMA = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+def to_gray(image):
+  """Convert a uint8 sRGB image to linear-intensity uint8 grayscale."""
+  if image.ndim == 2: return image
+  linear = _SRGB_TO_LINEAR[image[..., :3]]
+  return np.uint8(np.clip(np.round(255.0 * linear @ _REC709_LUMA), 0, 255))
+
+
+#### RECTANGLE SELECTION ####
+
+
+def parse_geometry(geometry):
+  """Parse an ImageMagick "WxH+X+Y" geometry string to (w, h, x, y)."""
+  match = re.fullmatch(r'(\d+)x(\d+)\+(\d+)\+(\d+)', geometry.strip())
+  if not match: raise ValueError(
+      'Crop rectangle "{}" is not of the form WxH+X+Y'.format(geometry))
+  return tuple(int(g) for g in match.groups())
+
+
+def format_geometry(rect):
+  """Format a (w, h, x, y) tuple as an ImageMagick "WxH+X+Y" geometry string."""
+  return '{}x{}+{}+{}'.format(*rect)
+
+
+def locate_rectangle(frames, reference, num_frames):
+  """Find where `reference` best matches the frames of a movie.
+
+  Args:
+    frames: list of per-frame image files.
+    reference: a grayscale image cropped from some other movie.
+    num_frames: number of frames, evenly spaced in `frames`, to average.
+
+  Returns:
+    A (width, height, x, y) crop rectangle the same size as `reference`.
+  """
+  # Average some frames. The digits shown change from frame to frame, but the
+  # layout of the screen does not.
+  sample = [frames[i] for i in np.unique(
+      np.linspace(0, len(frames) - 1, num_frames).round().astype(int))]
+  average = np.mean([to_gray(imageio.imread(f, ignoregamma=True))
+                     for f in sample], axis=0, dtype=np.float32)
+
+  # Correlate the average with the zero-mean reference; the best match is
+  # where the correlation peaks.
+  template = reference.astype(np.float32)
+  template -= template.mean()
+  score = signal.fftconvolve(average, template[::-1, ::-1], mode='valid')
+  y, x = np.unravel_index(np.argmax(score), score.shape)
+  logging.info('Best match at x={}, y={} (score {})'.format(x, y, score[y, x]))
+
+  height, width = reference.shape[:2]
+  return width, height, int(x), int(y)
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
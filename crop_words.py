@@ -19,6 +19,7 @@ import math
 import numpy as np
 
 import crop_word
+import normalise_banding
 
 
 def _define_flags():
@@ -49,6 +50,11 @@ def _define_flags():
                            'means "if the maximum pixel value is less than '
                            '87, multiply pixel values by 119 / 73"'))
 
+  flags.add_argument('--normalise-banding', action='store_true',
+                     help=('Correct brightness banding across the whole input '
+                           'image before cropping any words from it. (See '
+                           'normalise_banding.py.)'))
+
   flags.add_argument('-v', '--verbose', action='store_true',
                      help='Log debug information.')
 
@@ -78,6 +84,8 @@ def main(FLAGS):
   # crops is adjusted in a way that moves it more than three pixels from its
   # initial location.
   image = imageio.imread(FLAGS.input_image, ignoregamma=True)
+  if FLAGS.normalise_banding:
+    image = normalise_banding.normalise_banding(image)
   for name, tlx, tly in crop_locs:
     tlx, tly = float(tlx), float(tly)
     logging.info('Cropping {} from {}, starting at tlx={}, tly={}'.format(
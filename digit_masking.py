@@ -0,0 +1,302 @@
+"""Library for masking individual digits in batches of word images.
+
+If we sum a word image vertically, a plot of the column sums will present four
+humps, each corresponding to a digit. The columns containing the four digits
+are separated by the three smallest minima of the column sums, not counting
+columns where no boundary between digits could plausibly be. Once we know
+where the boundaries are, we can mask an image so that only the pixels
+contributing to the n'th hump are visible.
+
+That heuristic (the "minima" segmenter) works most of the time, but a deep
+valley inside a digit can outdo a shallow gap between digits. The "dp"
+segmenter, the default, instead chooses the three boundaries together, finding
+the split with the smallest total column sum at the boundaries among all
+splits where each digit has a plausible width. A small penalty on digits that
+depart from the usual width breaks ties. The search is a dynamic programme
+over columns, done for a whole batch at once.
+
+Functions in this library work on whole batches of images at once: KxRxC
+arrays of K images, or KxRxCx1 arrays of single-channel images as used by
+Keras. Boundaries are given as Kx3 arrays of column indices: the columns of
+digit n (counting from 0) run from boundary n-1 to boundary n inclusive, with
+the left and right edges of the image standing in for boundaries -1 and 3.
+
+Digit boundaries depend only on the images (and the segmenter), so
+`load_segmentation` saves them next to cached images (see `image_cache`) for
+reuse by later runs. Saved "segmentations" are Kx4 uint8 arrays: the three
+boundaries, then a bit field of the `AMBIGUOUS_*` flags below marking images
+whose boundaries are doubtful.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import numpy as np
+
+import image_cache
+
+
+# Half-open ranges of columns that are allowed to hold digit boundaries: one
+# range for each boundary.
+BOUNDARY_RANGES = ((7, 9), (13, 16), (19, 23))
+
+# Flags for doubtful segmentations. An image can have more than one.
+AMBIGUOUS_FEW_MINIMA = 1  # Fewer than three minima; fallback boundaries used.
+AMBIGUOUS_CROWDED = 2     # Two boundaries in the same allowed range.
+AMBIGUOUS_CLOSE_CALL = 4  # A rival choice of boundaries was nearly as good.
+AMBIGUOUS_INKY_CUT = 8    # A boundary column is not much darker than average.
+
+# The fourth-smallest minimum is "nearly as small" as the third if it's within
+# this fraction of the third.
+CLOSE_CALL_MARGIN = 0.1
+
+# A boundary column is "inky" if its column sum exceeds this fraction of the
+# image's mean column sum. The digits nearly touch, so even correct boundaries
+# can be fairly bright: up to 0.85 of the mean in the sample word images.
+INKY_CUT_FRACTION = 0.9
+
+# Digit widths allowed by the "dp" segmenter, counting a boundary column as
+# half a column on either side, and the penalty on the squared difference
+# between a digit's width and the usual width, relative to the image's mean
+# column sum.
+DP_MIN_WIDTH = 5
+DP_MAX_WIDTH = 10
+DP_WIDTH_PENALTY = 0.01
+
+# The "dp" segmenter calls its split a close call if some other split that
+# moves a boundary at least DP_RIVAL_DISTANCE columns costs no more than
+# DP_CLOSE_CALL_MARGIN (relative to the mean column sum) above it.
+DP_RIVAL_DISTANCE = 2
+DP_CLOSE_CALL_MARGIN = 0.1
+
+# Names of the available segmenters.
+SEGMENTERS = ('dp', 'minima')
+
+# Saved segmentations are named for this version as well as the segmenter.
+# Change it whenever `segment` would give different results, so that saved
+# segmentations from older code aren't reused.
+_SEGMENTATION_VERSION = 3
+
+
+def digit_boundaries(images, segmenter='dp'):
+  """Locate the three boundaries between the four digits in word images.
+
+  Args:
+    images: KxRxC or KxRxCx1 array of word images.
+    segmenter: which segmenter to use; one of `SEGMENTERS`.
+
+  Returns:
+    A Kx3 array of boundary column indices, in increasing order.
+  """
+  return segment(images, segmenter)[:, :3]
+
+
+def segment(images, segmenter='dp'):
+  """Locate digit boundaries in word images and flag doubtful ones.
+
+  Args:
+    images: KxRxC or KxRxCx1 array of word images.
+    segmenter: which segmenter to use; one of `SEGMENTERS`.
+
+  Returns:
+    A Kx4 uint8 array. The first three columns are boundary column indices in
+    increasing order; the last is a bit field of `AMBIGUOUS_*` flags.
+  """
+  colsum = np.sum(images, axis=1, dtype=np.float64).reshape(
+      (images.shape[0], images.shape[2]))
+  if segmenter == 'minima':
+    boundaries, flags = _segment_minima(colsum)
+  elif segmenter == 'dp':
+    boundaries, flags = _segment_dp(colsum)
+  else:
+    raise ValueError('Unknown segmenter "{}"; choose one of {}.'.format(
+        segmenter, ', '.join(SEGMENTERS)))
+
+  # Boundaries through bright columns are doubtful whatever the segmenter.
+  mean = np.mean(colsum, axis=1, keepdims=True)
+  cut_sums = np.take_along_axis(colsum, boundaries, axis=1)
+  inky = (cut_sums > INKY_CUT_FRACTION * mean).any(axis=1)
+  flags |= np.where(inky, AMBIGUOUS_INKY_CUT, 0)
+
+  return np.concatenate(
+      [boundaries, flags[:, np.newaxis]], axis=1).astype(np.uint8)
+
+
+def _segment_minima(colsum):
+  """Boundaries and flags for `segment` from the three smallest minima."""
+  colsum = colsum.copy()
+
+  # These columns are not allowed to have image boundaries in them.
+  allowed = np.zeros(colsum.shape[1], dtype=bool)
+  for start, stop in BOUNDARY_RANGES: allowed[start:stop] = True
+  colsum[:, ~allowed] = np.inf
+
+  # The columns containing the four digits are separated by the three smallest
+  # minima of colsum not at the edges of the image.
+  left_less = colsum[:, :-1] < colsum[:, 1:]
+  # True entries in this array are 4 pixels left of all local minima in colsum.
+  # This 4-offset allows us to ignore pixels at the edges of the image.
+  minima_mask = left_less[:, 4:-3] & ~left_less[:, 3:-4]
+  minima = np.where(minima_mask, colsum[:, 4:4+minima_mask.shape[1]], np.inf)
+  # Find which three indices are associated with the smallest minima.
+  smallest = np.argsort(minima, axis=1, kind='stable')[:, :4]
+  smallest_values = np.take_along_axis(minima, smallest, axis=1)
+  boundaries = np.sort(smallest[:, :3] + 4, axis=1)
+
+  # Should there be fewer than three minima in an image, we settle for the
+  # smallest column sum in each of the allowed ranges instead.
+  found = np.isfinite(smallest_values[:, :3]).all(axis=1)
+  fallback = np.stack([start + np.argmin(colsum[:, start:stop], axis=1)
+                       for start, stop in BOUNDARY_RANGES], axis=1)
+  boundaries = np.where(found[:, np.newaxis], boundaries, fallback)
+  return boundaries, _minima_ambiguity(boundaries, found, smallest_values)
+
+
+def _minima_ambiguity(boundaries, found, smallest_values):
+  """Compute `AMBIGUOUS_*` flags for `_segment_minima`."""
+  flags = np.where(found, 0, AMBIGUOUS_FEW_MINIMA)
+
+  # Each allowed range ought to hold exactly one boundary.
+  in_range = np.stack([(boundaries >= start) & (boundaries < stop)
+                       for start, stop in BOUNDARY_RANGES], axis=2)
+  crowded = (in_range.sum(axis=1) > 1).any(axis=1)
+  flags |= np.where(crowded, AMBIGUOUS_CROWDED, 0)
+
+  # Was the choice between the third and fourth smallest minima a close call?
+  if smallest_values.shape[1] > 3:
+    third, fourth = smallest_values[:, 2], smallest_values[:, 3]
+    with np.errstate(invalid='ignore'):
+      close = found & (fourth - third <= CLOSE_CALL_MARGIN * np.abs(third))
+    flags |= np.where(close, AMBIGUOUS_CLOSE_CALL, 0)
+
+  return flags
+
+
+def _segment_dp(colsum):
+  """Boundaries and flags for `segment` from globally optimal splits."""
+  num_images, num_cols = colsum.shape
+  usual_width = (num_cols + 1) / 4.0
+  widths = np.arange(DP_MIN_WIDTH, DP_MAX_WIDTH + 1)
+  # Column costs are scaled by the mean column sum so that the width penalty
+  # means the same thing for bright and dim images.
+  cost = colsum / np.maximum(np.mean(colsum, axis=1, keepdims=True), 1e-9)
+  penalty = lambda w: DP_WIDTH_PENALTY * (w - usual_width) ** 2
+
+  # best[:, c] is the least cost of placing the latest boundary at column c;
+  # back[k][:, c] is where the previous boundary goes in that case. The left
+  # edge of the image is a boundary at column -1.
+  cols = np.arange(num_cols)
+  best = np.where((cols + 1 >= DP_MIN_WIDTH) & (cols + 1 <= DP_MAX_WIDTH),
+                  cost + penalty(cols + 1), np.inf)
+  forward = [best]
+  back = []
+  for _ in range(2):
+    candidates = np.full((len(widths), num_images, num_cols), np.inf)
+    for i, w in enumerate(widths):
+      candidates[i, :, w:] = best[:, :num_cols-w] + penalty(w)
+    choice = np.argmin(candidates, axis=0)
+    best = cost + np.take_along_axis(candidates, choice[np.newaxis], 0)[0]
+    forward.append(best)
+    back.append(cols - widths[choice])
+
+  # The right edge of the image is a boundary at column num_cols.
+  last_width = num_cols - cols
+  after = np.broadcast_to(np.where(
+      (last_width >= DP_MIN_WIDTH) & (last_width <= DP_MAX_WIDTH),
+      penalty(last_width), np.inf), colsum.shape)
+  final = forward[-1] + after
+
+  # Trace back the boundaries.
+  b3 = np.argmin(final, axis=1)
+  b2 = np.take_along_axis(back[1], b3[:, np.newaxis], 1)[:, 0]
+  b1 = np.take_along_axis(back[0], b2[:, np.newaxis], 1)[:, 0]
+  boundaries = np.stack([b1, b2, b3], axis=1)
+
+  # The same recurrence run from the right gives, for each boundary, the least
+  # cost of everything after it; added to `forward`, that's the least total
+  # cost of any split that puts the boundary at each column. If a split with
+  # some boundary well away from ours costs nearly as little, it's a close
+  # call.
+  backward = [after]
+  for _ in range(2):
+    candidates = np.full((len(widths), num_images, num_cols), np.inf)
+    for i, w in enumerate(widths):
+      candidates[i, :, :num_cols-w] = (cost + backward[0])[:, w:] + penalty(w)
+    backward.insert(0, np.min(candidates, axis=0))
+  totals = np.stack([f + b for f, b in zip(forward, backward)], axis=1)
+  far = np.abs(cols - boundaries[:, :, np.newaxis]) >= DP_RIVAL_DISTANCE
+  rival = np.min(np.where(far, totals, np.inf), axis=(1, 2))
+  close = rival - np.min(final, axis=1) <= DP_CLOSE_CALL_MARGIN
+  return boundaries, np.where(close, AMBIGUOUS_CLOSE_CALL, 0)
+
+
+def load_segmentation(filenames, images, cache_dir=None, segmenter='dp',
+                      chunk_size=65536):
+  """Segment word images, saving the result alongside cached images.
+
+  Args:
+    filenames: list of the word image files in `images`.
+    images: KxRxC or KxRxCx1 array of the images in `filenames`, e.g. from
+        `image_cache.load_images`.
+    cache_dir: directory holding cached images. If None or empty, images are
+        segmented without saving the result.
+    segmenter: which segmenter to use; one of `SEGMENTERS`.
+    chunk_size: segment this many images at a time.
+
+  Returns:
+    A Kx4 uint8 array as returned by `segment`.
+  """
+  def segment_all():
+    return np.concatenate(
+        [segment(images[i:i+chunk_size], segmenter)
+         for i in range(0, len(images), chunk_size)] or
+        [np.zeros((0, 4), dtype=np.uint8)])
+
+  if not cache_dir: return segment_all()
+  path = image_cache.sidecar_path(
+      filenames, cache_dir,
+      'segmentation_{}_v{}'.format(segmenter, _SEGMENTATION_VERSION))
+  if not path.exists():
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, segment_all())
+  return np.load(path)
+
+
+def mask_digit(images, boundaries, n):
+  """Return a copy of `images` with all but the `n`th digit masked.
+
+  Args:
+    images: KxRxC or KxRxCx1 array of word images.
+    boundaries: Kx3 array of digit boundaries from e.g. `digit_boundaries`.
+    n: which digit (in [0, 3]) to show through the mask.
+
+  Returns:
+    A version of `images` masked as described.
+  """
+  cols = np.arange(images.shape[2])
+  keep = np.ones((images.shape[0], images.shape[2]), dtype=bool)
+  if n > 0: keep &= cols >= boundaries[:, n-1:n]
+  if n < 3: keep &= cols <= boundaries[:, n:n+1]
+  keep = keep.reshape(
+      (images.shape[0], 1, images.shape[2]) + (1,) * (images.ndim - 3))
+  return np.where(keep, images, np.zeros((), dtype=images.dtype))
+
+
+def mask_all_digits(images, boundaries=None, segmenter='dp'):
+  """Return four copies of `images`, each with all but one digit masked.
+
+  Args:
+    images: KxRxC or KxRxCx1 array of word images.
+    boundaries: optional Kx3 array of digit boundaries (or Kx4 segmentation
+        from `segment`). If None, they're computed with `digit_boundaries`.
+    segmenter: segmenter for computing boundaries if `boundaries` is None.
+
+  Returns:
+    A list of four masked versions of `images`, one for each digit.
+  """
+  if boundaries is None: boundaries = digit_boundaries(images, segmenter)
+  boundaries = boundaries[:, :3].astype(np.intp)
+  return [mask_digit(images, boundaries, n) for n in range(4)]
@@ -0,0 +1,177 @@
+"""Library for caching decoded word images on disk.
+
+Classifier programs load the same hundreds of thousands of word images each
+time they run, and decoding all of those .png files takes a while. This library
+decodes a list of word images once into a single KxRxC uint8 array, which it
+saves as a .npy file in a cache directory. Later requests for the same list of
+images are served by memory-mapping that file.
+
+Cache files are named for a digest of the image filenames and their sizes and
+modification times, so if any image is re-cropped or the list changes at all,
+the images are decoded again into a new cache file. Old cache files are never
+deleted by this library; remove them by hand if they take up too much space.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import hashlib
+import os
+import pathlib
+import sys
+
+import numpy as np
+import skimage
+import skimage.color
+import skimage.io
+
+
+def load_images(filenames, cache_dir=None):
+  """Load word images, from the cache if possible.
+
+  Args:
+    filenames: list of word image files to load. All images must be the same
+        size.
+    cache_dir: directory holding cached images. If None or empty, images are
+        decoded without caching.
+
+  Returns:
+    A KxRxC uint8 array of grayscale images in the same order as `filenames`.
+    If `cache_dir` is specified, this array is a read-only memory map.
+  """
+  if not cache_dir: return decode_images(filenames)
+
+  path = cache_path(filenames, cache_dir)
+  if not path.exists():
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Decode to a temporary file and rename it, so that interrupted runs don't
+    # leave incomplete cache files behind.
+    shape = (len(filenames),) + decode_image(filenames[0]).shape
+    temp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+    images = np.lib.format.open_memmap(
+        temp_path, mode='w+', dtype=np.uint8, shape=shape)
+    decode_images(filenames, out=images)
+    images.flush()
+    del images
+    os.replace(temp_path, path)
+
+  return np.load(path, mmap_mode='r')
+
+
+def decode_images(filenames, out=None, show_progress=True):
+  """Decode word images into a KxRxC uint8 array.
+
+  Args:
+    filenames: list of word image files to load.
+    out: optional KxRxC uint8 array that will receive the images.
+    show_progress: whether to display a progress indicator.
+
+  Returns:
+    `out`, or if `out` is None, a new KxRxC uint8 array of images.
+  """
+  for i, fn in enumerate(filenames):
+    # Display percentage progress indicator.
+    if show_progress:
+      sys.stdout.write('   {}% '.format(round(100 * i / len(filenames))))
+      sys.stdout.flush()
+
+    image = decode_image(fn)
+    if out is None:
+      out = np.empty((len(filenames),) + image.shape, dtype=np.uint8)
+    out[i] = image
+
+    # Clear away progress indicator.
+    if show_progress:
+      sys.stdout.write('\r\x1b[K')
+      sys.stdout.flush()
+
+  return out
+
+
+def decode_image(filename):
+  """Decode a single word image into an RxC uint8 grayscale array."""
+  image = skimage.io.imread(filename)
+  if image.ndim == 3:
+    image = np.round(255.0 * skimage.color.rgb2gray(image))
+  return image.astype(np.uint8)
+
+
+def content_hashes(images, chunk_size=8192, bits=8):
+  """Compute a 64-bit hash of the pixels of each image in a batch.
+
+  Hashes are not cryptographic, but any change to an image is very likely to
+  change its hash. They are computed for whole batches at once.
+
+  Args:
+    images: KxRxC... uint8 array of images.
+    chunk_size: hash this many images at a time.
+    bits: hash only this many of the most significant bits of each pixel, so
+        that images differing only in the remaining bits hash alike.
+
+  Returns:
+    A K-vector of uint64 hashes.
+  """
+  pixels = images.reshape((images.shape[0], -1))
+  # Each pixel is weighted by a different odd power of an odd constant, so the
+  # weighted sum (wrapping around modulo 2**64) depends on where every pixel
+  # is. The sum is then scrambled by the MurmurHash3 finaliser.
+  weights = np.cumprod(np.full(pixels.shape[1], 0x9E3779B97F4A7C15,
+                               dtype=np.uint64)) | np.uint64(1)
+  hashes = np.empty(pixels.shape[0], dtype=np.uint64)
+  with np.errstate(over='ignore'):
+    for i in range(0, pixels.shape[0], chunk_size):
+      chunk = pixels[i:i+chunk_size] >> np.uint8(8 - bits)
+      h = np.sum((chunk.astype(np.uint64) + np.uint64(1)) * weights,
+                 axis=1, dtype=np.uint64)
+      h ^= h >> np.uint64(33)
+      h *= np.uint64(0xFF51AFD7ED558CCD)
+      h ^= h >> np.uint64(33)
+      h *= np.uint64(0xC4CEB9FE1A85EC53)
+      h ^= h >> np.uint64(33)
+      hashes[i:i+chunk_size] = h
+  return hashes
+
+
+def find_duplicates(hashes):
+  """Group images with identical hashes.
+
+  Args:
+    hashes: K-vector of image hashes, e.g. from `content_hashes`.
+
+  Returns:
+    A 2-tuple: an N-vector of the indices of the first image in each of the N
+    groups of images sharing a hash, in increasing order; and a list of N
+    arrays of the indices of all images in each group.
+  """
+  _, first, inverse, counts = np.unique(
+      hashes, return_index=True, return_inverse=True, return_counts=True)
+  groups = np.split(np.argsort(inverse, kind='stable'), np.cumsum(counts)[:-1])
+  order = np.argsort(first)
+  return first[order], [groups[i] for i in order]
+
+
+def cache_path(filenames, cache_dir):
+  """Path of the cache file for `filenames` inside `cache_dir`."""
+  return pathlib.Path(cache_dir) / '{}.npy'.format(_digest(filenames))
+
+
+def sidecar_path(filenames, cache_dir, name):
+  """Path of a file of derived data `name` for the cache file for `filenames`.
+
+  Other libraries can use files at this path to save data computed from the
+  cached images; the path changes whenever the cache file's path does.
+  """
+  return pathlib.Path(cache_dir) / '{}.{}.npy'.format(_digest(filenames), name)
+
+
+def _digest(filenames):
+  """Hex digest of image filenames, sizes, and modification times."""
+  digest = hashlib.sha1()
+  for fn in filenames:
+    stat = os.stat(fn)
+    digest.update('{}\0{}\0{}\n'.format(
+        fn, stat.st_size, stat.st_mtime_ns).encode())
+  return digest.hexdigest()
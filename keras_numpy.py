@@ -0,0 +1,235 @@
+"""Run convnets trained by `labels_classification_keras.py` with NumPy alone.
+
+Importing Keras means probing for a working backend and starting up a whole
+deep-learning framework, but the convnets that `labels_classification_keras.py`
+trains are small, and their layers are simple to compute directly. `export`
+writes the weights of a trained Keras model and a description of its layers to
+an .npz file, and `load` turns that file into a `NumpyModel`, which classifies
+images with nothing but NumPy.
+
+The layers `NumpyModel` knows are `Conv2D` (stride 1, "same" or "valid"
+padding), `MaxPooling2D` (with strides equal to the pool size), `Flatten`,
+`Dense`, `Dropout` (which does nothing at inference time), and `Activation`,
+with ReLU, sigmoid, tanh, softmax, and linear activations. A model must be a
+chain of these layers, as in a `Sequential` model, except that the chain may
+end in several output layers that all take its output, as in the model that
+`labels_classification_keras.py` trains for --shared-model.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import json
+import numpy as np
+
+
+def export(model, filename, input_scale=1.0):
+  """Save a Keras model's layers and weights for `load`.
+
+  Args:
+    model: a Keras model made of the layers listed in the module docstring.
+    filename: .npz file to write.
+    input_scale: `NumpyModel.predict_proba` multiplies images by this before
+        classifying them, e.g. 1/255 for a model trained on images scaled to
+        [0, 1].
+
+  Raises:
+    ValueError: the model has layers or settings that `NumpyModel` can't
+        compute.
+  """
+  output_names = set(getattr(model, 'output_names', []))
+  layers, outputs, arrays = [], [], {}
+  for layer in model.layers:
+    kind = type(layer).__name__
+    if kind == 'InputLayer': continue
+    spec = _layer_spec(kind, layer.get_config())
+    for name, weights in zip(('kernel', 'bias'), layer.get_weights()):
+      key = 'layer_{}_{}'.format(len(layers) + len(outputs), name)
+      arrays[key] = np.asarray(weights, dtype=np.float32)
+      spec[name] = key
+    (outputs if layer.name in output_names and len(output_names) > 1
+     else layers).append(spec)
+
+  spec = dict(input_shape=list(model.input_shape[1:]), input_scale=input_scale,
+              layers=layers, outputs=outputs)
+  np.savez(filename, spec=np.array(json.dumps(spec)), **arrays)
+
+
+def load(filename):
+  """Load a `NumpyModel` from a file written by `export`."""
+  with np.load(filename, allow_pickle=False) as data:
+    spec = json.loads(str(data['spec']))
+    arrays = {k: data[k] for k in data.files if k != 'spec'}
+  resolve = lambda specs: [
+      dict(s, **{k: arrays[s[k]] for k in ('kernel', 'bias') if k in s})
+      for s in specs]
+  return NumpyModel(spec['input_shape'], resolve(spec['layers']),
+                    resolve(spec['outputs']), spec['input_scale'])
+
+
+def _layer_spec(kind, config):
+  """Describe a Keras layer of type `kind` with configuration `config`."""
+  if config.get('data_format', 'channels_last') != 'channels_last':
+    raise ValueError('Only channels_last layers are supported.')
+
+  if kind == 'Conv2D':
+    if tuple(config['strides']) != (1, 1) or config['padding'] not in (
+        'same', 'valid') or tuple(config.get('dilation_rate', (1, 1))) != (
+            1, 1):
+      raise ValueError('Conv2D layers must have stride 1 and no dilation.')
+    return dict(type='conv2d', padding=config['padding'],
+                activation=_activation(config['activation']))
+  elif kind == 'MaxPooling2D':
+    pool = tuple(config['pool_size'])
+    if tuple(config['strides'] or pool) != pool or config['padding'] != 'valid':
+      raise ValueError('MaxPooling2D layers must have strides equal to their '
+                       'pool size and "valid" padding.')
+    return dict(type='max_pool', pool_size=list(pool))
+  elif kind == 'Dense':
+    return dict(type='dense', activation=_activation(config['activation']))
+  elif kind == 'Activation':
+    return dict(type='activation',
+                activation=_activation(config['activation']))
+  elif kind in ('Flatten', 'Dropout'):
+    return dict(type=kind.lower())
+  else:
+    raise ValueError("Can't export {} layers.".format(kind))
+
+
+def _activation(name):
+  """Check that an activation function is one `NumpyModel` can compute."""
+  if name not in ACTIVATIONS: raise ValueError(
+      "Can't export {} activations.".format(name))
+  return name
+
+
+class NumpyModel(object):
+  """A convnet exported from Keras, computed with NumPy.
+
+  `predict` works like a Keras model's `predict`. `predict_proba` works like
+  a `MultiDigitClassifier`'s, so that `labels_classification.py` can use
+  exported convnets just as it uses its own classifiers.
+  """
+
+  def __init__(self, input_shape, layers, outputs=(), input_scale=1.0):
+    self.input_shape = tuple(input_shape)
+    self.layers = list(layers)
+    self.outputs = list(outputs)
+    self.input_scale = input_scale
+
+  def predict(self, inputs, batch_size=1024):
+    """Outputs for KxRxCx1 `inputs`: an array, or a list for several outputs.
+
+    Args:
+      inputs: images with shape (K,) + `input_shape`, prepared as for the
+          Keras model.
+      batch_size: compute outputs for this many images at a time.
+
+    Returns:
+      A Kx16 array of class probabilities, or a list of them for a model with
+      several outputs.
+    """
+    results = []
+    for start in range(0, len(inputs), batch_size):
+      x = self._forward(self.layers, np.asarray(
+          inputs[start:start+batch_size], dtype=np.float32))
+      results.append([self._forward([o], x) for o in self.outputs] or [x])
+    outputs = [np.concatenate(r) for r in zip(*results)] if results else [
+        np.zeros((0, 16), dtype=np.float32)] * max(1, len(self.outputs))
+    return outputs if self.outputs else outputs[0]
+
+  def predict_proba(self, inputs):
+    """KxDx16 class probabilities for D outputs, from linearised images.
+
+    Args:
+      inputs: a KxP array of linearised images with their original pixel
+          values, which are multiplied by `input_scale`.
+    """
+    images = np.asarray(inputs, dtype=np.float32).reshape(
+        (-1,) + self.input_shape) * np.float32(self.input_scale)
+    outputs = self.predict(images)
+    if not isinstance(outputs, list): outputs = [outputs]
+    return np.stack(outputs, axis=1)
+
+  def _forward(self, layers, x):
+    """Apply a chain of layer specs to `x`. Subclasses may override this."""
+    return forward(layers, x)
+
+
+def forward(layers, x):
+  """Apply a chain of layer specs to a batch of activations `x`.
+
+  Args:
+    layers: list of layer spec dicts, as in `NumpyModel.layers`.
+    x: a batch of activations: NHWC images for convolutional layers, or a
+        KxN array for dense layers.
+
+  Returns:
+    The activations the last layer outputs.
+  """
+  for spec in layers:
+    kind = spec['type']
+    if kind == 'conv2d':
+      x = _conv2d(x, spec['kernel'], spec['padding'])
+    elif kind == 'max_pool':
+      x = _max_pool(x, *spec['pool_size'])
+    elif kind == 'dense':
+      x = x @ spec['kernel']
+    elif kind == 'flatten':
+      x = x.reshape((len(x), -1))
+    if 'bias' in spec: x = x + spec['bias']
+    if 'activation' in spec: x = ACTIVATIONS[spec['activation']](x)
+  return x
+
+
+def _conv2d(x, kernel, padding):
+  """Stride-1 2-D convolution (correlation, as in Keras) of NHWC `x`."""
+  kh, kw, cin, cout = kernel.shape
+  columns = patches(x, kh, kw, padding)
+  return (columns @ kernel.reshape((kh * kw * cin, cout))).reshape(
+      columns.shape[:3] + (cout,))
+
+
+def patches(x, kh, kw, padding):
+  """Every `kh`x`kw` patch of NHWC `x`, for convolution by matrix product.
+
+  Args:
+    x: a KxHxWxC array.
+    kh: patch rows.
+    kw: patch columns.
+    padding: "same" to pad `x` with zeros so that there's a patch centred on
+        every pixel, or "valid" for no padding.
+
+  Returns:
+    A KxH'xW'x(kh*kw*C) array: each patch, linearised in the same order as
+    the weights of a Keras `Conv2D` kernel of the same size.
+  """
+  if padding == 'same':
+    top, left = (kh - 1) // 2, (kw - 1) // 2
+    x = np.pad(x, ((0, 0), (top, kh - 1 - top), (left, kw - 1 - left), (0, 0)))
+  h, w = x.shape[1] - kh + 1, x.shape[2] - kw + 1
+  return np.stack([x[:, i:i+h, j:j+w, :]
+                   for i in range(kh) for j in range(kw)], axis=3).reshape(
+                       (len(x), h, w, -1))
+
+
+def _max_pool(x, ph, pw):
+  """Max pooling of NHWC `x` over non-overlapping `ph`x`pw` windows."""
+  k, h, w, c = x.shape
+  x = x[:, :h - h % ph, :w - w % pw, :]
+  return x.reshape((k, h // ph, ph, w // pw, pw, c)).max(axis=(2, 4))
+
+
+def _softmax(x):
+  """Softmax along the last axis."""
+  x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+  return x / np.sum(x, axis=-1, keepdims=True)
+
+
+# Activation functions, by their names in Keras.
+ACTIVATIONS = dict(linear=lambda x: x, relu=lambda x: np.maximum(x, 0),
+                   sigmoid=lambda x: 1.0 / (1.0 + np.exp(-x)), tanh=np.tanh,
+                   softmax=_softmax)
@@ -1,5 +1,10 @@
 """Library for our database of image labels.
 
+Databases are CSV files with the header "Filename,Label,Count". Programs that
+classify images may also record a fingerprint of the image and of the
+classifier that labeled it in an optional fourth "Fingerprint" column, which is
+only written if at least one image has a fingerprint.
+
 Licensing:
 
 This program and any supporting programs, software libraries, and documentation
@@ -43,6 +48,8 @@ class Database(object):
     self._database = collections.OrderedDict()
     # Maps counts to sets of filenames.
     self._by_count = collections.defaultdict(set)
+    # Maps filename to fingerprint, for images that have one.
+    self._fingerprints = {}
     self.reload()
 
   def __enter__(self):
@@ -62,6 +69,11 @@ class Database(object):
     with self._lock_db:
       return self._database[filename]
 
+  def fingerprint(self, filename):
+    """Retrieve the fingerprint recorded with an image's label (or None)."""
+    with self._lock_db:
+      return self._fingerprints.get(filename)
+
   def num_labels_with_counts_of_at_least(self, n):
     """How many labels have been supplied at least `n` times?"""
     with self._lock_db:
@@ -134,7 +146,7 @@ class Database(object):
         self._by_count[count].remove(filename)
         self._by_count[count - 1].add(filename)
 
-  def force(self, filename, label, count):
+  def force(self, filename, label, count, fingerprint=None):
     """Force a particular label and count in the image label database.
 
     List an image in the database as having a particular label and count.
@@ -144,6 +156,8 @@ class Database(object):
       filename: filename of image to force-label.
       label: label for this image.
       count: label count for the label.
+      fingerprint: optional fingerprint string to record with the label. Any
+          fingerprint recorded previously is discarded.
 
     Raises:
       RuntimeError: the database is open in read-only mode.
@@ -155,6 +169,10 @@ class Database(object):
         self._by_count[self._database[filename][1]].remove(filename)
       self._database[filename] = (label, count)
       self._by_count[count].add(filename)
+      if fingerprint is None:
+        self._fingerprints.pop(filename, None)
+      else:
+        self._fingerprints[filename] = fingerprint
 
   def reload(self):
     """Reload the image label database from the CSV file."""
@@ -162,15 +180,20 @@ class Database(object):
       with open(self._filename, newline='') as csvfile:
         reader = csv.reader(csvfile)
         fieldnames = next(reader)
-        assert fieldnames == ['Filename', 'Label', 'Count'], (
-            'Label database column names must be "Filename,Label,Count"')
+        assert fieldnames in (['Filename', 'Label', 'Count'],
+                              ['Filename', 'Label', 'Count', 'Fingerprint']), (
+            'Label database column names must be "Filename,Label,Count" '
+            'or "Filename,Label,Count,Fingerprint"')
 
         self._database = collections.OrderedDict()
         self._by_count = collections.defaultdict(set)
-        for imgfile, label, count in reader:
+        self._fingerprints = {}
+        for imgfile, label, count, *fingerprint in reader:
           count = int(count)
           self._database[imgfile] = (label, count)
           self._by_count[count].add(imgfile)
+          if fingerprint and fingerprint[0]:
+            self._fingerprints[imgfile] = fingerprint[0]
 
   def save(self):
     """Save the image label database to the CSV file, making backups."""
@@ -185,12 +208,18 @@ class Database(object):
         shutil.move(self._filename,
                     '{}~{}~'.format(self._filename, int(time.time())))
 
-      # Write a new database file.
+      # Write a new database file, with fingerprints only if there are any.
       with open(self._filename, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, dialect='unix')
-        writer.writerow(['Filename', 'Label', 'Count'])
-        for imgfile, (label, count) in self._database.items():
-          writer.writerow([imgfile, label, count])
+        if self._fingerprints:
+          writer.writerow(['Filename', 'Label', 'Count', 'Fingerprint'])
+          for imgfile, (label, count) in self._database.items():
+            writer.writerow([imgfile, label, count,
+                             self._fingerprints.get(imgfile, '')])
+        else:
+          writer.writerow(['Filename', 'Label', 'Count'])
+          for imgfile, (label, count) in self._database.items():
+            writer.writerow([imgfile, label, count])
 
   def _check_writable(self):
     """Raise `RuntimeError` if the database is in read-only mode."""
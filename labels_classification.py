@@ -3,7 +3,9 @@
 
 This program uses the training data to train four classifiers: one for each
 digit in a word image. It uses these classifiers to label the digits in all of
-the word images.
+the word images. Alternatively, with --shared-model, it trains one classifier
+that labels all four digits at once. The "template" classifier type (see
+`template_classifier`) always labels all four digits at once.
 
 Licensing:
 
@@ -14,19 +16,27 @@ warranty. See the LICENSE file for details.
 
 import argparse
 import collections
+import concurrent.futures
+import inspect
+import multiprocessing.shared_memory
 import numpy as np
 import pathlib
 import scipy as sp
 import scipy.ndimage
-import skimage
-import skimage.io
 import sklearn.ensemble
 import sklearn.svm
 import sklearn.neighbors
 import sklearn.neural_network
-import sys
 
+import classify_pipeline
+import digit_masking
+import image_cache
+import keras_numpy
 import label_database
+import model_store
+import multi_digit_classifier
+import probability_store
+import template_classifier
 
 
 def _define_flags():
@@ -64,6 +74,106 @@ def _define_flags():
                            'are presented to or used to train classifiers for '
                            'those digits.'))
 
+  flags.add_argument('--classifier-type', default='mlp',
+                     choices=CLASSIFIER_TYPES,
+                     help=('Which kind of classifier to train for each '
+                           'digit. "template" trains one template-matching '
+                           'classifier for all digits, as if --shared-model '
+                           'were given.'))
+
+  flags.add_argument('--shared-model', action='store_true',
+                     help=('Train one classifier that labels all four digits '
+                           'at once instead of one classifier for each digit. '
+                           'Incompatible with --mask-digits.'))
+
+  flags.add_argument('--training-processes', default=1, type=int,
+                     help=('Train the classifiers for different digits in '
+                           'this many processes at once. Their training '
+                           'progress reports are interleaved.'))
+
+  flags.add_argument('--segmenter', default='dp',
+                     choices=digit_masking.SEGMENTERS,
+                     help=('How to find the boundaries between digits when '
+                           'masking: "dp" chooses the best split into four '
+                           'digits of plausible widths; "minima" takes the '
+                           'three smallest minima of the column sums.'))
+
+  flags.add_argument('--skip-ambiguous-segmentation', action='store_true',
+                     help=('When masking digits, leave word images out of the '
+                           'training and test data if the boundaries between '
+                           'their digits are doubtful.'))
+
+  flags.add_argument('--seed', type=int,
+                     help=('Seed for the random division of labeled images '
+                           'into training and test data and for the initial '
+                           'state of the classifiers. Without a seed, '
+                           'training is not repeatable, so saved classifiers '
+                           'are never reused in place of training new ones.'))
+
+  flags.add_argument('--model-dir', default='models', type=str,
+                     help=('Save trained classifiers in this directory, and '
+                           'reuse saved classifiers instead of training new '
+                           'ones when the training data and settings, '
+                           'including --seed, are the same. An empty value '
+                           'disables saving.'))
+
+  flags.add_argument('--retrain', action='store_true',
+                     help=('Train new classifiers even if matching saved '
+                           'classifiers exist.'))
+
+  flags.add_argument('--load-model', type=str,
+                     help=('Skip training and classify images with the '
+                           'classifiers saved in this directory.'))
+
+  flags.add_argument('--classify-only', action='store_true',
+                     help=('Skip training and classify images with the '
+                           'classifiers trained most recently in --model-dir, '
+                           'passing over quantised ones.'))
+
+  flags.add_argument('--full', action='store_true',
+                     help=('Classify all word images, even those whose '
+                           'labels in output_label_database came from the '
+                           'same classifiers and unchanged images.'))
+
+  flags.add_argument('--probabilities', type=str,
+                     help=('Save the probabilities that the classifiers '
+                           'assign to each value of each digit of every word '
+                           'image in this .npy file (see probability_store).'))
+
+  flags.add_argument('--deduplicate', action='store_true',
+                     help=('Classify only one of each group of word images '
+                           'with identical pixels, giving its label to the '
+                           'whole group.'))
+
+  flags.add_argument('--deduplicate-bits', default=8, type=int,
+                     choices=range(1, 9), metavar='{1..8}',
+                     help=('With --deduplicate, compare only this many of the '
+                           'most significant bits of each pixel, so that '
+                           'images differing by faint noise count as '
+                           'duplicates.'))
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  flags.add_argument('--classification-batch-size', default=4096, type=int,
+                     help=('Classify this many word images at a time when '
+                           'labeling all of the word images.'))
+
+  flags.add_argument('--decode-threads', default=4, type=int,
+                     help=('Number of threads loading word images while the '
+                           'classifiers label other word images.'))
+
+  flags.add_argument('--decode-queue-depth', default=4, type=int,
+                     help=('Load at most this many batches of word images '
+                           'ahead of the classifiers. Memory used by loaded '
+                           'images is capped at this many batches.'))
+
+  flags.add_argument('--write-queue-depth', default=4, type=int,
+                     help=('Allow at most this many batches of labels to wait '
+                           'to be written to the output label database.'))
+
   return flags
 
 
@@ -75,6 +185,12 @@ def main(FLAGS):
     raise ValueError("Input and output label databases can't be the same file.")
   if FLAGS.minimum_label_count < 1: raise ValueError(
       'The value of --minimum-label-count must be greater than 2.')
+  shared_model = FLAGS.shared_model or FLAGS.classifier_type == 'template'
+  if shared_model and FLAGS.mask_digits: raise ValueError(
+      "--shared-model and --mask-digits can't be used together.")
+  if shared_model and FLAGS.classifier_type not in ('mlp', 'template'):
+    raise ValueError(
+        '--shared-model only works with --classifier-type=mlp or template.')
 
   # Create new output label database if it doesn't exist yet.
   if not pathlib.Path(FLAGS.output_label_database).exists():
@@ -89,36 +205,76 @@ def main(FLAGS):
     with label_database.Database(
         FLAGS.output_label_database, save_backups=False) as db_out:
 
-      # Load labeled images and per-digit labels.
-      print('Loading labeled images; arranging test/train data...')
-      all_data = load_data(db_in, FLAGS.minimum_label_count, FLAGS.max_0000)
-
-      # Divide into training and test data.
-      train_data, test_data = divide_data(all_data, FLAGS.train_data_fraction)
-      print('   ...loaded', len(train_data), 'data points for training,',
-            len(test_data), 'for testing.')
-
-      # Train classifiers.
-      classifiers = []
-      for d in range(1, train_data.num_digits() + 1):
-        images_train = train_data.images
-        images_test = test_data.images
-        if FLAGS.mask_digits:
-          print('Preprocessing data for digit {}...'.format(d))
-          images_train = mask_nth_digit_in_images(images_train, d - 1)
-          images_test = mask_nth_digit_in_images(images_test, d - 1)
-
-        print('Training classifier for digit {}...'.format(d))
-        cfier = train_classifier(images_train, train_data[d])
-        print('        Training set accuracy:',
-              test_classifier(cfier, images_train, train_data[d]))
-        print('            Test set accuracy:',
-              test_classifier(cfier, images_test, test_data[d]))
-        classifiers.append(cfier)
-
-      # Now classify all of the data.
+      if FLAGS.load_model or FLAGS.classify_only:
+        # Use previously trained classifiers if directed. Quantised
+        # classifiers are only used if they're named explicitly...
+        path = FLAGS.load_model or model_store.latest(
+            FLAGS.model_dir, program=_PROGRAM, quantised=None)
+        print('Loading classifiers from {}...'.format(path))
+        classifiers, metadata = load_classifiers(path)
+
+      else:
+        # ...otherwise, load labeled images and per-digit labels.
+        print('Loading labeled images; arranging test/train data...')
+        all_data = load_data(
+            db_in, FLAGS.minimum_label_count, FLAGS.max_0000,
+            FLAGS.image_cache_dir,
+            FLAGS.segmenter if FLAGS.mask_digits else None)
+
+        # Leave out images that may be masked badly, if desired.
+        if FLAGS.mask_digits and FLAGS.skip_ambiguous_segmentation:
+          unambiguous = all_data.segments[:, 3] == 0
+          print('   ...leaving out', np.sum(~unambiguous), 'images with '
+                'ambiguous digit boundaries.')
+          all_data = Data(*[d[unambiguous] for d in all_data])
+
+        # Classifiers trained on the same data in the same way may be saved
+        # already. If so, and if we're allowed, we use them. Only seeded
+        # training is repeatable, so unseeded runs always train afresh.
+        metadata = dict(program=_PROGRAM, mask_digits=bool(FLAGS.mask_digits),
+                        segmenter=FLAGS.segmenter,
+                        shared_model=shared_model,
+                        classifier_type=FLAGS.classifier_type)
+        fp = model_store.fingerprint(
+            *all_data, metadata, FLAGS.train_data_fraction, FLAGS.seed,
+            _training_source())
+        metadata['fingerprint'] = fp
+        path = model_store.model_path(FLAGS.model_dir, fp)
+        if (FLAGS.model_dir and FLAGS.seed is not None and path.exists() and
+            not FLAGS.retrain):
+          print('Loading saved classifiers from {}...'.format(path))
+          classifiers, metadata = load_classifiers(path)
+
+        else:
+          # Divide into training and test data.
+          if FLAGS.seed is not None: np.random.seed(FLAGS.seed)
+          train_data, test_data = divide_data(
+              all_data, FLAGS.train_data_fraction)
+          print('   ...loaded', len(train_data), 'data points for training,',
+                len(test_data), 'for testing.')
+
+          # Train and save classifiers.
+          classifiers = train_classifiers(
+              train_data, test_data, FLAGS.mask_digits, shared_model,
+              FLAGS.training_processes, FLAGS.classifier_type, FLAGS.seed)
+          if FLAGS.model_dir:
+            print('Saving classifiers to {}...'.format(path))
+            metadata = model_store.save(path, classifiers,
+                                        model_store.pickle_classifier, metadata)
+
+      # Now classify all of the data. Classifiers that weren't saved have no
+      # version, so their labels can't be kept by later runs.
       print('Classifying all word images...')
-      classify_everything(db_in, db_out, classifiers, FLAGS.mask_digits)
+      model_version = metadata.get('version')
+      classify_everything(db_in, db_out, classifiers, metadata['mask_digits'],
+                          metadata['segmenter'], FLAGS.image_cache_dir,
+                          FLAGS.classification_batch_size,
+                          FLAGS.decode_threads, FLAGS.decode_queue_depth,
+                          FLAGS.write_queue_depth,
+                          model_version and model_version[
+                              :_MODEL_VERSION_LENGTH],
+                          FLAGS.full, FLAGS.probabilities,
+                          FLAGS.deduplicate_bits if FLAGS.deduplicate else None)
 
       # All done!
       print('Saving output label database...')
@@ -127,45 +283,299 @@ def main(FLAGS):
 #### CLASSIFICATION ####
 
 
-def train_classifier(inputs, labels):
+def train_classifiers(train_data, test_data, mask_digits, shared_model,
+                      training_processes, classifier_type='mlp', seed=None):
+  """Train and test classifiers for all digits.
+
+  Args:
+    train_data: `Data` for training the classifiers.
+    test_data: `Data` for testing the classifiers.
+    mask_digits: Whether to mask digits in the images.
+    shared_model: Whether to train one classifier for all digits.
+    training_processes: Number of processes training per-digit classifiers.
+    classifier_type: Which kind of classifiers to train; one of
+        `CLASSIFIER_TYPES`.
+    seed: Optional seed for classifiers with random initialisation. The
+        classifier for digit d (counting from 0) gets `seed + d`, so that
+        results don't depend on `training_processes`.
+
+  Returns:
+    A list of 16-class classifiers, one for each digit, or a list holding just
+    one `MultiDigitClassifier` or `TemplateClassifier`.
+  """
+  # Train classifiers: either one for all digits...
+  classifiers = []
+  if shared_model:
+    print('Training shared classifier for all digits...')
+    cfier = train_shared_classifier(train_data.images,
+                                    train_data.all_labels(), classifier_type,
+                                    seed)
+    print('        Training set accuracy:', test_classifier(
+        cfier, train_data.images, train_data.all_labels()))
+    print('            Test set accuracy:', test_classifier(
+        cfier, test_data.images, test_data.all_labels()))
+    classifiers.append(cfier)
+
+  elif training_processes > 1:
+    # ...or one for each digit, several at a time...
+    print('Training classifiers for all digits in {} processes...'.format(
+        training_processes))
+    results = train_classifiers_in_parallel(
+        train_data, test_data, mask_digits, training_processes,
+        classifier_type, seed)
+    for d, (cfier, train_accuracy, test_accuracy) in enumerate(results):
+      print('Classifier for digit {}:'.format(d + 1))
+      print('        Training set accuracy:', train_accuracy)
+      print('            Test set accuracy:', test_accuracy)
+      classifiers.append(cfier)
+
+  else:
+    # ...or one for each digit, one at a time. Mask digits if desired.
+    if mask_digits:
+      print('Preprocessing data...')
+      masked_train = mask_digits_in_images(
+          train_data.images, train_data.segments)
+      masked_test = mask_digits_in_images(
+          test_data.images, test_data.segments)
+
+    for d in range(1, train_data.num_digits() + 1):
+      images_train = train_data.images
+      images_test = test_data.images
+      if mask_digits:
+        images_train = masked_train[d - 1]
+        images_test = masked_test[d - 1]
+
+      print('Training classifier for digit {}...'.format(d))
+      cfier = train_classifier(images_train, train_data[d], classifier_type,
+                               _digit_seed(seed, d - 1))
+      print('        Training set accuracy:',
+            test_classifier(cfier, images_train, train_data[d]))
+      print('            Test set accuracy:',
+            test_classifier(cfier, images_test, test_data[d]))
+      classifiers.append(cfier)
+
+  return classifiers
+
+
+def _digit_seed(seed, n):
+  """Seed for the classifier for digit `n` (in [0, 3]), or None if unseeded."""
+  return None if seed is None else seed + n
+
+
+def train_classifier(inputs, labels, classifier_type='mlp', random_state=None):
   """Train a classifier from flattened image inputs to labels.
 
   Args:
     inputs: a Kx464 array of linearised input images.
     labels: a K-vector of integer labels.
+    classifier_type: which kind of classifier to train; one of
+        `CLASSIFIER_TYPES`.
+    random_state: optional seed for classifiers with random initialisation.
 
   Returns:
     A scikit-learn classifier trained on the argument data.
   """
-  # classifier = sklearn.svm.LinearSVC(class_weight='balanced')
-  # classifier = sklearn.neighbors.KNeighborsClassifier()
-  # classifier = sklearn.ensemble.GradientBoostingClassifier(verbose=100)
-  # classifier = sklearn.ensemble.RandomForestClassifier(class_weight='balanced')
-  classifier = sklearn.neural_network.MLPClassifier(
-      hidden_layer_sizes=(50, 40, 30),
-      # hidden_layer_sizes=(80, 60, 40),  # Probably too big.
-      # hidden_layer_sizes=(40, 30, 20),  # Too small?
-      # hidden_layer_sizes=(40, 20, 30),
-      # hidden_layer_sizes=(60, 50, 40, 30),  # :-P
-      # hidden_layer_sizes=(30, 20, 20, 30),  # 8-P
-      # tol=1e-4,
-      solver='lbfgs',
-      tol=1e-6,
-      max_iter=10000,
-      # batch_size=500,
-      batch_size=5000,
-      verbose=True)
+  classifier = make_classifier(classifier_type, random_state)
   classifier.fit(inputs, labels)
   return classifier
 
 
+def make_classifier(classifier_type='mlp', random_state=None):
+  """Create an untrained classifier of the type named by `classifier_type`."""
+  if classifier_type == 'linear_svm':
+    return sklearn.svm.LinearSVC(class_weight='balanced',
+                                 random_state=random_state)
+  elif classifier_type == 'knn':
+    return sklearn.neighbors.KNeighborsClassifier()
+  elif classifier_type == 'gradient_boosting':
+    return sklearn.ensemble.GradientBoostingClassifier(
+        verbose=100, random_state=random_state)
+  elif classifier_type == 'random_forest':
+    return sklearn.ensemble.RandomForestClassifier(
+        class_weight='balanced', random_state=random_state)
+  elif classifier_type == 'template':
+    return template_classifier.TemplateClassifier()
+  elif classifier_type == 'mlp':
+    return sklearn.neural_network.MLPClassifier(
+        hidden_layer_sizes=(50, 40, 30),
+        # hidden_layer_sizes=(80, 60, 40),  # Probably too big.
+        # hidden_layer_sizes=(40, 30, 20),  # Too small?
+        # hidden_layer_sizes=(40, 20, 30),
+        # hidden_layer_sizes=(60, 50, 40, 30),  # :-P
+        # hidden_layer_sizes=(30, 20, 20, 30),  # 8-P
+        # tol=1e-4,
+        solver='lbfgs',
+        tol=1e-6,
+        max_iter=10000,
+        # batch_size=500,
+        batch_size=5000,
+        verbose=True,
+        random_state=random_state)
+  else:
+    raise ValueError('Unknown classifier type "{}"; choose one of {}.'.format(
+        classifier_type, ', '.join(CLASSIFIER_TYPES)))
+
+
+# Names of the kinds of classifiers that `make_classifier` can create. All but
+# "template" classify one digit; "template" classifies all four at once.
+CLASSIFIER_TYPES = (
+    'mlp', 'linear_svm', 'knn', 'gradient_boosting', 'random_forest',
+    'template')
+
+
+def train_shared_classifier(inputs, labels, classifier_type='mlp',
+                            random_state=None):
+  """Train a classifier from flattened image inputs to labels for all digits.
+
+  Args:
+    inputs: a Kx464 array of linearised input images.
+    labels: a Kx4 array of integer labels, one column for each digit.
+    classifier_type: 'mlp' for a `MultiDigitClassifier` wrapping an MLP, or
+        'template' for a `TemplateClassifier`.
+    random_state: optional seed for the MLP's random initialisation.
+
+  Returns:
+    A classifier trained on the argument data.
+  """
+  if classifier_type == 'template':
+    return make_classifier('template').fit(inputs, labels)
+  classifier = multi_digit_classifier.MultiDigitClassifier(
+      sklearn.neural_network.MLPClassifier(
+          hidden_layer_sizes=(50, 40, 30),
+          solver='lbfgs',
+          tol=1e-6,
+          max_iter=10000,
+          batch_size=5000,
+          verbose=True, random_state=random_state))
+  classifier.fit(inputs, labels)
+  return classifier
+
+
+def train_classifiers_in_parallel(train_data, test_data, do_masking,
+                                  processes, classifier_type='mlp', seed=None):
+  """Train and test per-digit classifiers in a pool of processes.
+
+  Training and test images are placed in shared memory, so that worker
+  processes can read them without receiving copies of their own. Workers mask
+  the images for their digits themselves.
+
+  Args:
+    train_data: `Data` for training the classifiers.
+    test_data: `Data` for testing the classifiers.
+    do_masking: Whether to mask digits in the images.
+    processes: Number of worker processes.
+    classifier_type: Which kind of classifiers to train; one of
+        `CLASSIFIER_TYPES`.
+    seed: Optional seed for classifiers with random initialisation; see
+        `train_classifiers`.
+
+  Returns:
+    A list with an entry for each digit: a 3-tuple of the classifier trained
+    for that digit, its training set accuracy, and its test set accuracy.
+  """
+  shared = []
+  try:
+    # Copy images into shared memory.
+    images = []
+    for data in (train_data, test_data):
+      block = multiprocessing.shared_memory.SharedMemory(
+          create=True, size=max(1, data.images.nbytes))
+      shared.append(block)
+      np.copyto(np.ndarray(data.images.shape, data.images.dtype, block.buf),
+                data.images)
+      images.append((block.name, data.images.shape, data.images.dtype))
+
+    # Train classifiers for all digits.
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+      segments = ((train_data.segments, test_data.segments) if do_masking
+                  else None)
+      futures = [executor.submit(_train_and_test_digit, n, images,
+                                 (train_data[n + 1], test_data[n + 1]),
+                                 segments, classifier_type,
+                                 _digit_seed(seed, n))
+                 for n in range(train_data.num_digits())]
+      return [f.result() for f in futures]
+
+  finally:
+    for block in shared:
+      block.close()
+      block.unlink()
+
+
+def _train_and_test_digit(n, images, labels, segments, classifier_type,
+                          random_state):
+  """Worker for `train_classifiers_in_parallel`: train and test for digit `n`.
+
+  Args:
+    n: Which digit (in [0, 3]) to train a classifier for.
+    images: Training and test images, each given as a (shared memory block
+        name, shape, dtype) tuple.
+    labels: Training and test labels for digit `n`.
+    segments: Training and test segmentations for masking the images, or None
+        if images should not be masked.
+    classifier_type: Which kind of classifier to train.
+    random_state: Seed for the classifier's random initialisation, or None.
+
+  Returns:
+    The classifier, its training set accuracy, and its test set accuracy.
+  """
+  blocks = [multiprocessing.shared_memory.SharedMemory(name=name)
+            for name, _, _ in images]
+  inputs = []
+  try:
+    inputs = [np.ndarray(shape, dtype, block.buf)
+              for block, (_, shape, dtype) in zip(blocks, images)]
+    if segments is not None:
+      inputs = [digit_masking.mask_digit(i.reshape((-1, 16, 29)),
+                                         s[:, :3].astype(np.intp),
+                                         n).reshape(i.shape)
+                for i, s in zip(inputs, segments)]
+    cfier = train_classifier(inputs[0], labels[0], classifier_type,
+                             random_state)
+    return (cfier, test_classifier(cfier, inputs[0], labels[0]),
+            test_classifier(cfier, inputs[1], labels[1]))
+  finally:
+    del inputs  # Views must go before their shared memory blocks can close.
+    for block in blocks: block.close()
+
+
+def load_classifiers(path):
+  """Load classifiers saved by this program from `path` (see `model_store`)."""
+  classifiers, metadata = model_store.load(
+      path, model_store.unpickle_classifier)
+  if metadata.get('program') != _PROGRAM: raise ValueError(
+      '{} holds classifiers for {}, not {}.'.format(
+          path, metadata.get('program'), _PROGRAM))
+  return classifiers, metadata
+
+
+def _training_source():
+  """Source code of the functions that train classifiers, for fingerprints."""
+  return [inspect.getsource(f) for f in (
+      train_classifiers, train_classifier, make_classifier,
+      train_shared_classifier,
+      _digit_seed, train_classifiers_in_parallel, _train_and_test_digit,
+      multi_digit_classifier.MultiDigitClassifier,
+      template_classifier.TemplateClassifier)]
+
+
+# Model versions recorded in output label databases are this many characters
+# of the saved model's version (see `model_store`).
+_MODEL_VERSION_LENGTH = 12
+
+# Identifies classifiers saved by this program.
+_PROGRAM = 'labels_classification'
+
+
 def test_classifier(classifier, inputs, labels):
   """Compute mean subset accuracy for a classifier.
 
   Args:
-    classifier: A scikit-learn classifier.
+    classifier: A scikit-learn classifier, a `MultiDigitClassifier`, or a
+        `TemplateClassifier`.
     inputs: a Kx464 array of linearised input images.
-    labels: a K-vector of integer labels.
+    labels: a K-vector of integer labels, or a Kx4 array for a
+        `MultiDigitClassifier` or `TemplateClassifier`.
 
   Returns:
     A scalar mean accuracy score.
@@ -173,44 +583,248 @@ def test_classifier(classifier, inputs, labels):
   return classifier.score(inputs, labels)
 
 
-def classify_everything(db_in, db_out, classifiers, do_masking):
+def classify_everything(db_in, db_out, classifiers, do_masking,
+                        segmenter='dp', image_cache_dir=None,
+                        batch_size=4096, decode_threads=4,
+                        decode_queue_depth=4, write_queue_depth=4,
+                        model_version=None, full=True,
+                        probabilities_path=None, deduplicate_bits=None):
   """Apply classifiers to every word image.
 
+  Images are loaded, classified in batches of `batch_size`, and labeled in a
+  pipeline; see `classify_pipeline` for details.
+
+  If `model_version` is given, each label is recorded in `db_out` with a
+  fingerprint of the model version and the image's pixels. Unless `full` is
+  set, images whose fingerprints match those recorded with their labels
+  already keep their labels without being classified again.
+
+  If `probabilities_path` is given, the classifiers' per-digit probabilities
+  for all images are saved there; see `probability_store`. Images that keep
+  their labels keep their saved probabilities, too, but if there are no saved
+  probabilities for the same list of images from classifiers with the same
+  `model_version`, all images are classified.
+
+  If `deduplicate_bits` is given, only one image from each group of images
+  with the same pixels is classified, and the whole group gets its label and
+  probabilities. Pixels are compared on their `deduplicate_bits` most
+  significant bits, so values below 8 also group images that differ slightly.
+
   Args:
     db_in: Label database object listing all of the files in the dataset.
     db_out: Label database object receiving classifier-derived labels.
-    classifiers: List of 16-class classifiers, one for each digit.
+    classifiers: List of 16-class classifiers, one for each digit, or a list
+        holding just one `MultiDigitClassifier` or `TemplateClassifier`.
     do_masking: Whether to mask digits during classification.
+    segmenter: Which `digit_masking` segmenter locates digits for masking.
+    image_cache_dir: Directory for caching decoded images (see `image_cache`).
+    batch_size: Number of images to classify at once.
+    decode_threads: Number of threads loading images.
+    decode_queue_depth: Number of batches that may be loaded ahead of the
+        classifiers.
+    write_queue_depth: Number of batches of labels that may wait to be written.
+    model_version: Optional string identifying the classifiers, e.g. their
+        `model_store` version.
+    full: Whether to classify all images even if they're unchanged.
+    probabilities_path: Optional .npy file for saving probabilities.
+    deduplicate_bits: Optional number of bits (1-8) of each pixel to compare
+        when grouping duplicate images. If None, images aren't deduplicated.
   """
-  label = 'XXXX'  # Early first value for progress indicator.
   all_images = [fn for fn, _ in db_in.all_labels_with_counts_of_at_least(0)]
-  for i, fn in enumerate(all_images):
-    # Display percentage progress indicator.
-    sys.stdout.write('   {}% '.format(round(100 * i / len(all_images))))
-    sys.stdout.write('{} '.format(label))  # This display should look cool :-)
-    sys.stdout.flush()
-
-    # Load the image and classify its digits. Commit the label.
-    original_image = (
-        skimage.color.rgb2gray(skimage.io.imread(fn)).astype(np.float32))
+
+  probabilities = None
+  if probabilities_path:
+    probabilities, reusable = probability_store.open_for_writing(
+        probabilities_path, all_images, model_version=model_version)
+    if not reusable: full = True
+
+  # Images are loaded from a memory map if there's an image cache, and from
+  # memory if they're all needed at once for deduplication; otherwise, they're
+  # decoded by the pipeline's decode threads.
+  all_decoded = None
+  all_segments = None
+  if image_cache_dir or deduplicate_bits:
+    print('   ...loading images...')
+    all_decoded = image_cache.load_images(all_images, image_cache_dir)
+    image_shape = all_decoded.shape[1:]
     if do_masking:
-      original_masked = np.zeros_like(original_image)
-      # A flattened view with a "batch dimension" for the classifier.
-      masked = original_masked.ravel()[np.newaxis, ...]
-      label = ''
-      for i, cfier in enumerate(classifiers):
-        mask_nth_digit_in_image(original_image, i, out=original_masked)
-        label += '0123456789ABCDEF'[cfier.predict(masked)[0]]
+      print('   ...segmenting images...')
+      all_segments = digit_masking.load_segmentation(
+          all_images, all_decoded, image_cache_dir, segmenter)
+  else:
+    image_shape = image_cache.decode_image(all_images[0]).shape
+
+  # Images to classify, as indices into all_images. With deduplication, only
+  # the first of each group of images with the same pixels is classified, and
+  # its label goes to every image in the group; `groups[i]` lists the group of
+  # `to_classify[i]`. Hashes stand in for pixels: with 64 bits, collisions
+  # among a million images are vanishingly unlikely.
+  all_hashes = None
+  groups = None
+  if deduplicate_bits:
+    print('   ...finding duplicate images...')
+    all_hashes = image_cache.content_hashes(all_decoded)
+    to_classify, groups = image_cache.find_duplicates(
+        all_hashes if deduplicate_bits >= 8 else
+        image_cache.content_hashes(all_decoded, bits=deduplicate_bits))
+    print('   ...{} distinct images among {}.'.format(
+        len(to_classify), len(all_images)))
+    def load(start, end, out):
+      np.take(all_decoded, to_classify[start:end], axis=0, out=out)
+  else:
+    to_classify = np.arange(len(all_images))
+    if all_decoded is not None:
+      def load(start, end, out):
+        np.copyto(out, all_decoded[start:end])
     else:
-      # A flattened view with a "batch dimension" for the classifier.
-      image = original_image.ravel()[np.newaxis, ...]
-      label = ''.join('0123456789ABCDEF'[cfier.predict(image)[0]]
-                      for cfier in classifiers)
-    db_out.force(fn, label, 2)
+      def load(start, end, out):
+        image_cache.decode_images(
+            all_images[start:end], out, show_progress=False)
+
+  # Image hashes for batches awaiting the writer, keyed by the batch's start,
+  # and the number of images that kept their old labels.
+  batch_hashes = {}
+  num_unchanged = 0
+
+  def write(start, end, labels):
+    hashes = batch_hashes.pop(start, None)
+    for i, label in enumerate(labels):
+      for index in ([to_classify[start + i]] if groups is None else
+                    groups[start + i]):
+        fp = None
+        if model_version:
+          h = hashes[i] if all_hashes is None else all_hashes[index]
+          fp = '{}:{:016x}'.format(model_version, h)
+        db_out.force(all_images[index], label, 2, fp)
+
+  # Classify images, masking with saved segmentations if we have them, but
+  # skipping images whose labels came from the same pixels and model.
+  def predict(start, end, images):
+    nonlocal num_unchanged
+    indices = to_classify[start:end]
+    labels = [None] * len(indices)
+    if model_version:
+      hashes = (image_cache.content_hashes(images) if all_hashes is None else
+                all_hashes[indices])
+      batch_hashes[start] = hashes
+      if not full:
+        for i, (index, h) in enumerate(zip(indices, hashes)):
+          fn = all_images[index]
+          if db_out.fingerprint(fn) == '{}:{:016x}'.format(model_version, h):
+            labels[i] = db_out[fn][0]
+    changed = [i for i, label in enumerate(labels) if label is None]
+    num_unchanged += len(labels) - len(changed)
+
+    if changed:
+      if len(changed) < len(labels): images = images[changed]
+      if all_segments is not None:
+        segments = all_segments[indices[changed]]
+      elif do_masking:
+        segments = digit_masking.segment(images, segmenter)
+      else:
+        segments = None
+      new_probabilities = classify_probabilities(
+          classifiers, do_masking, images, segments)
+      if probabilities is not None:
+        probabilities[indices[changed]] = new_probabilities
+      new_labels = labels_from_probabilities(new_probabilities)
+      for i, label in zip(changed, new_labels): labels[i] = label
+
+    # Duplicates share their group's probabilities.
+    if probabilities is not None and groups is not None:
+      for i, index in enumerate(indices):
+        if len(groups[start + i]) > 1:
+          probabilities[groups[start + i]] = probabilities[index]
+    return labels
+
+  counters = classify_pipeline.classify(
+      [all_images[i] for i in to_classify], image_shape, load, predict, write,
+      batch_size, decode_threads, decode_queue_depth, write_queue_depth)
+  for c in counters: print(c)
+  if num_unchanged:
+    print('   ...kept labels for {} unchanged images.'.format(num_unchanged))
+  if probabilities is not None:
+    probabilities.flush()
+    print('   ...saved probabilities to {}.'.format(probabilities_path))
+
+
+def classify_images(classifiers, do_masking, images, segments=None):
+  """Apply classifiers to a batch of word images.
 
-    # Clear away progress indicator.
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
+  Args:
+    classifiers: List of 16-class classifiers, one for each digit, or a list
+        holding just one `MultiDigitClassifier` or `TemplateClassifier`.
+    do_masking: Whether to mask digits during classification.
+    images: KxRxC uint8 array of word images.
+    segments: Optional Kx4 array of digit boundaries for masking the images
+        (see `digit_masking.segment`). If None, boundaries are computed.
+
+  Returns:
+    A list of K labels: strings of four hex digits.
+  """
+  return labels_from_probabilities(
+      classify_probabilities(classifiers, do_masking, images, segments))
+
+
+def classify_probabilities(classifiers, do_masking, images, segments=None):
+  """Compute per-digit class probabilities for a batch of word images.
+
+  Args are the same as for `classify_images`.
+
+  Returns:
+    A Kx4x16 float32 array: the probability of each value of each digit.
+  """
+  images = images.astype(np.float32)
+  images = images.reshape((images.shape[0], -1))  # Linearised images.
+  masked = mask_digits_in_images(images, segments) if do_masking else None
+  probabilities = []
+  for n, cfier in enumerate(classifiers):
+    inputs = masked[n] if do_masking else images
+    probabilities.append(digit_probabilities(cfier, inputs))
+  return np.concatenate(probabilities, axis=1)
+
+
+def digit_probabilities(classifier, inputs):
+  """Class probabilities from a classifier for one or all digits.
+
+  Args:
+    classifier: A scikit-learn classifier for one digit, a
+        `MultiDigitClassifier`, a `TemplateClassifier`, or a convnet loaded by
+        `keras_numpy`.
+    inputs: a Kx464 array of linearised input images.
+
+  Returns:
+    A KxDx16 array of probabilities: D is 1 for a single-digit classifier, 4
+    for a `MultiDigitClassifier` or `TemplateClassifier`, and the number of
+    outputs for a convnet. Classifiers that don't estimate probabilities
+    (like `LinearSVC`) get the softmax of their decision function instead.
+  """
+  if isinstance(classifier, (multi_digit_classifier.MultiDigitClassifier,
+                             template_classifier.TemplateClassifier,
+                             keras_numpy.NumpyModel)):
+    return classifier.predict_proba(inputs)
+
+  if hasattr(classifier, 'predict_proba'):
+    scores = classifier.predict_proba(inputs)
+  else:
+    scores = classifier.decision_function(inputs)
+    if scores.ndim == 1: scores = np.stack([-scores, scores], axis=1)
+    scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    scores /= scores.sum(axis=1, keepdims=True)
+
+  # Classes missing from the training data get no probability.
+  probabilities = np.zeros((len(inputs), 1, 16), dtype=np.float32)
+  probabilities[:, 0, classifier.classes_] = scores
+  return probabilities
+
+
+def labels_from_probabilities(probabilities):
+  """Convert a Kx4x16 array of probabilities to a list of K labels."""
+  return [''.join(l) for l in _HEX_DIGITS[np.argmax(probabilities, axis=2)]]
+
+
+# Hex digit characters, indexed by their values.
+_HEX_DIGITS = np.array(list('0123456789ABCDEF'))
 
 
 #### IMAGE PROCESSING ####
@@ -218,138 +832,107 @@ def classify_everything(db_in, db_out, classifiers, do_masking):
 
 def mask_nth_digit_in_image(image, n, out=None):
   """Return a copy of `image` with all but the `n`th digit masked."""
-  # If we sum the image vertically, a plot of the column sums will present
-  # four humps, each corresponding to a digit. This masking routine detects
-  # the humps and masks the image so only the pixels contributing to the n'th
-  # hump are visible.
-  colsum = np.sum(image, axis=0)
-
-  # # Now we need to find the least t such that image > t obtains four separate
-  # # contiguous 'True' regions. We'll scan up from t = 0...
-  # thresholded = colsum > 0                   # These two lines are just for
-  # labels = sp.ndimage.label(thresholded)[0]  # memory allocation.
-
-  # for t in range(int(max(colsum))):
-  #   np.greater(colsum, t, out=thresholded)
-  #   if sp.ndimage.label(thresholded, output=labels) == 4: break
-  # else:
-  #   raise RuntimeError('mask_nth_digit could not find four distinct digits '
-  #                      'in an image.')
-
-  # # We can now mask off the columns not containing the n'th digit.
-  # if out is None:
-  #   out = image.copy()
-  # else:
-  #   np.copyto(out, image)
-  # out[:, labels != (n + 1)] = 0
-  # return out
-
-  colsum[:7] = 1000
-  colsum[9:13] = 1000
-  colsum[16:19] = 1000
-  colsum[23:] = 1000
-  # The columns containing the four digits are separated by the three smallest
-  # minima of colsum not at the edges of the image.
-  left_less = colsum[:-1] < colsum[1:]
-  # True entries in this array are 4 pixels left of all local minima in colsum.
-  # This 4-offset allows us to ignore pixels at the edges of the image.
-  minima_mask = left_less[4:-3] & ~left_less[3:-4]
-  # So these are the minima's indices:
-  minima_inds = np.argwhere(minima_mask).ravel() + 4
-  # Find which three indices are associated with the smallest minima.
-  boundaries = np.sort(minima_inds[np.argsort(colsum[minima_inds])[:3]])
-
-  # Perform the masking now.
-  if out is None:
-    out = image.copy()
-  elif out is not image:
-    np.copyto(out, image)
-
-  if n > 0: out[:, :(boundaries[n-1])] = 0
-  if n < 3: out[:, (boundaries[n]+1):] = 0
+  masked = digit_masking.mask_all_digits(image[np.newaxis, ...])[n][0]
+  if out is None: return masked
+  np.copyto(out, masked)
   return out
 
 
-def mask_nth_digit_in_images(images, n):
-  """Return a copy of `images` with all but the `n`th digit masked.
+def mask_digits_in_images(images, segments=None):
+  """Return four copies of `images`, each with all but one digit masked.
 
   Args:
     images: a Kx464 array of linearised input images.
-    n: which digit to show through the mask.
+    segments: optional Kx4 array of digit boundaries for the images, as from
+        `digit_masking.segment`. If None, boundaries are computed.
 
   Returns:
-    A version of `images` masked as described.
+    A list of four versions of `images`, each showing only one digit through
+    the mask. See `digit_masking` for details.
   """
-  masked = images.copy()
-  num_images = masked.shape[0]
-  for i in range(num_images):
-    sys.stdout.write('   {}% '.format(round(100 * i / num_images)))
-    sys.stdout.flush()
-    ith_image_reshaped = masked[i].reshape((16, 29))
-    mask_nth_digit_in_image(ith_image_reshaped, n, out=ith_image_reshaped)
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
-
-  return masked
+  masked = digit_masking.mask_all_digits(
+      images.reshape((-1, 16, 29)), segments)
+  return [m.reshape(images.shape) for m in masked]
 
 
 #### DATA SHUFFLING ####
 
 
 class Data(collections.namedtuple(
-    'Data', ['images', 'labels_1', 'labels_2', 'labels_3', 'labels_4'])):
-  """A data container for images and their per-digit labels."""
+    'Data', ['images', 'labels_1', 'labels_2', 'labels_3', 'labels_4',
+             'segments'])):
+  """A data container for images, their per-digit labels and segmentations."""
 
   def __len__(self):
     return len(self.images)
 
   def num_digits(self):
-    return len(self._fields) - 1
+    return sum(f.startswith('labels_') for f in self._fields)
+
+  def all_labels(self):
+    """A KxD array of the labels for all D digits."""
+    return np.stack(self[1:self.num_digits() + 1], axis=1)
 
 
-def load_data(db, minimum_label_count, max_0000):
+def load_data(db, minimum_label_count, max_0000, image_cache_dir=None,
+              segmenter=None):
   """Load labeled images and create classifier training inputs.
 
   Args:
     db: Label database object.
     minimum_label_count: Do not use labels with a count less than this value.
     max_0000: Load no more than this many examples of "0000" labels.
+    image_cache_dir: Directory for caching decoded images (see `image_cache`).
+    segmenter: Which `digit_masking` segmenter locates digit boundaries, or
+        None to skip segmenting the images (e.g. when they won't be masked).
 
   Returns:
-    A 5-tuple with the following elements:
+    A 6-tuple with the following elements:
     [0]: A Kx464 array of linearised images, where K is the number of files
          in the database with a label count exceeding `minimum_label_count`.
     [1]: A K-vector of integer labels in [0, 15] for the first digit.
     [2]: A K-vector of integer labels in [0, 15] for the second digit.
     [3]: A K-vector of integer labels in [0, 15] for the third digit.
     [4]: A K-vector of integer labels in [0, 15] for the fourth digit.
+    [5]: A Kx4 uint8 array of digit boundaries and ambiguity flags for each
+         image (see `digit_masking.segment`), or None if `segmenter` is None.
+  """
+  filenames, labels = select_labeled(db, minimum_label_count, max_0000)
+  images = image_cache.load_images(filenames, image_cache_dir)
+  segments = None if segmenter is None else digit_masking.load_segmentation(
+      filenames, images, image_cache_dir, segmenter)
+  images = images.reshape((len(filenames), -1)).astype(np.float32)
+  return Data(*[images, *(np.int32(l) for l in zip(*labels)), segments])
+
+
+def select_labeled(db, minimum_label_count, max_0000):
+  """Choose labeled images for training and testing classifiers.
+
+  Args:
+    db: Label database object.
+    minimum_label_count: Do not use labels with a count less than this value.
+    max_0000: Choose no more than this many examples of "0000" labels.
+
+  Returns:
+    A 2-tuple: a list of K image filenames, and a list of K 4-tuples of their
+    integer per-digit labels in [0, 15].
   """
-  images = []
+  filenames = []
   labels = []
   num_0000 = 0
 
   # Note filtering for minimum label count...
   worthy_labels = db.all_labels_with_counts_of_at_least(minimum_label_count)
 
-  for i, (fn, label) in enumerate(worthy_labels):
-    # Display percentage progress indicator.
-    sys.stdout.write('   {}% '.format(round(100 * i / len(worthy_labels))))
-    sys.stdout.flush()
-
+  for fn, label in worthy_labels:
     # Process label if it is of interest.
     if label != '0000' or num_0000 < max_0000:
       if all(d in '0123456789ABCDEF' for d in label):
-        image = skimage.io.imread(fn)
-        image = skimage.color.rgb2gray(image).astype(np.float32).ravel()
-        images.append(image)
+        filenames.append(fn)
         labels.append(tuple('0123456789ABCDEF'.find(d) for d in label))
         if label == '0000': num_0000 += 1
 
-    # Clear away progress indicator.
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
-
-  return Data(*[np.stack(images, axis=0), *(np.int32(l) for l in zip(*labels))])
+  return filenames, labels
 
 
 def divide_data(data, train_data_fraction):
@@ -358,11 +941,12 @@ def divide_data(data, train_data_fraction):
   # Create shuffled dataset.
   inds = np.arange(len(data))
   np.random.shuffle(inds)
-  data = Data(*[d[inds] for d in data])
+  data = Data(*[d if d is None else d[inds] for d in data])
 
   # Split it into training and test data.
   split = round(len(data) * train_data_fraction)
-  return Data(*[d[:split] for d in data]), Data(*[d[split:] for d in data])
+  return (Data(*[d if d is None else d[:split] for d in data]),
+          Data(*[d if d is None else d[split:] for d in data]))
 
 
 #### MISCELLANEOUS ####
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+"""Classify digits in word images with an ensemble of classifiers.
+
+`assemble_labels.py` gathers votes from many classified label databases, like
+`database_classified_44.csv` through `database_classified_71.csv`. Running
+`labels_classification.py` once for each of those reloads every image and
+redivides the data every time. This program instead loads the images once and
+trains an ensemble of "members": each member divides the labeled images into
+training and test data with its own random seed, trains its own per-digit
+classifiers, classifies all of the word images, and writes its labels to its
+own output label database. Members are trained and run in parallel.
+
+Members can differ in the kind of classifier they train, too: the types listed
+by --classifier-types are assigned to members in turn. "template" members train
+one classifier for all digits and never mask digits.
+
+All images are placed in shared memory once, so worker processes don't need
+copies of their own.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing.shared_memory
+import numpy as np
+import os
+import pathlib
+
+import digit_masking
+import image_cache
+import label_database
+import labels_classification
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Classify digits in word images with many classifiers.')
+
+  flags.add_argument('input_label_database', type=str,
+                     help=('CSV file containing image paths, labels, and '
+                           'the number of times a particular label was '
+                           'supplied for an image. The CSV header should be '
+                           '"Filename,Label,Count". Labels in this file will '
+                           'serve as training data for the classifiers.'))
+
+  flags.add_argument('output_label_databases', type=str,
+                     help=('Pattern for the CSV files receiving image content '
+                           'labels from each member of the ensemble: "{}" is '
+                           'replaced by the member number, as in '
+                           '"database_classified_{}.csv". (Files need not '
+                           'exist already.)'))
+
+  flags.add_argument('--members', default=8, type=int,
+                     help='Number of members in the ensemble.')
+
+  flags.add_argument('--first-member', default=0, type=int,
+                     help=('Number of the first member; subsequent members '
+                           'are numbered consecutively.'))
+
+  flags.add_argument('--classifier-types', default='mlp', type=str,
+                     help=('Comma-separated list of the kinds of classifiers '
+                           'to train, assigned to members in turn. Choose '
+                           'from: {}.'.format(', '.join(
+                               labels_classification.CLASSIFIER_TYPES))))
+
+  flags.add_argument('--seed', default=0, type=int,
+                     help=('Random seed for the first member; subsequent '
+                           'members use subsequent seeds.'))
+
+  flags.add_argument('--processes', default=os.cpu_count(), type=int,
+                     help='Number of members to train and run at once.')
+
+  flags.add_argument('--minimum-label-count', default=2, type=int,
+                     help=('Only use image labels with at least this many '
+                           'counts as training data.'))
+
+  flags.add_argument('--max-0000', default=200, type=int,
+                     help=('Load no more than this many "0000" images from the '
+                           'labeled data.'))
+
+  flags.add_argument('--train-data-fraction', default=0.8, type=float,
+                     help=('Fraction of the labels in input_label_database '
+                           'to use as training data. (The remainder will be '
+                           'used as test data.)'))
+
+  flags.add_argument('--mask-digits', default=False, type=bool,
+                     help=('Mask individual digits in the images when they '
+                           'are presented to or used to train classifiers for '
+                           'those digits.'))
+
+  flags.add_argument('--segmenter', default='dp',
+                     choices=digit_masking.SEGMENTERS,
+                     help='How to find the boundaries between digits.')
+
+  flags.add_argument('--skip-ambiguous-segmentation', action='store_true',
+                     help=('When masking digits, leave word images out of the '
+                           'training and test data if the boundaries between '
+                           'their digits are doubtful.'))
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  flags.add_argument('--classification-batch-size', default=4096, type=int,
+                     help=('Classify this many word images at a time when '
+                           'labeling all of the word images.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  if '{}' not in FLAGS.output_label_databases: raise ValueError(
+      'The output label database pattern must contain "{}".')
+  if FLAGS.input_label_database in output_databases(FLAGS): raise ValueError(
+      "Input and output label databases can't be the same file.")
+  classifier_types = FLAGS.classifier_types.split(',')
+  for t in classifier_types:
+    if t not in labels_classification.CLASSIFIER_TYPES: raise ValueError(
+        'Unknown classifier type "{}".'.format(t))
+
+  # Find all images and the labeled images among them.
+  print('Opening input label database...')
+  with label_database.Database(
+      FLAGS.input_label_database, readonly=True) as db_in:
+    all_images = [fn for fn, _ in db_in.all_labels_with_counts_of_at_least(0)]
+    labeled_images, labels = labels_classification.select_labeled(
+        db_in, FLAGS.minimum_label_count, FLAGS.max_0000)
+  indices = {fn: i for i, fn in enumerate(all_images)}
+  labeled = np.array([indices[fn] for fn in labeled_images], dtype=np.intp)
+  labels = np.array(labels, dtype=np.int32).reshape((-1, 4))
+
+  # Load all of the images.
+  print('Loading images...')
+  images = image_cache.load_images(all_images, FLAGS.image_cache_dir)
+  segments = None
+  if FLAGS.mask_digits:
+    print('   ...segmenting images...')
+    segments = digit_masking.load_segmentation(
+        all_images, images, FLAGS.image_cache_dir, FLAGS.segmenter)
+
+    # Leave out images that may be masked badly, if desired.
+    if FLAGS.skip_ambiguous_segmentation:
+      unambiguous = segments[labeled, 3] == 0
+      print('   ...leaving out', np.sum(~unambiguous), 'images with '
+            'ambiguous digit boundaries.')
+      labeled, labels = labeled[unambiguous], labels[unambiguous]
+  print('   ...loaded', len(all_images), 'images,', len(labeled), 'labeled.')
+
+  # Describe the members of the ensemble.
+  members = [
+      Member(number=FLAGS.first_member + i,
+             classifier_type=classifier_types[i % len(classifier_types)],
+             seed=FLAGS.seed + i,
+             output_label_database=output_databases(FLAGS)[i])
+      for i in range(FLAGS.members)]
+
+  # Copy images into shared memory, then train and run all the members.
+  block = multiprocessing.shared_memory.SharedMemory(
+      create=True, size=max(1, images.nbytes))
+  try:
+    np.copyto(np.ndarray(images.shape, np.uint8, block.buf), images)
+    common = dict(
+        images=(block.name, images.shape), all_images=all_images,
+        labeled=labeled, labels=labels, segments=segments,
+        train_data_fraction=FLAGS.train_data_fraction,
+        batch_size=FLAGS.classification_batch_size)
+    print('Training and running {} members in {} processes...'.format(
+        len(members), FLAGS.processes))
+    with concurrent.futures.ProcessPoolExecutor(
+        FLAGS.processes, initializer=_init_worker,
+        initargs=(common,)) as executor:
+      futures = {executor.submit(run_member, m): m for m in members}
+      for future in concurrent.futures.as_completed(futures):
+        member = futures[future]
+        train_accuracies, test_accuracies = future.result()
+        print('Member {} ({}, seed {}) wrote {}'.format(
+            member.number, member.classifier_type, member.seed,
+            member.output_label_database))
+        print('        Training set accuracy:', *train_accuracies)
+        print('            Test set accuracy:', *test_accuracies)
+
+  finally:
+    block.close()
+    block.unlink()
+
+  # All done!
+  print('Done.')
+
+
+def output_databases(FLAGS):
+  """Output label database filenames for each member of the ensemble."""
+  return [FLAGS.output_label_databases.format(FLAGS.first_member + i)
+          for i in range(FLAGS.members)]
+
+
+#### ENSEMBLE MEMBERS ####
+
+
+class Member(object):
+  """Settings for one member of the ensemble."""
+
+  def __init__(self, number, classifier_type, seed, output_label_database):
+    self.number = number
+    self.classifier_type = classifier_type
+    self.seed = seed
+    self.output_label_database = output_label_database
+
+
+# Data shared by all members, set in each worker process by `_init_worker`.
+_COMMON = None
+
+
+def _init_worker(common):
+  """Receive data shared by all members in a worker process."""
+  global _COMMON
+  _COMMON = common
+
+
+def run_member(member):
+  """Train a member's classifiers, then classify all images with them.
+
+  Runs in a worker process. Training data and labels come from `_COMMON`.
+
+  Args:
+    member: `Member` to train and run.
+
+  Returns:
+    A 2-tuple: lists of the training set and test set accuracies of the
+    member's classifier for each digit.
+  """
+  name, shape = _COMMON['images']
+  block = multiprocessing.shared_memory.SharedMemory(name=name)
+  images = None
+  try:
+    images = np.ndarray(shape, np.uint8, block.buf)
+    segments = _COMMON['segments']
+    shared = member.classifier_type == 'template'
+    do_masking = segments is not None and not shared
+
+    # Divide labeled images into this member's training and test data.
+    labeled, labels = _COMMON['labeled'], _COMMON['labels']
+    order = np.random.RandomState(member.seed).permutation(len(labeled))
+    split = round(len(labeled) * _COMMON['train_data_fraction'])
+    parts = [order[:split], order[split:]]
+    inputs = [images[labeled[p]].reshape((len(p), -1)).astype(np.float32)
+              for p in parts]
+    if do_masking:
+      inputs = [labels_classification.mask_digits_in_images(
+          i, segments[labeled[p]]) for i, p in zip(inputs, parts)]
+    else:
+      inputs = [[i] * labels.shape[1] for i in inputs]
+
+    # Train classifiers: one for all digits...
+    classifiers = []
+    accuracies = [[], []]
+    if shared:
+      cfier = labels_classification.train_shared_classifier(
+          inputs[0][0], labels[parts[0]], member.classifier_type,
+          random_state=member.seed)
+      for a, i, p in zip(accuracies, inputs, parts):
+        a.extend(np.mean(cfier.predict(i[0]) == labels[p], axis=0))
+      classifiers.append(cfier)
+    else:
+      # ...or one for each digit.
+      for d in range(labels.shape[1]):
+        cfier = labels_classification.train_classifier(
+            inputs[0][d], labels[parts[0], d], member.classifier_type,
+            random_state=member.seed)
+        for a, i, p in zip(accuracies, inputs, parts):
+          a.append(labels_classification.test_classifier(
+              cfier, i[d], labels[p, d]))
+        classifiers.append(cfier)
+    del inputs
+
+    # Classify all of the images.
+    all_images = _COMMON['all_images']
+    if not pathlib.Path(member.output_label_database).exists():
+      with open(member.output_label_database, 'w') as f:
+        f.write('"Filename","Label","Count"\n')
+    with label_database.Database(
+        member.output_label_database, save_backups=False) as db_out:
+      batch_size = _COMMON['batch_size']
+      for start in range(0, len(all_images), batch_size):
+        end = min(start + batch_size, len(all_images))
+        batch_labels = labels_classification.classify_images(
+            classifiers, do_masking, images[start:end],
+            segments[start:end] if do_masking else None)
+        for fn, label in zip(all_images[start:end], batch_labels):
+          db_out.force(fn, label, 2)
+
+    return accuracies
+
+  finally:
+    del images  # Views must go before their shared memory block can close.
+    block.close()
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -3,7 +3,23 @@
 
 This program uses the training data to train four classifiers: one for each
 digit in a word image. It uses these classifiers to label the digits in all of
-the word images.
+the word images. Alternatively, with --shared-model, it trains one convnet with
+four outputs that labels all four digits at once.
+
+Training images are distorted a little at random (shifted, sheared, zoomed, and
+rotated) on every epoch, so that the convnets learn to tolerate small errors in
+word image cropping. Training stops early once loss on the test data stops
+improving, and the convnets keep the weights that did best. With
+--checkpoint-dir, training saves its progress after every epoch, and --resume
+carries on from there after an interruption.
+
+Saved convnets are also exported for `keras_numpy`, so that
+`labels_classification_numpy.py` can classify images with them without Keras.
+
+Convnets are slow, and most word images are easy. With --cascade-model, a
+cheaper model saved by `labels_classification.py` (an MLP, say, or a template
+classifier) labels every image first, and only images where it isn't sure of
+some digit go to the convnet.
 
 Licensing:
 
@@ -14,15 +30,15 @@ warranty. See the LICENSE file for details.
 
 import argparse
 import collections
+import csv
+import inspect
 import math
 import numpy as np
 import os
 import pathlib
 import scipy as sp
 import scipy.ndimage
-import skimage
-import skimage.io
-import sys
+import time
 
 for backend in ['theano', 'tensorflow']:
   os.environ['KERAS_BACKEND'] = backend
@@ -33,9 +49,22 @@ for backend in ['theano', 'tensorflow']:
     pass
 else:
   raise RuntimeError("Couldn't find a working backend for Keras.")
-import keras.preprocessing.image
 
+# TensorFlow gives training a tf.data input pipeline if it's available;
+# otherwise, training images are augmented with NumPy.
+try:
+  import tensorflow as tf
+except ModuleNotFoundError:
+  tf = None
+
+import classify_pipeline
+import digit_masking
+import image_cache
+import keras_numpy
 import label_database
+import labels_classification
+import model_store
+import probability_store
 
 
 def _define_flags():
@@ -73,6 +102,122 @@ def _define_flags():
                            'are presented to or used to train classifiers for '
                            'those digits.'))
 
+  flags.add_argument('--shared-model', action='store_true',
+                     help=('Train one classifier that labels all four digits '
+                           'at once instead of one classifier for each digit. '
+                           'Incompatible with --mask-digits.'))
+
+  flags.add_argument('--segmenter', default='dp',
+                     choices=digit_masking.SEGMENTERS,
+                     help=('How to find the boundaries between digits when '
+                           'masking: "dp" chooses the best split into four '
+                           'digits of plausible widths; "minima" takes the '
+                           'three smallest minima of the column sums.'))
+
+  flags.add_argument('--skip-ambiguous-segmentation', action='store_true',
+                     help=('When masking digits, leave word images out of the '
+                           'training and test data if the boundaries between '
+                           'their digits are doubtful.'))
+
+  flags.add_argument('--seed', type=int,
+                     help=('Seed for the random division of labeled images '
+                           'into training and test data, and for training. '
+                           'Without a seed, training is not repeatable, so '
+                           'saved classifiers are never reused in place of '
+                           'training new ones.'))
+
+  flags.add_argument('--epochs', default=130, type=int,
+                     help='Train each convnet for at most this many epochs.')
+
+  flags.add_argument('--patience', default=10, type=int,
+                     help=('Stop training a convnet after this many epochs '
+                           'without improvement in loss on the test data.'))
+
+  flags.add_argument('--checkpoint-dir', type=str,
+                     help=('Save the latest and best weights of each convnet '
+                           'in this directory after every epoch of '
+                           'training.'))
+
+  flags.add_argument('--resume', action='store_true',
+                     help=('Resume interrupted training from the checkpoints '
+                           'in --checkpoint-dir, if they were made with the '
+                           'same training data and settings.'))
+
+  flags.add_argument('--model-dir', default='models', type=str,
+                     help=('Save trained classifiers in this directory, and '
+                           'reuse saved classifiers instead of training new '
+                           'ones when the training data and settings, '
+                           'including --seed, are the same. An empty value '
+                           'disables saving.'))
+
+  flags.add_argument('--retrain', action='store_true',
+                     help=('Train new classifiers even if matching saved '
+                           'classifiers exist.'))
+
+  flags.add_argument('--load-model', type=str,
+                     help=('Skip training and classify images with the '
+                           'classifiers saved in this directory.'))
+
+  flags.add_argument('--classify-only', action='store_true',
+                     help=('Skip training and classify images with the '
+                           'classifiers saved most recently in --model-dir.'))
+
+  flags.add_argument('--full', action='store_true',
+                     help=('Classify all word images, even those whose '
+                           'labels in output_label_database came from the '
+                           'same classifiers and unchanged images.'))
+
+  flags.add_argument('--probabilities', type=str,
+                     help=('Save the probabilities that the classifiers '
+                           'assign to each value of each digit of every word '
+                           'image in this .npy file (see probability_store).'))
+
+  flags.add_argument('--deduplicate', action='store_true',
+                     help=('Classify only one of each group of word images '
+                           'with identical pixels, giving its label to the '
+                           'whole group.'))
+
+  flags.add_argument('--deduplicate-bits', default=8, type=int,
+                     choices=range(1, 9), metavar='{1..8}',
+                     help=('With --deduplicate, compare only this many of the '
+                           'most significant bits of each pixel, so that '
+                           'images differing by faint noise count as '
+                           'duplicates.'))
+
+  flags.add_argument('--cascade-model', type=str,
+                     help=('Classify images first with the classifiers saved '
+                           'in this directory by labels_classification.py, '
+                           'and use the convnet only for images they are '
+                           'unsure of.'))
+
+  flags.add_argument('--cascade-margin', default=0.5, type=float,
+                     help=('With --cascade-model, send an image to the '
+                           'convnet if, for any digit, the two values the '
+                           'cheaper classifiers find likeliest differ in '
+                           'probability by less than this.'))
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  flags.add_argument('--classification-batch-size', default=4096, type=int,
+                     help=('Classify this many word images at a time when '
+                           'labeling all of the word images.'))
+
+  flags.add_argument('--decode-threads', default=4, type=int,
+                     help=('Number of threads loading word images while the '
+                           'classifiers label other word images.'))
+
+  flags.add_argument('--decode-queue-depth', default=4, type=int,
+                     help=('Load at most this many batches of word images '
+                           'ahead of the classifiers. Memory used by loaded '
+                           'images is capped at this many batches.'))
+
+  flags.add_argument('--write-queue-depth', default=4, type=int,
+                     help=('Allow at most this many batches of labels to wait '
+                           'to be written to the output label database.'))
+
   return flags
 
 
@@ -84,6 +229,10 @@ def main(FLAGS):
     raise ValueError("Input and output label databases can't be the same file.")
   if FLAGS.minimum_label_count < 1: raise ValueError(
       'The value of --minimum-label-count must be greater than 2.')
+  if FLAGS.shared_model and FLAGS.mask_digits: raise ValueError(
+      "--shared-model and --mask-digits can't be used together.")
+  if FLAGS.resume and not FLAGS.checkpoint_dir: raise ValueError(
+      '--resume needs --checkpoint-dir.')
 
   # Create new output label database if it doesn't exist yet.
   if not pathlib.Path(FLAGS.output_label_database).exists():
@@ -98,37 +247,89 @@ def main(FLAGS):
     with label_database.Database(
         FLAGS.output_label_database, save_backups=False) as db_out:
 
-      # Load labeled images and per-digit labels.
-      print('Loading labeled images; arranging test/train data...')
-      all_data = load_data(db_in, FLAGS.minimum_label_count, FLAGS.max_0000)
-
-      # Divide into training and test data.
-      train_data, test_data = divide_data(all_data, FLAGS.train_data_fraction)
-      print('   ...loaded', len(train_data), 'data points for training,',
-            len(test_data), 'for testing.')
-
-      # Train classifiers.
-      classifiers = []
-      for d in range(1, train_data.num_digits() + 1):
-        images_train = train_data.images
-        images_test = test_data.images
-        if FLAGS.mask_digits:
-          print('Preprocessing data for digit {}...'.format(d))
-          images_train = mask_nth_digit_in_images(images_train, d - 1)
-          images_test = mask_nth_digit_in_images(images_test, d - 1)
-
-        print('Training classifier for digit {}...'.format(d))
-        cfier = train_classifier(images_train, train_data[d],
-                                 images_test, test_data[d])
-        print('        Training set accuracy:',
-              test_classifier(cfier, images_train, train_data[d]))
-        print('            Test set accuracy:',
-              test_classifier(cfier, images_test, test_data[d]))
-        classifiers.append(cfier)
+      if FLAGS.load_model or FLAGS.classify_only:
+        # Use previously trained classifiers if directed...
+        path = FLAGS.load_model or model_store.latest(
+            FLAGS.model_dir, program=_PROGRAM)
+        print('Loading classifiers from {}...'.format(path))
+        classifiers, metadata = load_classifiers(path)
+
+      else:
+        # ...otherwise, load labeled images and per-digit labels.
+        print('Loading labeled images; arranging test/train data...')
+        all_data = load_data(
+            db_in, FLAGS.minimum_label_count, FLAGS.max_0000,
+            FLAGS.image_cache_dir,
+            FLAGS.segmenter if FLAGS.mask_digits else None)
+
+        # Leave out images that may be masked badly, if desired.
+        if FLAGS.mask_digits and FLAGS.skip_ambiguous_segmentation:
+          unambiguous = all_data.segments[:, 3] == 0
+          print('   ...leaving out', np.sum(~unambiguous), 'images with '
+                'ambiguous digit boundaries.')
+          all_data = Data(*[d[unambiguous] for d in all_data])
+
+        # Classifiers trained on the same data in the same way may be saved
+        # already. If so, and if we're allowed, we use them. Only seeded
+        # training is repeatable, so unseeded runs always train afresh.
+        metadata = dict(program=_PROGRAM, mask_digits=bool(FLAGS.mask_digits),
+                        segmenter=FLAGS.segmenter,
+                        shared_model=FLAGS.shared_model)
+        fp = model_store.fingerprint(
+            *all_data, metadata, FLAGS.train_data_fraction, FLAGS.seed,
+            FLAGS.epochs, FLAGS.patience, _training_source())
+        metadata['fingerprint'] = fp
+        path = model_store.model_path(FLAGS.model_dir, fp)
+        if (FLAGS.model_dir and FLAGS.seed is not None and path.exists() and
+            not FLAGS.retrain):
+          print('Loading saved classifiers from {}...'.format(path))
+          classifiers, metadata = load_classifiers(path)
+
+        else:
+          # Divide into training and test data.
+          if FLAGS.seed is not None: _set_seeds(FLAGS.seed)
+          train_data, test_data = divide_data(
+              all_data, FLAGS.train_data_fraction)
+          print('   ...loaded', len(train_data), 'data points for training,',
+                len(test_data), 'for testing.')
+
+          # Train and save classifiers. Checkpoints are kept apart for each
+          # fingerprint, so only matching training can resume from them.
+          classifiers = train_classifiers(
+              train_data, test_data, FLAGS.mask_digits, FLAGS.shared_model,
+              FLAGS.epochs, FLAGS.patience,
+              FLAGS.checkpoint_dir and pathlib.Path(FLAGS.checkpoint_dir) / fp,
+              FLAGS.resume)
+          if FLAGS.model_dir:
+            print('Saving classifiers to {}...'.format(path))
+            metadata = model_store.save(
+                path, classifiers, _save_classifier, metadata)
+
+      # Load cheaper classifiers for a cascade if desired. Labels then
+      # depend on the cascade, too. Classifiers that weren't saved have no
+      # version, so their labels can't be kept by later runs.
+      cascade = None
+      model_version = metadata.get('version')
+      if FLAGS.cascade_model:
+        print('Loading cascade classifiers from {}...'.format(
+            FLAGS.cascade_model))
+        cascade = Cascade(*labels_classification.load_classifiers(
+            FLAGS.cascade_model), FLAGS.cascade_margin)
+        if model_version: model_version = model_store.fingerprint(
+            model_version, cascade.metadata['version'], cascade.margin)
 
       # Now classify all of the data.
       print('Classifying all word images...')
-      classify_everything(db_in, db_out, classifiers, FLAGS.mask_digits)
+      classify_everything(db_in, db_out, classifiers, metadata['mask_digits'],
+                          metadata['segmenter'], FLAGS.image_cache_dir,
+                          FLAGS.classification_batch_size,
+                          FLAGS.decode_threads, FLAGS.decode_queue_depth,
+                          FLAGS.write_queue_depth,
+                          model_version and model_version[
+                              :_MODEL_VERSION_LENGTH],
+                          FLAGS.full, FLAGS.probabilities,
+                          FLAGS.deduplicate_bits if FLAGS.deduplicate else None,
+                          cascade)
 
       # All done!
       print('Saving output label database...')
@@ -137,7 +338,76 @@ def main(FLAGS):
 #### CLASSIFICATION ####
 
 
-def train_classifier(inputs, labels, test_inputs, test_labels):
+def train_classifiers(train_data, test_data, mask_digits, shared_model,
+                      epochs=130, patience=10, checkpoint_dir=None,
+                      resume=False):
+  """Train and test classifiers for all digits.
+
+  Args:
+    train_data: `Data` for training the classifiers.
+    test_data: `Data` for testing the classifiers.
+    mask_digits: Whether to mask digits in the images.
+    shared_model: Whether to train one classifier for all digits.
+    epochs: Train each classifier for at most this many epochs.
+    patience: Stop training a classifier after this many epochs without
+        improvement in loss on the test data.
+    checkpoint_dir: Optional directory for training checkpoints, in which
+        each classifier gets a subdirectory (see `fit_classifier`).
+    resume: Whether to resume training from checkpoints in `checkpoint_dir`.
+
+  Returns:
+    A list of 16-class classifiers, one for each digit, or a list holding just
+    one model from `train_shared_classifier`.
+  """
+  # Mask digits if desired.
+  if mask_digits:
+    print('Preprocessing data...')
+    masked_train = mask_digits_in_images(
+        train_data.images, train_data.segments)
+    masked_test = mask_digits_in_images(
+        test_data.images, test_data.segments)
+
+  # Train classifiers: either one for all digits...
+  classifiers = []
+  checkpoints = lambda name: (
+      pathlib.Path(checkpoint_dir) / name if checkpoint_dir else None)
+  if shared_model:
+    print('Training shared classifier for all digits...')
+    labels_train = list(train_data[1:train_data.num_digits() + 1])
+    labels_test = list(test_data[1:test_data.num_digits() + 1])
+    cfier = train_shared_classifier(train_data.images, labels_train,
+                                    test_data.images, labels_test, epochs,
+                                    patience, checkpoints('shared'), resume)
+    print('        Training set accuracy:', test_shared_classifier(
+        cfier, train_data.images, labels_train))
+    print('            Test set accuracy:', test_shared_classifier(
+        cfier, test_data.images, labels_test))
+    classifiers.append(cfier)
+
+  else:
+    # ...or one for each digit.
+    for d in range(1, train_data.num_digits() + 1):
+      images_train = train_data.images
+      images_test = test_data.images
+      if mask_digits:
+        images_train = masked_train[d - 1]
+        images_test = masked_test[d - 1]
+
+      print('Training classifier for digit {}...'.format(d))
+      cfier = train_classifier(images_train, train_data[d],
+                               images_test, test_data[d], epochs, patience,
+                               checkpoints('digit_{}'.format(d)), resume)
+      print('        Training set accuracy:',
+            test_classifier(cfier, images_train, train_data[d]))
+      print('            Test set accuracy:',
+            test_classifier(cfier, images_test, test_data[d]))
+      classifiers.append(cfier)
+
+  return classifiers
+
+
+def train_classifier(inputs, labels, test_inputs, test_labels, epochs=130,
+                     patience=10, checkpoint_dir=None, resume=False):
   """Train a classifier from flattened image inputs to labels.
 
   Args:
@@ -145,6 +415,7 @@ def train_classifier(inputs, labels, test_inputs, test_labels):
     labels: a K-vector of integer training labels.
     test_inputs: a Kx29x16x1 array of input testing images.
     test_labels: a K-vector of integer testing labels.
+    epochs, patience, checkpoint_dir, resume: as for `fit_classifier`.
 
   Returns:
     A Keras model trained on the argument data.
@@ -152,7 +423,6 @@ def train_classifier(inputs, labels, test_inputs, test_labels):
   # Derived from
   # https://github.com/keras-team/keras/blob/master/examples/cifar10_cnn.py
   batch_size = 48
-  epochs = 130
 
   # Construct a model with a convnet.
   classifier = keras.models.Sequential()
@@ -182,7 +452,8 @@ def train_classifier(inputs, labels, test_inputs, test_labels):
   classifier.add(keras.layers.Dense(16))
   classifier.add(keras.layers.Activation('softmax'))
 
-  # Our optimiser, decaying the learning rate from 0.001 to 0.0001.
+  # Our optimiser, decaying the learning rate from 0.001 to 0.0001 over the
+  # most epochs training may take.
   update_steps = epochs * (inputs.shape[0] / batch_size)
   optimiser = keras.optimizers.Adam(
       lr=0.001,
@@ -194,55 +465,338 @@ def train_classifier(inputs, labels, test_inputs, test_labels):
                      optimizer=optimiser,
                      metrics=['accuracy'])
 
-  # Prepare data augmentation.
-  data_generator = keras.preprocessing.image.ImageDataGenerator(
-      featurewise_center=False,             # set input mean to 0 over dataset
-      samplewise_center=False,              # set each sample mean to 0
-      featurewise_std_normalization=False,  # divide inputs by std of dataset
-      samplewise_std_normalization=False,   # divide each input by its std
-      zca_whitening=False,                  # apply ZCA whitening
-      zca_epsilon=1e-06,                    # epsilon for ZCA whitening
-      rotation_range=0.05,                  # randomly rotate (-this, this) degs
-      # randomly shift images horizontally (fraction of total width)
-      width_shift_range=0.05,
-      # randomly shift images vertically (fraction of total height)
-      height_shift_range=0.05,
-      shear_range=0.05,                     # set range for random shear
-      zoom_range=0.05,                      # set range for random zoom
-      channel_shift_range=0.,               # set range for channel shifts
-      # set mode for filling points outside the input boundaries
-      fill_mode='nearest',
-      cval=0.,                              # value for fill_mode = "constant"
-      horizontal_flip=False,                # randomly flip images
-      vertical_flip=False,                  # randomly flip images
-      # set rescaling factor (applied before any other transformation)
-      rescale=None,
-      # set function that will be applied on each input
-      preprocessing_function=None,
-      # image data format, either "channels_first" or "channels_last"
-      data_format='channels_last',
+  # Train the classifier!
+  return fit_classifier(classifier, inputs, labels, test_inputs, test_labels,
+                        batch_size, epochs, patience, checkpoint_dir, resume)
+
+
+def train_shared_classifier(inputs, labels, test_inputs, test_labels,
+                            epochs=130, patience=10, checkpoint_dir=None,
+                            resume=False):
+  """Train a classifier from image inputs to labels for all digits at once.
+
+  The model is the same convnet as `train_classifier`'s up to its last hidden
+  layer, which feeds four 16-way softmax outputs, one for each digit.
+
+  Args:
+    inputs: a Kx29x16x1 array of input training images.
+    labels: a list of four K-vectors of integer training labels, one for each
+        digit.
+    test_inputs: a Kx29x16x1 array of input testing images.
+    test_labels: a list of four K-vectors of integer testing labels.
+    epochs, patience, checkpoint_dir, resume: as for `fit_classifier`.
+
+  Returns:
+    A Keras model trained on the argument data. Its `predict` method returns a
+    list of four Kx16 arrays of class probabilities.
+  """
+  batch_size = 48
+
+  # Construct a model with a convnet trunk shared by the digit outputs.
+  image = keras.layers.Input(shape=inputs.shape[1:])
+  trunk = keras.layers.Conv2D(filters=16, kernel_size=(3, 3),
+                              padding='same')(image)
+  trunk = keras.layers.Activation('relu')(trunk)
+  trunk = keras.layers.MaxPooling2D(pool_size=(2, 2))(trunk)
+  trunk = keras.layers.Flatten()(trunk)
+  trunk = keras.layers.Dense(48)(trunk)
+  trunk = keras.layers.Activation('relu')(trunk)
+  trunk = keras.layers.Dense(38)(trunk)
+  trunk = keras.layers.Activation('relu')(trunk)
+  trunk = keras.layers.Dropout(0.3333)(trunk)
+  digits = [keras.layers.Dense(16, activation='softmax',
+                               name='digit_{}'.format(d + 1))(trunk)
+            for d in range(len(labels))]
+  classifier = keras.models.Model(inputs=image, outputs=digits)
+
+  # Our optimiser, decaying the learning rate from 0.001 to 0.0001 over the
+  # most epochs training may take.
+  update_steps = epochs * (inputs.shape[0] / batch_size)
+  optimiser = keras.optimizers.Adam(
+      lr=0.001,
+      decay=(1.0 - math.exp(math.log(0.1)/update_steps)),
   )
-  data_generator.fit(inputs)
+
+  # Compile the model.
+  classifier.compile(loss='sparse_categorical_crossentropy',
+                     optimizer=optimiser,
+                     metrics=['accuracy'])
 
   # Train the classifier!
-  classifier.fit(
-      x=inputs, y=labels,
-      batch_size=batch_size,
-      epochs=epochs,
-      validation_data=(test_inputs, test_labels),
-      verbose=2)
-
-  # classifier.fit_generator(
-  #     data_generator.flow(inputs, labels, batch_size=batch_size),
-  #     epochs=epochs,
-  #     steps_per_epoch=math.ceil(inputs.shape[0] / batch_size),
-  #     validation_data=(test_inputs, test_labels),
-  #     verbose=2,
-  #     workers=4)
+  return fit_classifier(classifier, inputs, labels, test_inputs, test_labels,
+                        batch_size, epochs, patience, checkpoint_dir, resume)
+
+
+def fit_classifier(classifier, inputs, labels, test_inputs, test_labels,
+                   batch_size, epochs, patience=10, checkpoint_dir=None,
+                   resume=False):
+  """Train a compiled Keras model on randomly distorted training images.
+
+  Distortions are made batch by batch as training proceeds (see
+  `augmented_batches`), and test images are left as they are. Training stops
+  early if loss on the test images stops improving, and the model ends up
+  with the weights that did best.
+
+  If `checkpoint_dir` is given, after every epoch it receives the whole model
+  (`last.h5`, optimiser state included), the best weights so far (`best.h5`),
+  and a line of the training log (`log.csv`). Training with `resume` starts
+  from `last.h5`, carrying on the epoch count and the wait for improvement
+  recorded in the log.
 
+  Args:
+    classifier: a compiled Keras model.
+    inputs: a KxRxCx1 array of input training images.
+    labels: a K-vector of integer training labels, or a list of them for a
+        model with several outputs.
+    test_inputs: a KxRxCx1 array of input testing images.
+    test_labels: testing labels, like `labels`.
+    batch_size: number of images in each training batch.
+    epochs: greatest number of passes over the training data.
+    patience: stop after this many epochs without improvement in test loss.
+    checkpoint_dir: optional directory for training checkpoints.
+    resume: whether to resume training from `checkpoint_dir`.
+
+  Returns:
+    The trained model: `classifier`, or a model loaded from `checkpoint_dir`
+    when resuming.
+  """
+  initial_epoch, best, wait = 0, None, 0
+  callbacks = []
+  if checkpoint_dir is not None:
+    checkpoint_dir = pathlib.Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    last_path = str(checkpoint_dir / 'last.h5')
+    best_path = str(checkpoint_dir / 'best.h5')
+    log_path = checkpoint_dir / 'log.csv'
+    if resume and pathlib.Path(last_path).exists() and log_path.exists():
+      initial_epoch, best, wait = _training_progress(log_path)
+      print('   ...resuming from {} after epoch {}.'.format(
+          checkpoint_dir, initial_epoch))
+      classifier = keras.models.load_model(last_path)
+
+    # The best-weights checkpoint must only improve on the best so far.
+    save_best = keras.callbacks.ModelCheckpoint(
+        best_path, monitor='val_loss', save_best_only=True,
+        save_weights_only=True)
+    if best is not None: save_best.best = best
+    callbacks += [save_best, keras.callbacks.ModelCheckpoint(last_path),
+                  keras.callbacks.CSVLogger(str(log_path),
+                                            append=initial_epoch > 0)]
+
+  callbacks.append(keras.callbacks.EarlyStopping(
+      monitor='val_loss', patience=patience - wait, baseline=best,
+      restore_best_weights=True))
+
+  if initial_epoch < epochs and wait < patience:
+    classifier.fit(
+        augmented_batches(inputs, labels, batch_size),
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        validation_data=(test_inputs, test_labels),
+        callbacks=callbacks,
+        verbose=2)
+
+  # The best weights may date from before training resumed.
+  if checkpoint_dir is not None and pathlib.Path(best_path).exists():
+    classifier.load_weights(best_path)
   return classifier
 
 
+def _training_progress(log_path):
+  """Progress recorded in a training log written by `fit_classifier`.
+
+  Returns:
+    A 3-tuple: the number of epochs completed, the best test loss, and the
+    number of epochs since the best test loss.
+  """
+  with open(log_path, newline='') as f:
+    losses = [float(row['val_loss']) for row in csv.DictReader(f)]
+  if not losses: return 0, None, 0
+  best_epoch = int(np.argmin(losses))
+  return len(losses), losses[best_epoch], len(losses) - 1 - best_epoch
+
+
+#### AUGMENTATION ####
+
+
+# Ranges of the random distortions applied to training images. Shifts are
+# fractions of the image's width and height; shear and rotation are in
+# degrees; zooms are independent in X and Y. These are the settings the
+# program once gave to Keras's `ImageDataGenerator`.
+AUGMENTATION = dict(shift=0.05, shear=0.05, zoom=0.05, rotation=0.05)
+
+
+def augmented_batches(inputs, labels, batch_size):
+  """Batches of randomly distorted training images, shuffled on every epoch.
+
+  With TensorFlow, this is a `tf.data.Dataset` that distorts each batch with
+  one projective transform op, running in parallel with training and
+  prefetched ahead of it. Without TensorFlow, it's a `keras.utils.Sequence`
+  that distorts each batch with one `scipy.ndimage.map_coordinates` call.
+  Either can be passed straight to a Keras model's `fit` method.
+
+  Args:
+    inputs: a KxRxCx1 array of images.
+    labels: a K-vector of integer labels, or a list of them.
+    batch_size: number of images in each batch.
+
+  Returns:
+    A `tf.data.Dataset` or a `keras.utils.Sequence` of (images, labels)
+    batches.
+  """
+  multiple = isinstance(labels, (list, tuple))
+  if tf is None: return _AugmentedSequence(inputs, labels, batch_size)
+
+  def distort(images, labels):
+    u = tf.random.uniform((tf.shape(images)[0], 6), -1.0, 1.0)
+    transforms = affine_transforms(u, inputs.shape[1:3], ops=tf)
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms,
+        output_shape=tf.constant(inputs.shape[1:3], dtype=tf.int32),
+        fill_value=0.0, interpolation='BILINEAR', fill_mode='NEAREST')
+    return images, labels
+
+  dataset = tf.data.Dataset.from_tensor_slices(
+      (inputs.astype(np.float32), tuple(labels) if multiple else labels))
+  return dataset.shuffle(len(inputs), reshuffle_each_iteration=True).batch(
+      batch_size).map(distort, num_parallel_calls=tf.data.AUTOTUNE).prefetch(
+          tf.data.AUTOTUNE)
+
+
+class _AugmentedSequence(keras.utils.Sequence):
+  """`augmented_batches` for Keras backends other than TensorFlow."""
+
+  def __init__(self, inputs, labels, batch_size):
+    self.inputs = inputs
+    self.labels = labels
+    self.batch_size = batch_size
+    self.order = np.random.permutation(len(inputs))
+
+  def __len__(self):
+    return math.ceil(len(self.inputs) / self.batch_size)
+
+  def __getitem__(self, index):
+    batch = self.order[index*self.batch_size:(index+1)*self.batch_size]
+    u = np.random.uniform(-1.0, 1.0, (len(batch), 6))
+    images = apply_transforms(
+        self.inputs[batch], affine_transforms(u, self.inputs.shape[1:3]))
+    if isinstance(self.labels, (list, tuple)):
+      return images, [l[batch] for l in self.labels]
+    return images, self.labels[batch]
+
+  def on_epoch_end(self):
+    self.order = np.random.permutation(len(self.inputs))
+
+
+def affine_transforms(u, image_shape, ops=np):
+  """Random distortions of images, as projective transforms.
+
+  Args:
+    u: Kx6 array of random numbers in [-1, 1], scaling the `AUGMENTATION`
+        ranges for rotation, shear, X zoom, Y zoom, X shift, and Y shift.
+    image_shape: (rows, columns) of the images.
+    ops: `np`, or `tf` for TensorFlow tensors.
+
+  Returns:
+    A Kx8 array of transforms laid out as TensorFlow's projective transform
+    ops expect: [a0, a1, a2, b0, b1, b2, 0, 0] maps output pixel (x, y) to the
+    input point (a0*x + a1*y + a2, b0*x + b1*y + b2). Distortions are centred
+    on the middle of the image.
+  """
+  rows, cols = image_shape
+  theta = u[:, 0] * AUGMENTATION['rotation'] * math.pi / 180
+  shear = u[:, 1] * AUGMENTATION['shear'] * math.pi / 180
+  zoom_x = 1.0 + u[:, 2] * AUGMENTATION['zoom']
+  zoom_y = 1.0 + u[:, 3] * AUGMENTATION['zoom']
+  shift_x = u[:, 4] * AUGMENTATION['shift'] * cols
+  shift_y = u[:, 5] * AUGMENTATION['shift'] * rows
+
+  # Rotation, then shear, then zoom, as in Keras's `ImageDataGenerator`.
+  a0 = ops.cos(theta) * zoom_x
+  a1 = -ops.sin(theta + shear) * zoom_y
+  b0 = ops.sin(theta) * zoom_x
+  b1 = ops.cos(theta + shear) * zoom_y
+
+  # Keep the centre of the image in place, apart from the shift.
+  cx, cy = (cols - 1) / 2, (rows - 1) / 2
+  a2 = cx - a0 * cx - a1 * cy + shift_x
+  b2 = cy - b0 * cx - b1 * cy + shift_y
+  zero = ops.zeros_like(a0)
+  return ops.stack([a0, a1, a2, b0, b1, b2, zero, zero], axis=1)
+
+
+def apply_transforms(images, transforms):
+  """Apply `affine_transforms` transforms to a KxRxCx1 array of images."""
+  k, rows, cols = images.shape[:3]
+  ys, xs = np.mgrid[0:rows, 0:cols]
+  t = transforms[:, :, np.newaxis, np.newaxis]
+  in_x = t[:, 0] * xs + t[:, 1] * ys + t[:, 2]
+  in_y = t[:, 3] * xs + t[:, 4] * ys + t[:, 5]
+  batch = np.broadcast_to(np.arange(k)[:, np.newaxis, np.newaxis], in_x.shape)
+  return sp.ndimage.map_coordinates(
+      images[..., 0], [batch, in_y, in_x], order=1, mode='nearest')[
+          ..., np.newaxis].astype(images.dtype)
+
+
+def load_classifiers(path):
+  """Load classifiers saved by this program from `path` (see `model_store`).
+
+  Classifiers saved before this program exported them for `keras_numpy` are
+  exported as they're loaded.
+  """
+  classifiers, metadata = model_store.load(path, _load_classifier)
+  if metadata.get('program') != _PROGRAM: raise ValueError(
+      '{} holds classifiers for {}, not {}.'.format(
+          path, metadata.get('program'), _PROGRAM))
+  for classifier, fn in zip(classifiers, metadata['files']):
+    filename = str(pathlib.Path(path) / fn)
+    if not pathlib.Path(filename + '.npz').exists():
+      _export_classifier(classifier, filename)
+  return classifiers, metadata
+
+
+def _save_classifier(classifier, filename):
+  """Save a Keras model for `model_store`, and export it for `keras_numpy`."""
+  classifier.save(filename + '.h5')
+  _export_classifier(classifier, filename)
+
+
+def _export_classifier(classifier, filename):
+  """Export a Keras model to `filename`.npz (see `keras_numpy`)."""
+  # Images are scaled to [0, 1] for classification (see
+  # `classify_probabilities`).
+  keras_numpy.export(classifier, filename + '.npz', input_scale=1.0 / 255.0)
+
+
+def _load_classifier(filename):
+  """Load a Keras model saved by `_save_classifier`."""
+  return keras.models.load_model(filename + '.h5')
+
+
+def _training_source():
+  """Source code of the functions that train classifiers, for fingerprints."""
+  return [inspect.getsource(f) for f in (
+      train_classifiers, train_classifier, train_shared_classifier,
+      fit_classifier, augmented_batches, affine_transforms)] + [AUGMENTATION]
+
+
+def _set_seeds(seed):
+  """Seed NumPy and the Keras backend, so that training is repeatable."""
+  np.random.seed(seed)  # Also seeds Theano's initialisers.
+  if hasattr(keras.utils, 'set_random_seed'):
+    keras.utils.set_random_seed(seed)  # Python, NumPy, and TensorFlow.
+  elif tf is not None:
+    tf.random.set_seed(seed)
+
+
+# Model versions recorded in output label databases are this many characters
+# of the saved model's version (see `model_store`).
+_MODEL_VERSION_LENGTH = 12
+
+# Identifies classifiers saved by this program.
+_PROGRAM = 'labels_classification_keras'
+
+
 def test_classifier(classifier, inputs, labels):
   """Compute mean subset accuracy for a classifier.
 
@@ -257,46 +811,303 @@ def test_classifier(classifier, inputs, labels):
   return classifier.evaluate(inputs, labels)[1]
 
 
-def classify_everything(db_in, db_out, classifiers, do_masking):
+def test_shared_classifier(classifier, inputs, labels):
+  """Compute the fraction of words whose digits are all labeled correctly.
+
+  Args:
+    classifier: A Keras model from `train_shared_classifier`.
+    inputs: a Kx29x16x1 array of input images.
+    labels: a list of four K-vectors of integer labels, one for each digit.
+
+  Returns:
+    A scalar mean accuracy score.
+  """
+  outputs = classifier.predict(inputs, batch_size=1024)
+  correct = [np.argmax(o, axis=1) == np.ravel(l)
+             for o, l in zip(outputs, labels)]
+  return np.mean(np.all(correct, axis=0))
+
+
+def classify_everything(db_in, db_out, classifiers, do_masking,
+                        segmenter='dp', image_cache_dir=None,
+                        batch_size=4096, decode_threads=4,
+                        decode_queue_depth=4, write_queue_depth=4,
+                        model_version=None, full=True,
+                        probabilities_path=None, deduplicate_bits=None,
+                        cascade=None):
   """Apply classifiers to every word image.
 
+  Images are loaded, classified in batches of `batch_size`, and labeled in a
+  pipeline; see `classify_pipeline` for details.
+
+  If `model_version` is given, each label is recorded in `db_out` with a
+  fingerprint of the model version and the image's pixels. Unless `full` is
+  set, images whose fingerprints match those recorded with their labels
+  already keep their labels without being classified again.
+
+  If `probabilities_path` is given, the classifiers' per-digit probabilities
+  for all images are saved there; see `probability_store`. Images that keep
+  their labels keep their saved probabilities, too, but if there are no saved
+  probabilities for the same list of images from classifiers with the same
+  `model_version`, all images are classified.
+
+  If `deduplicate_bits` is given, only one image from each group of images
+  with the same pixels is classified, and the whole group gets its label and
+  probabilities. Pixels are compared on their `deduplicate_bits` most
+  significant bits, so values below 8 also group images that differ slightly.
+
+  If `cascade` is given, it classifies images first, and `classifiers` only
+  classify the images it's unsure of.
+
   Args:
     db_in: Label database object listing all of the files in the dataset.
     db_out: Label database object receiving classifier-derived labels.
-    classifiers: List of 16-class classifiers, one for each digit.
+    classifiers: List of 16-class classifiers, one for each digit, or a list
+        holding just one model from `train_shared_classifier`.
     do_masking: Whether to mask digits during classification.
+    segmenter: Which `digit_masking` segmenter locates digits for masking.
+    image_cache_dir: Directory for caching decoded images (see `image_cache`).
+    batch_size: Number of images to classify at once.
+    decode_threads: Number of threads loading images.
+    decode_queue_depth: Number of batches that may be loaded ahead of the
+        classifiers.
+    write_queue_depth: Number of batches of labels that may wait to be written.
+    model_version: Optional string identifying the classifiers, e.g. their
+        `model_store` version.
+    full: Whether to classify all images even if they're unchanged.
+    probabilities_path: Optional .npy file for saving probabilities.
+    deduplicate_bits: Optional number of bits (1-8) of each pixel to compare
+        when grouping duplicate images. If None, images aren't deduplicated.
+    cascade: Optional `Cascade` of cheaper classifiers.
   """
-  label = 'XXXX'  # Early first value for progress indicator.
   all_images = [fn for fn, _ in db_in.all_labels_with_counts_of_at_least(0)]
-  for i, fn in enumerate(all_images):
-    # Display percentage progress indicator.
-    sys.stdout.write('   {}% '.format(round(100 * i / len(all_images))))
-    sys.stdout.write('{} '.format(label))  # This display should look cool :-)
-    sys.stdout.flush()
-
-    # Load the image and classify its digits. Commit the label.
-    original_image = skimage.io.imread(fn)
-    original_image = (
-        skimage.color.rgb2gray(original_image).astype(np.float32) / 255.0)
-    original_image = original_image[..., np.newaxis]  # One colour channel.
+
+  probabilities = None
+  if probabilities_path:
+    probabilities, reusable = probability_store.open_for_writing(
+        probabilities_path, all_images, model_version=model_version)
+    if not reusable: full = True
+
+  # Images are loaded from a memory map if there's an image cache, and from
+  # memory if they're all needed at once for deduplication; otherwise, they're
+  # decoded by the pipeline's decode threads.
+  all_decoded = None
+  all_segments = None
+  if image_cache_dir or deduplicate_bits:
+    print('   ...loading images...')
+    all_decoded = image_cache.load_images(all_images, image_cache_dir)
+    image_shape = all_decoded.shape[1:]
     if do_masking:
-      original_masked = np.zeros_like(original_image)
-      # A view with a "batch dimension" for the classifier.
-      masked = original_masked[np.newaxis, ...]
-      label = ''
-      for i, cfier in enumerate(classifiers):
-        mask_nth_digit_in_image(original_image, i, out=original_masked)
-        label += '0123456789ABCDEF'[np.argmax(cfier.predict(masked)[0])]
+      print('   ...segmenting images...')
+      all_segments = digit_masking.load_segmentation(
+          all_images, all_decoded, image_cache_dir, segmenter)
+  else:
+    image_shape = image_cache.decode_image(all_images[0]).shape
+
+  # Images to classify, as indices into all_images. With deduplication, only
+  # the first of each group of images with the same pixels is classified, and
+  # its label goes to every image in the group; `groups[i]` lists the group of
+  # `to_classify[i]`. Hashes stand in for pixels: with 64 bits, collisions
+  # among a million images are vanishingly unlikely.
+  all_hashes = None
+  groups = None
+  if deduplicate_bits:
+    print('   ...finding duplicate images...')
+    all_hashes = image_cache.content_hashes(all_decoded)
+    to_classify, groups = image_cache.find_duplicates(
+        all_hashes if deduplicate_bits >= 8 else
+        image_cache.content_hashes(all_decoded, bits=deduplicate_bits))
+    print('   ...{} distinct images among {}.'.format(
+        len(to_classify), len(all_images)))
+    def load(start, end, out):
+      np.take(all_decoded, to_classify[start:end], axis=0, out=out)
+  else:
+    to_classify = np.arange(len(all_images))
+    if all_decoded is not None:
+      def load(start, end, out):
+        np.copyto(out, all_decoded[start:end])
     else:
-      # A view with a "batch dimension" for the classifier.
-      image = original_image[np.newaxis, ...]
-      label = ''.join('0123456789ABCDEF'[np.argmax(cfier.predict(image)[0])]
-                      for cfier in classifiers)
-    db_out.force(fn, label, 2)
+      def load(start, end, out):
+        image_cache.decode_images(
+            all_images[start:end], out, show_progress=False)
+
+  # Image hashes for batches awaiting the writer, keyed by the batch's start,
+  # and the number of images that kept their old labels.
+  batch_hashes = {}
+  num_unchanged = 0
+
+  def write(start, end, labels):
+    hashes = batch_hashes.pop(start, None)
+    for i, label in enumerate(labels):
+      for index in ([to_classify[start + i]] if groups is None else
+                    groups[start + i]):
+        fp = None
+        if model_version:
+          h = hashes[i] if all_hashes is None else all_hashes[index]
+          fp = '{}:{:016x}'.format(model_version, h)
+        db_out.force(all_images[index], label, 2, fp)
+
+  # Classify images, masking with saved segmentations if we have them, but
+  # skipping images whose labels came from the same pixels and model.
+  def predict(start, end, images):
+    nonlocal num_unchanged
+    indices = to_classify[start:end]
+    labels = [None] * len(indices)
+    if model_version:
+      hashes = (image_cache.content_hashes(images) if all_hashes is None else
+                all_hashes[indices])
+      batch_hashes[start] = hashes
+      if not full:
+        for i, (index, h) in enumerate(zip(indices, hashes)):
+          fn = all_images[index]
+          if db_out.fingerprint(fn) == '{}:{:016x}'.format(model_version, h):
+            labels[i] = db_out[fn][0]
+    changed = [i for i, label in enumerate(labels) if label is None]
+    num_unchanged += len(labels) - len(changed)
+
+    if changed:
+      if len(changed) < len(labels): images = images[changed]
+      if all_segments is not None:
+        segments = all_segments[indices[changed]]
+      elif do_masking:
+        segments = digit_masking.segment(images, segmenter)
+      else:
+        segments = None
+      if cascade is None:
+        new_probabilities = classify_probabilities(
+            classifiers, do_masking, images, segments)
+      else:
+        new_probabilities = cascade.classify_probabilities(
+            classifiers, do_masking, images, segments, segmenter)
+      if probabilities is not None:
+        probabilities[indices[changed]] = new_probabilities
+      new_labels = labels_from_probabilities(new_probabilities)
+      for i, label in zip(changed, new_labels): labels[i] = label
+
+    # Duplicates share their group's probabilities.
+    if probabilities is not None and groups is not None:
+      for i, index in enumerate(indices):
+        if len(groups[start + i]) > 1:
+          probabilities[groups[start + i]] = probabilities[index]
+    return labels
+
+  counters = classify_pipeline.classify(
+      [all_images[i] for i in to_classify], image_shape, load, predict, write,
+      batch_size, decode_threads, decode_queue_depth, write_queue_depth)
+  for c in counters: print(c)
+  if cascade is not None:
+    for c in cascade.counters: print(c)
+    print('   ...sent {} of {} images to the convnet.'.format(
+        cascade.counters[1].images, cascade.counters[0].images))
+  if num_unchanged:
+    print('   ...kept labels for {} unchanged images.'.format(num_unchanged))
+  if probabilities is not None:
+    probabilities.flush()
+    print('   ...saved probabilities to {}.'.format(probabilities_path))
+
+
+def classify_images(classifiers, do_masking, images, segments=None):
+  """Apply classifiers to a batch of word images.
 
-    # Clear away progress indicator.
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
+  Args:
+    classifiers: List of 16-class classifiers, one for each digit, or a list
+        holding just one model from `train_shared_classifier`.
+    do_masking: Whether to mask digits during classification.
+    images: KxRxC uint8 array of word images.
+    segments: Optional Kx4 array of digit boundaries for masking the images
+        (see `digit_masking.segment`). If None, boundaries are computed.
+
+  Returns:
+    A list of K labels: strings of four hex digits.
+  """
+  return labels_from_probabilities(
+      classify_probabilities(classifiers, do_masking, images, segments))
+
+
+def classify_probabilities(classifiers, do_masking, images, segments=None):
+  """Compute per-digit class probabilities for a batch of word images.
+
+  Args are the same as for `classify_images`.
+
+  Returns:
+    A Kx4x16 float32 array: the probability of each value of each digit.
+  """
+  images = images.astype(np.float32)
+  images = images[..., np.newaxis] / 255.0  # One colour channel.
+  masked = mask_digits_in_images(images, segments) if do_masking else None
+  probabilities = []
+  for n, cfier in enumerate(classifiers):
+    inputs = masked[n] if do_masking else images
+    outputs = cfier.predict(inputs, batch_size=1024)
+    # A shared model has one output for each digit.
+    if not isinstance(outputs, list): outputs = [outputs]
+    probabilities.append(np.stack(outputs, axis=1))
+  return np.concatenate(probabilities, axis=1)
+
+
+class Cascade(object):
+  """Classifies with cheaper classifiers first, and convnets where unsure.
+
+  The cheaper classifiers are those saved by `labels_classification.py`. An
+  image goes on to the convnets if, for any of its digits, the difference
+  between the two largest probabilities from the cheaper classifiers is less
+  than `margin`. Counters record the images each stage classifies and the time
+  it spends (see `classify_pipeline.StageCounters`).
+  """
+
+  def __init__(self, classifiers, metadata, margin):
+    self.classifiers = classifiers
+    self.metadata = metadata
+    self.margin = margin
+    self.counters = (classify_pipeline.StageCounters('cheap'),
+                     classify_pipeline.StageCounters('convnet'))
+
+  def classify_probabilities(self, classifiers, do_masking, images,
+                             segments=None, segmenter='dp'):
+    """Like `classify_probabilities`, with the cascade's classifiers first.
+
+    Args:
+      classifiers: convnets, as for `classify_probabilities`.
+      do_masking: Whether the convnets expect images with masked digits.
+      images: KxRxC uint8 array of word images.
+      segments: Optional Kx4 array of digit boundaries for masking the images
+          for the convnets.
+      segmenter: Which `digit_masking` segmenter found `segments`.
+
+    Returns:
+      A Kx4x16 float32 array: the probability of each value of each digit.
+    """
+    t0 = time.perf_counter()
+    cheap_segments = None
+    if self.metadata['mask_digits']:
+      cheap_segments = (
+          segments if segments is not None and
+          segmenter == self.metadata['segmenter'] else
+          digit_masking.segment(images, self.metadata['segmenter']))
+    probabilities = labels_classification.classify_probabilities(
+        self.classifiers, self.metadata['mask_digits'], images,
+        cheap_segments).astype(np.float32)
+    top_two = np.sort(probabilities, axis=2)[..., -2:]
+    margins = np.min(top_two[..., 1] - top_two[..., 0], axis=1)
+    unsure = np.flatnonzero(margins < self.margin)
+    self.counters[0].add(len(images), time.perf_counter() - t0)
+
+    if len(unsure):
+      t0 = time.perf_counter()
+      probabilities[unsure] = classify_probabilities(
+          classifiers, do_masking, images[unsure],
+          segments[unsure] if segments is not None else None)
+      self.counters[1].add(len(unsure), time.perf_counter() - t0)
+    return probabilities
+
+
+def labels_from_probabilities(probabilities):
+  """Convert a Kx4x16 array of probabilities to a list of K labels."""
+  return [''.join(l) for l in _HEX_DIGITS[np.argmax(probabilities, axis=2)]]
+
+
+# Hex digit characters, indexed by their values.
+_HEX_DIGITS = np.array(list('0123456789ABCDEF'))
 
 
 #### IMAGE PROCESSING ####
@@ -304,141 +1115,89 @@ def classify_everything(db_in, db_out, classifiers, do_masking):
 
 def mask_nth_digit_in_image(image, n, out=None):
   """Return a copy of `image` with all but the `n`th digit masked."""
-  # If we sum the image vertically, a plot of the column sums will present
-  # four humps, each corresponding to a digit. This masking routine detects
-  # the humps and masks the image so only the pixels contributing to the n'th
-  # hump are visible.
-  colsum = np.sum(image, axis=0).ravel()
-
-  # # Now we need to find the least t such that image > t obtains four separate
-  # # contiguous 'True' regions. We'll scan up from t = 0...
-  # thresholded = colsum > 0                   # These two lines are just for
-  # labels = sp.ndimage.label(thresholded)[0]  # memory allocation.
-
-  # for t in range(int(max(colsum))):
-  #   np.greater(colsum, t, out=thresholded)
-  #   if sp.ndimage.label(thresholded, output=labels) == 4: break
-  # else:
-  #   raise RuntimeError('mask_nth_digit could not find four distinct digits '
-  #                      'in an image.')
-
-  # # We can now mask off the columns not containing the n'th digit.
-  # if out is None:
-  #   out = image.copy()
-  # else:
-  #   np.copyto(out, image)
-  # out[:, labels != (n + 1)] = 0
-  # return out
-
-  # These columns are not allowed to have image boundaries in them.
-  colsum[:7] = 1000
-  colsum[9:13] = 1000
-  colsum[16:19] = 1000
-  colsum[23:] = 1000
-  # The columns containing the four digits are separated by the three smallest
-  # minima of colsum not at the edges of the image.
-  left_less = colsum[:-1] < colsum[1:]
-  # True entries in this array are 4 pixels left of all local minima in colsum.
-  # This 4-offset allows us to ignore pixels at the edges of the image.
-  minima_mask = left_less[4:-3] & ~left_less[3:-4]
-  # So these are the minima's indices:
-  minima_inds = np.argwhere(minima_mask).ravel() + 4
-  # Find which three indices are associated with the smallest minima.
-  boundaries = np.sort(minima_inds[np.argsort(colsum[minima_inds])[:3]])
-
-  # Perform the masking now.
-  if out is None:
-    out = image.copy()
-  elif out is not image:
-    np.copyto(out, image)
-
-  if n > 0: out[:, :(boundaries[n-1]), ...] = 0
-  if n < 3: out[:, (boundaries[n]+1):, ...] = 0
+  masked = mask_digits_in_images(image[np.newaxis, ...])[n][0]
+  if out is None: return masked
+  np.copyto(out, masked)
   return out
 
 
-def mask_nth_digit_in_images(images, n):
-  """Return a copy of `images` with all but the `n`th digit masked.
+def mask_digits_in_images(images, segments=None):
+  """Return four copies of `images`, each with all but one digit masked.
 
   Args:
     images: a Kx16x29x1 array of input images.
-    n: which digit to show through the mask.
+    segments: optional Kx4 array of digit boundaries for the images, as from
+        `digit_masking.segment`. If None, boundaries are computed.
 
   Returns:
-    A version of `images` masked as described.
+    A list of four versions of `images`, each showing only one digit through
+    the mask. See `digit_masking` for details.
   """
-  masked = images.copy()
-  num_images = masked.shape[0]
-  for i in range(num_images):
-    sys.stdout.write('   {}% '.format(round(100 * i / num_images)))
-    sys.stdout.flush()
-    mask_nth_digit_in_image(masked[i], n, out=masked[i])
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
-
-  return masked
+  return digit_masking.mask_all_digits(images, segments)
 
 
 #### DATA SHUFFLING ####
 
 
 class Data(collections.namedtuple(
-    'Data', ['images', 'labels_1', 'labels_2', 'labels_3', 'labels_4'])):
-  """A data container for images and their per-digit labels."""
+    'Data', ['images', 'labels_1', 'labels_2', 'labels_3', 'labels_4',
+             'segments'])):
+  """A data container for images, their per-digit labels and segmentations."""
 
   def __len__(self):
     return len(self.images)
 
   def num_digits(self):
-    return len(self._fields) - 1
+    return sum(f.startswith('labels_') for f in self._fields)
 
 
-def load_data(db, minimum_label_count, max_0000):
+def load_data(db, minimum_label_count, max_0000, image_cache_dir=None,
+              segmenter=None):
   """Load labeled images and create classifier training inputs.
 
   Args:
     db: Label database object.
     minimum_label_count: Do not use labels with a count less than this value.
     max_0000: Load no more than this many examples of "0000" labels.
+    image_cache_dir: Directory for caching decoded images (see `image_cache`).
+    segmenter: Which `digit_masking` segmenter locates digit boundaries, or
+        None to skip segmenting the images (e.g. when they won't be masked).
 
   Returns:
-    A 5-tuple with the following elements:
+    A 6-tuple with the following elements:
     [0]: A Kx16x29x1 array of images, where K is the number of files in the
          database with a label count exceeding `minimum_label_count`.
     [1]: A Kx1 array of integer labels in [0, 15] for the first digit.
     [2]: A Kx1 array of integer labels in [0, 15] for the second digit.
     [3]: A Kx1 array of integer labels in [0, 15] for the third digit.
     [4]: A Kx1 array of integer labels in [0, 15] for the fourth digit.
+    [5]: A Kx4 uint8 array of digit boundaries and ambiguity flags for each
+         image (see `digit_masking.segment`), or None if `segmenter` is None.
   """
-  images = []
+  filenames = []
   labels = []
   num_0000 = 0
 
   # Note filtering for minimum label count...
   worthy_labels = db.all_labels_with_counts_of_at_least(minimum_label_count)
 
-  for i, (fn, label) in enumerate(worthy_labels):
-    # Display percentage progress indicator.
-    sys.stdout.write('   {}% '.format(round(100 * i / len(worthy_labels))))
-    sys.stdout.flush()
-
+  for fn, label in worthy_labels:
     # Process label if it is of interest.
     if label != '0000' or num_0000 < max_0000:
       if all(d in '0123456789ABCDEF' for d in label):
-        image = skimage.io.imread(fn)
-        image = skimage.color.rgb2gray(image).astype(np.float32) / 255.0
-        image = image[..., np.newaxis]  # One colour channel.
-        images.append(image)
+        filenames.append(fn)
         labels.append(tuple('0123456789ABCDEF'.find(d) for d in label))
         if label == '0000': num_0000 += 1
 
-    # Clear away progress indicator.
-    sys.stdout.write('\r\x1b[K')
-    sys.stdout.flush()
-
+  images = image_cache.load_images(filenames, image_cache_dir)
+  segments = None if segmenter is None else digit_masking.load_segmentation(
+      filenames, images, image_cache_dir, segmenter)
+  images = images.astype(np.float32) / 255.0
+  images = images[..., np.newaxis]  # One colour channel.
   return Data(*[
-      np.stack(images, axis=0),
-      *(np.int64(l)[:, np.newaxis] for l in zip(*labels))])
+      images,
+      *(np.int64(l)[:, np.newaxis] for l in zip(*labels)),
+      segments])
 
 
 def divide_data(data, train_data_fraction):
@@ -447,11 +1206,12 @@ def divide_data(data, train_data_fraction):
   # Create shuffled dataset.
   inds = np.arange(len(data))
   np.random.shuffle(inds)
-  data = Data(*[d[inds] for d in data])
+  data = Data(*[d if d is None else d[inds] for d in data])
 
   # Split it into training and test data.
   split = round(len(data) * train_data_fraction)
-  return Data(*[d[:split] for d in data]), Data(*[d[split:] for d in data])
+  return (Data(*[d if d is None else d[:split] for d in data]),
+          Data(*[d if d is None else d[split:] for d in data]))
 
 
 #### MISCELLANEOUS ####
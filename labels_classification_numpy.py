@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+"""Classify digits in word images with saved convnets, using NumPy alone.
+
+`labels_classification_keras.py` exports the convnets it saves so that they
+can run without Keras (see `keras_numpy`). This program loads exported
+convnets and labels all of the word images with them, just as
+`labels_classification_keras.py --classify-only` would, but without importing
+Keras or any other deep-learning framework.
+
+Labels are recorded with the same model version as the Keras program would
+record, so either program can pick up where the other left off.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import pathlib
+
+import keras_numpy
+import label_database
+import labels_classification
+import model_store
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Classify digits in word images with exported convnets.')
+
+  flags.add_argument('input_label_database', type=str,
+                     help=('CSV file containing image paths, labels, and '
+                           'the number of times a particular label was '
+                           'supplied for an image. The CSV header should be '
+                           '"Filename,Label,Count".'))
+
+  flags.add_argument('output_label_database', type=str,
+                     help=('CSV file receiving image content labels from the '
+                           'classifier. (Need not refer to an existing file.)'))
+
+  flags.add_argument('--model-dir', default='models', type=str,
+                     help=('Use the convnets saved most recently in this '
+                           'directory by labels_classification_keras.py.'))
+
+  flags.add_argument('--load-model', type=str,
+                     help='Use the convnets saved in this directory instead.')
+
+  flags.add_argument('--full', action='store_true',
+                     help=('Classify all word images, even those whose '
+                           'labels in output_label_database came from the '
+                           'same classifiers and unchanged images.'))
+
+  flags.add_argument('--probabilities', type=str,
+                     help=('Save the probabilities that the classifiers '
+                           'assign to each value of each digit of every word '
+                           'image in this .npy file (see probability_store).'))
+
+  flags.add_argument('--deduplicate', action='store_true',
+                     help=('Classify only one of each group of word images '
+                           'with identical pixels, giving its label to the '
+                           'whole group.'))
+
+  flags.add_argument('--deduplicate-bits', default=8, type=int,
+                     choices=range(1, 9), metavar='{1..8}',
+                     help=('With --deduplicate, compare only this many of the '
+                           'most significant bits of each pixel, so that '
+                           'images differing by faint noise count as '
+                           'duplicates.'))
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  flags.add_argument('--classification-batch-size', default=4096, type=int,
+                     help=('Classify this many word images at a time when '
+                           'labeling all of the word images.'))
+
+  flags.add_argument('--decode-threads', default=4, type=int,
+                     help=('Number of threads loading word images while the '
+                           'classifiers label other word images.'))
+
+  flags.add_argument('--decode-queue-depth', default=4, type=int,
+                     help=('Load at most this many batches of word images '
+                           'ahead of the classifiers. Memory used by loaded '
+                           'images is capped at this many batches.'))
+
+  flags.add_argument('--write-queue-depth', default=4, type=int,
+                     help=('Allow at most this many batches of labels to wait '
+                           'to be written to the output label database.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  if FLAGS.input_label_database == FLAGS.output_label_database:
+    raise ValueError("Input and output label databases can't be the same file.")
+
+  # Load exported convnets.
+  path = FLAGS.load_model or model_store.latest(
+      FLAGS.model_dir, program=_KERAS_PROGRAM)
+  print('Loading exported convnets from {}...'.format(path))
+  classifiers, metadata = load_classifiers(path)
+
+  # Create new output label database if it doesn't exist yet.
+  if not pathlib.Path(FLAGS.output_label_database).exists():
+    with open(FLAGS.output_label_database, 'w') as f:
+      f.write('"Filename","Label","Count"\n')
+
+  # Open label databases.
+  print('Opening input label database...')
+  with label_database.Database(
+      FLAGS.input_label_database, readonly=True) as db_in:
+    print('Opening output label database...')
+    with label_database.Database(
+        FLAGS.output_label_database, save_backups=False) as db_out:
+
+      # Classify all of the data.
+      print('Classifying all word images...')
+      labels_classification.classify_everything(
+          db_in, db_out, classifiers, metadata['mask_digits'],
+          metadata['segmenter'], FLAGS.image_cache_dir,
+          FLAGS.classification_batch_size, FLAGS.decode_threads,
+          FLAGS.decode_queue_depth, FLAGS.write_queue_depth,
+          metadata['version'][:_MODEL_VERSION_LENGTH], FLAGS.full,
+          FLAGS.probabilities,
+          FLAGS.deduplicate_bits if FLAGS.deduplicate else None)
+
+      # All done!
+      print('Saving output label database...')
+
+
+def load_classifiers(path):
+  """Load convnets exported by `labels_classification_keras.py` from `path`."""
+  classifiers, metadata = model_store.load(
+      path, lambda filename: keras_numpy.load(filename + '.npz'))
+  if metadata.get('program') != _KERAS_PROGRAM: raise ValueError(
+      '{} holds classifiers for {}, not {}.'.format(
+          path, metadata.get('program'), _KERAS_PROGRAM))
+  return classifiers, metadata
+
+
+# Model versions recorded in output label databases are this many characters
+# of the saved model's version, as in `labels_classification_keras.py`.
+_MODEL_VERSION_LENGTH = 12
+
+# Identifies classifiers saved by `labels_classification_keras.py`.
+_KERAS_PROGRAM = 'labels_classification_keras'
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+"""Label the words in cropped screen images without cropping word images.
+
+The usual route from a cropped screen image (in a `01_cropped` directory) to
+labels crops 18 word images from it with `crop_words.py`, one at a time and
+each with its own 200 rounds of position refinement, saves them as files, and
+classifies them later. This program goes straight from screen images to
+labels: it refines the positions of all 18 word boxes in `crop_list.csv`
+together, sampling every word on each iteration with one interpolation call,
+keeps the word images in memory, and classifies the words of many screens in
+one batch with classifiers saved by `labels_classification.py` (see
+`model_store`).
+
+Labels go into a label database under the names that `crop_all_words.sh` would
+give the word images---`./X/01_cropped/0123.png` yields names from
+`./X/02_words/0123_0_0.png` to `./X/02_words/0123_1_8.png`---so that other
+programs can use them just as they use labels for word image files. Like
+`crop_all_words.sh`, run this program from the top of the data directory tree:
+names are relative to the current directory, starting with "./", however the
+screen images were specified.
+
+Screens where any word box moves three pixels or more during refinement are
+skipped, just as `crop_words.py` gives up on them.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import csv
+import functools
+import imageio
+import multiprocessing
+import numpy as np
+import os
+import pathlib
+import sys
+from scipy import ndimage
+
+import digit_masking
+import label_database
+import labels_classification
+import model_store
+import normalise_banding
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Label the words in cropped screen images.')
+
+  flags.add_argument('output_label_database', type=str,
+                     help=('CSV file receiving image content labels. (File '
+                           'need not exist already.)'))
+
+  flags.add_argument('inputs', type=str, nargs='+',
+                     help=('Cropped screen images, or directories to search '
+                           'for "01_cropped" directories of them.'))
+
+  flags.add_argument('--crop-list', default='crop_list.csv', type=str,
+                     help=('CSV file listing word names and initial x,y '
+                           'locations of their top-left corners. The CSV '
+                           'header should be "Name,tlx,tly".'))
+
+  flags.add_argument('-r', '--rows', default=16, type=int,
+                     help='Word image size: rows.')
+
+  flags.add_argument('-c', '--cols', default=29, type=int,
+                     help='Word image size: columns.')
+
+  flags.add_argument('-i', '--iters', default=200, type=int,
+                     help='Iterations of layout position refinement.')
+
+  flags.add_argument('--brighten', default='88;73;119', type=str,
+                     help=('Do conditional brightening of word images: the '
+                           'code "87;73;119" means "if the maximum pixel value '
+                           'is less than 87, multiply pixel values by 119 / '
+                           '73". An empty value disables brightening.'))
+
+  flags.add_argument('--normalise-banding', action='store_true',
+                     help=('Correct brightness banding across whole screen '
+                           'images before sampling words from them. (See '
+                           'normalise_banding.py.)'))
+
+  flags.add_argument('--model-dir', default='models', type=str,
+                     help=('Use the classifiers trained most recently in '
+                           'this directory by labels_classification.py (not '
+                           'quantised ones).'))
+
+  flags.add_argument('--load-model', type=str,
+                     help=('Use the classifiers saved in this directory '
+                           'instead.'))
+
+  flags.add_argument('--screens-per-batch', default=256, type=int,
+                     help='Classify the words of this many screens at a time.')
+
+  flags.add_argument('--processes', default=os.cpu_count(), type=int,
+                     help='Number of processes sampling word images.')
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  # Load the .csv file listing initial word locations.
+  with open(FLAGS.crop_list, newline='') as csvfile:
+    reader = csv.reader(csvfile)
+    fieldnames = next(reader)
+    crop_locs = [(name, float(tlx), float(tly)) for name, tlx, tly in reader]
+    assert fieldnames == ['Name', 'tlx', 'tly'], (
+        'Crop list file column names must be "Name,tlx,tly"')
+
+  # Find screen images.
+  print('Listing screen image files...')
+  screens = list_screens(FLAGS.inputs)
+  print('   ...found', len(screens), 'screen images.')
+
+  # Load classifiers.
+  path = FLAGS.load_model or model_store.latest(
+      FLAGS.model_dir, program='labels_classification', quantised=None)
+  print('Loading classifiers from {}...'.format(path))
+  classifiers, metadata = labels_classification.load_classifiers(path)
+
+  # Create new output label database if it doesn't exist yet.
+  if not pathlib.Path(FLAGS.output_label_database).exists():
+    with open(FLAGS.output_label_database, 'w') as f:
+      f.write('"Filename","Label","Count"\n')
+
+  print('Opening output label database...')
+  with label_database.Database(
+      FLAGS.output_label_database, save_backups=False) as db_out:
+
+    # Sample words from screens in worker processes, and classify them here a
+    # batch of screens at a time.
+    print('Labeling words in screen images...')
+    sample = functools.partial(
+        sample_screen, crop_locs=crop_locs, rows=FLAGS.rows, cols=FLAGS.cols,
+        iters=FLAGS.iters, brighten=FLAGS.brighten,
+        do_normalise_banding=FLAGS.normalise_banding)
+    batch_screens, batch_words, skipped = [], [], []
+
+    def classify_batch():
+      words = np.concatenate(batch_words)
+      segments = (digit_masking.segment(words, metadata['segmenter'])
+                  if metadata['mask_digits'] else None)
+      labels = labels_classification.classify_images(
+          classifiers, metadata['mask_digits'], words, segments)
+      keys = [word_key(screen, name)
+              for screen in batch_screens for name, _, _ in crop_locs]
+      for key, label in zip(keys, labels): db_out.force(key, label, 2)
+      batch_screens.clear()
+      batch_words.clear()
+
+    with multiprocessing.Pool(FLAGS.processes) as pool:
+      for i, (screen, words, nudge) in enumerate(
+          pool.imap_unordered(sample, screens, chunksize=16)):
+        # Display percentage progress indicator.
+        sys.stdout.write('\r\x1b[K   {}% '.format(
+            round(100 * i / len(screens))))
+        sys.stdout.flush()
+
+        if nudge >= 3.0:
+          skipped.append(screen)
+          continue
+        batch_screens.append(screen)
+        batch_words.append(words)
+        if len(batch_screens) >= FLAGS.screens_per_batch: classify_batch()
+      if batch_screens: classify_batch()
+
+    # Clear away progress indicator.
+    sys.stdout.write('\r\x1b[K')
+    sys.stdout.flush()
+    for screen in skipped:
+      print('   ...skipped {}: excessive crop adjustment.'.format(screen))
+    print('   ...labeled words in', len(screens) - len(skipped), 'screens.')
+    print('Saving output label database...')
+
+  # All done!
+  print('Done.')
+
+
+def list_screens(inputs):
+  """List screen images: `inputs` files, and images in "01_cropped" dirs."""
+  screens = []
+  for path in inputs:
+    if not os.path.isdir(path):
+      screens.append(path)
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      if os.path.basename(root) == '01_cropped':
+        screens.extend(os.path.join(root, f) for f in sorted(files)
+                       if f.endswith('.png'))
+  return screens
+
+
+def word_key(screen, name):
+  """Filename `crop_all_words.sh` gives to word `name` cropped from `screen`.
+
+  `crop_all_words.sh` names files as `find .` lists them: relative to the
+  current directory and starting with "./", e.g. `./X/02_words/0123_0_0.png`.
+  Keys take the same form however `screen` is written (e.g. `X/01_cropped/...`
+  or an absolute path), unless `screen` lies outside the current directory.
+  """
+  head, tail = os.path.split(os.path.relpath(screen))
+  parent, innermost = os.path.split(head)
+  if innermost == '01_cropped': head = os.path.join(parent, '02_words')
+  key = os.path.join(head, '{}_{}.png'.format(os.path.splitext(tail)[0], name))
+  return key if key.startswith(os.pardir) else os.path.join(os.curdir, key)
+
+
+#### SAMPLING ####
+
+
+def sample_screen(screen, crop_locs, rows, cols, iters, brighten,
+                  do_normalise_banding):
+  """Load a screen image and sample all of its word images.
+
+  Args:
+    screen: screen image file.
+    crop_locs: list of (name, tlx, tly) tuples of initial word locations.
+    rows: word image rows.
+    cols: word image columns.
+    iters: number of position refinement iterations.
+    brighten: conditional brightening code, as for --brighten, or None.
+    do_normalise_banding: whether to correct brightness banding first.
+
+  Returns: a 3-tuple with the following items:
+    [0]: `screen`.
+    [1]: an NxRxC array of the N word images.
+    [2]: the furthest any word moved during refinement.
+  """
+  image = imageio.imread(screen, ignoregamma=True)
+  if do_normalise_banding:
+    image = normalise_banding.normalise_banding(image)
+
+  # Set up conditional brightening if desired.
+  if brighten:
+    thresh, denom, num = (float(x) for x in brighten.split(';'))
+    def postcrop(x):
+      dim = np.max(x, axis=(1, 2), keepdims=True) < thresh
+      return np.where(dim, np.uint8(x * num / denom), x)
+  else:
+    postcrop = lambda x: x
+
+  corners = np.array([(tlx, tly) for _, tlx, tly in crop_locs])
+  words, dx, dy = centre_and_sample(image, rows, cols, corners, iters, postcrop)
+  return screen, words, np.max(np.hypot(dx, dy))
+
+
+def centre_and_sample(image, rows, cols, corners, iters,
+                      postcrop=lambda x: x):
+  """Sample word images, nudging each to centre on bright pixels.
+
+  This is `crop_word.centre_and_crop` for many words at once: each word moves
+  on its own, but all of the words are sampled together on every iteration.
+
+  Args:
+    image: screen image.
+    rows: word image rows.
+    cols: word image columns.
+    corners: Nx2 array of initial (x, y) coordinates of the top-left corners
+        of N word images.
+    iters: number of nudging iterations.
+    postcrop: a callable to apply to NxRxC arrays of word images after they
+        are sampled.
+
+  Returns: a 3-tuple with the following items:
+    [0]: an NxRxC array of word images.
+    [1]: N-vector of nudging displacements in the X direction.
+    [2]: N-vector of nudging displacements in the Y direction.
+  """
+  # Set up sampling points and unscaled positioning gradients, which have a
+  # row for each word.
+  xs, ys = np.meshgrid(
+      np.arange(cols, dtype=float), np.arange(rows, dtype=float))
+  dtlx_dcol = np.tile(2.0 * xs.ravel() / (cols-1) - 1.0, (len(corners), 1))
+  dtly_drow = np.tile(2.0 * ys.ravel() / (rows-1) - 1.0, (len(corners), 1))
+  xs = xs.ravel() + corners[:, 0:1]  # Move sampling points to their initial
+  ys = ys.ravel() + corners[:, 1:2]  # positions.
+
+  # Spline coefficients are computed once for all of the iterations.
+  coefficients = ndimage.spline_filter(image, order=3, output=np.float64)
+  extract_subimages = lambda: postcrop(ndimage.map_coordinates(
+      coefficients, coordinates=[ys, xs], output=image.dtype, order=3,
+      mode='constant', cval=0.0, prefilter=False).reshape((-1, rows, cols)))
+  subimages = extract_subimages()
+
+  # Subimage position adjustment, capped at 0.01 in X or Y on each iteration.
+  cap = lambda d: 0.01 / np.maximum(np.abs(d), 0.01)
+  if iters > 0:
+    flat = subimages.reshape((len(corners), -1)).astype(float)
+    dtlx_dcol *= cap(np.sum(flat * dtlx_dcol, axis=1))[:, np.newaxis]
+    dtly_drow *= cap(np.sum(flat * dtly_drow, axis=1))[:, np.newaxis]
+
+    for it in range(iters):
+      flat = subimages.reshape((len(corners), -1)).astype(float)
+      dtlx = np.sum(flat * dtlx_dcol, axis=1)
+      dtly = np.sum(flat * dtly_drow, axis=1)
+      xs += (dtlx * cap(dtlx))[:, np.newaxis]
+      ys += (dtly * cap(dtly))[:, np.newaxis]
+      subimages = extract_subimages()
+
+  return subimages, xs[:, 0] - corners[:, 0], ys[:, 0] - corners[:, 1]
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+"""Rank word images by how much a human label for them would help.
+
+`labelthon.py` normally chooses images for a human to label at random, but
+most images are easy, and the classifiers already label them correctly. This
+program ranks images so that `labelthon.py --priority-queue` can present the
+informative ones first. Two sources of evidence are available:
+
+   - Classifier margins, from probability files saved by the classifier
+     programs' --probabilities flag: an image whose least certain digit has
+     two values with similar probabilities is a good candidate. Probabilities
+     from several files are averaged before margins are computed.
+
+   - Disagreement among classified label databases, like those used by
+     `assemble_labels.py`: an image that the databases label in many different
+     ways is a good candidate.
+
+Each source yields a priority in [0, 1] for every image it covers; when both
+are used, an image's priority is the mean of the priorities it has.
+
+Output is a CSV file with the header "Filename,Priority", sorted from highest
+priority to lowest.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import csv
+import numpy as np
+import sys
+
+import label_database
+import probability_store
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Rank word images for hand-labeling.')
+
+  flags.add_argument('output_priority_file', type=str,
+                     help=('Write image priorities to this CSV file, whose '
+                           'header will be "Filename,Priority".'))
+
+  flags.add_argument('--probabilities', type=str, nargs='+', default=[],
+                     help=('Probability files (.npy) saved by the classifier '
+                           'programs. Images are ranked by their classifier '
+                           'margins.'))
+
+  flags.add_argument('--label-databases', type=str, nargs='+', default=[],
+                     help=('Databases of classifier-generated labels. Images '
+                           'are ranked by how much the databases disagree '
+                           'about them. Will be opened read-only.'))
+
+  flags.add_argument('--exclude-labeled-in', type=str,
+                     help=('Leave out images with label counts of at least 2 '
+                           'in this label database (e.g. the hand-labeled '
+                           'one). Will be opened read-only.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  if not FLAGS.probabilities and not FLAGS.label_databases: raise ValueError(
+      'Specify at least one of --probabilities or --label-databases.')
+
+  # Priorities from each source, as dicts from filenames to priorities.
+  sources = []
+  if FLAGS.probabilities:
+    sys.stderr.write('Computing margins...\n')
+    sources.append(margin_priorities(FLAGS.probabilities))
+  if FLAGS.label_databases:
+    sys.stderr.write('Computing disagreement...\n')
+    sources.append(disagreement_priorities(FLAGS.label_databases))
+
+  # Combine priorities.
+  totals = {}
+  for source in sources:
+    for fn, priority in source.items():
+      total, n = totals.get(fn, (0.0, 0))
+      totals[fn] = (total + priority, n + 1)
+  priorities = {fn: total / n for fn, (total, n) in totals.items()}
+
+  # Leave out images that already have verified labels, if desired.
+  if FLAGS.exclude_labeled_in:
+    sys.stderr.write('Opening {}...\n'.format(FLAGS.exclude_labeled_in))
+    with label_database.Database(
+        FLAGS.exclude_labeled_in, readonly=True) as db:
+      for fn, _ in db.all_labels_with_counts_of_at_least(2):
+        priorities.pop(fn, None)
+
+  # Write priorities in descending order.
+  sys.stderr.write('Writing {} priorities...\n'.format(len(priorities)))
+  with open(FLAGS.output_priority_file, 'w', newline='') as f:
+    writer = csv.writer(f, dialect='unix')
+    writer.writerow(['Filename', 'Priority'])
+    for fn, priority in sorted(priorities.items(), key=lambda p: -p[1]):
+      writer.writerow([fn, '{:.6f}'.format(priority)])
+
+
+#### PRIORITIES ####
+
+
+def margin_priorities(probability_files, chunk_size=65536):
+  """Rank images by classifier margin.
+
+  Args:
+    probability_files: list of probability files (see `probability_store`).
+    chunk_size: how many images' probabilities to read from a file at a time.
+
+  Returns:
+    A dict mapping image filenames to 1 minus the smallest difference between
+    the two largest probabilities for any digit in the image. Probabilities
+    for images in more than one file are averaged first. Rows of all zeros
+    (e.g. for images a probability store has no probabilities for yet) are no
+    evidence, so they're skipped; images with no other evidence are left out.
+  """
+  # Accumulate probabilities. Files usually share a list of filenames, so the
+  # indices of their images in the accumulators are computed only when the
+  # list changes.
+  indices = {}
+  sums = counts = None
+  previous_filenames = None
+  for path in probability_files:
+    sys.stderr.write('   ...{}\n'.format(path))
+    filenames, probabilities = probability_store.load(path)
+    if filenames != previous_filenames:
+      rows = np.array([indices.setdefault(fn, len(indices))
+                       for fn in filenames], dtype=np.intp)
+      previous_filenames = filenames
+    if sums is None:
+      sums = np.zeros((0,) + probabilities.shape[1:], dtype=np.float32)
+      counts = np.zeros(0, dtype=np.int32)
+    if len(indices) > len(counts):
+      grow = len(indices) - len(counts)
+      sums = np.concatenate(
+          [sums, np.zeros((grow,) + sums.shape[1:], dtype=np.float32)])
+      counts = np.concatenate([counts, np.zeros(grow, dtype=np.int32)])
+    for start in range(0, len(filenames), chunk_size):
+      chunk = rows[start:start+chunk_size]
+      chunk_probabilities = probabilities[start:start+chunk_size]
+      keep = np.any(chunk_probabilities != 0, axis=(1, 2))
+      sums[chunk[keep]] += chunk_probabilities[keep]
+      counts[chunk[keep]] += 1
+  if sums is None: return {}
+
+  # Compute margins for images with evidence.
+  has_evidence = counts > 0
+  means = sums[has_evidence] / counts[has_evidence, np.newaxis, np.newaxis]
+  top_two = np.sort(means, axis=2)[..., -2:]
+  margins = np.min(top_two[..., 1] - top_two[..., 0], axis=1)
+  filenames = np.array(list(indices), dtype=object)[has_evidence]
+  return dict(zip(filenames, np.clip(1.0 - margins, 0.0, 1.0)))
+
+
+def disagreement_priorities(label_databases):
+  """Rank images by disagreement among classified label databases.
+
+  Args:
+    label_databases: list of label database files.
+
+  Returns:
+    A dict mapping image filenames to the fraction of databases that don't
+    give the image its most common label. Only images with label counts of at
+    least 2 in a database count as labeled by that database.
+  """
+  # Gather labels as integers: one row for each database. -1 means "no label",
+  # -2 means an unparseable label like "XXXX".
+  indices = {}
+  rows = []
+  for dbfile in label_databases:
+    sys.stderr.write('   ...{}\n'.format(dbfile))
+    with label_database.Database(dbfile, readonly=True) as db:
+      labels = db.all_labels_with_counts_of_at_least(2)
+    for fn, _ in labels: indices.setdefault(fn, len(indices))
+    row = np.full(len(indices), -1, dtype=np.int32)
+    for fn, label in labels:
+      row[indices[fn]] = _label_to_int(label)
+    rows.append(row)
+  votes = np.full((len(rows), len(indices)), -1, dtype=np.int32)
+  for i, row in enumerate(rows): votes[i, :len(row)] = row
+
+  # How many databases agree with the most common label?
+  voted = votes != -1
+  agreement = np.zeros(len(indices), dtype=np.int32)
+  for row in votes:
+    agreement = np.maximum(
+        agreement, np.sum((votes == row) & voted & (row != -1), axis=0))
+  num_votes = np.maximum(np.sum(voted, axis=0), 1)
+  return dict(zip(indices, 1.0 - agreement / num_votes))
+
+
+def _label_to_int(label):
+  """Convert a hex label to an integer, or -2 if it isn't hex."""
+  try:
+    return int(label, 16)
+  except ValueError:
+    return -2
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+"""Label word images with the labels of nearly identical labeled images.
+
+The same word often appears in several consecutive video frames, and its word
+images then differ only by a little noise. This program gives unlabeled word
+images the labels of their nearest labeled neighbours, no classifier training
+required.
+
+Every word image is reduced to a short vector by principal component analysis
+(PCA), and the vectors of labeled images go into a k-d tree. Distances between
+PCA vectors never exceed distances between the images themselves, so for each
+unlabeled image, the tree finds every labeled image that might be closer to it
+than a threshold. These candidates are then measured and ranked by the
+distances between their actual pixels. If the nearest labeled image (or the
+nearest few, if desired) is within the threshold, and they all share one
+label, the unlabeled image gets that label.
+
+Distances are given as root-mean-square (RMS) differences between pixel
+values. Repeated images of the same word are usually within about 12 grey
+levels of each other, and images of different words are usually much further
+apart.
+
+The output label database receives the labels of the labeled images as well as
+the propagated labels, all with a count of 2, like the databases written by the
+classifier programs.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import itertools
+import numpy as np
+import pathlib
+import scipy.spatial
+import sys
+
+import image_cache
+import label_database
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Propagate labels to nearly identical word images.')
+
+  flags.add_argument('input_label_database', type=str,
+                     help=('CSV file containing image paths, labels, and '
+                           'the number of times a particular label was '
+                           'supplied for an image. The CSV header should be '
+                           '"Filename,Label,Count". Labels in this file will '
+                           'be propagated to unlabeled images.'))
+
+  flags.add_argument('output_label_database', type=str,
+                     help=('CSV file receiving image content labels. (File '
+                           'need not exist already.)'))
+
+  flags.add_argument('--minimum-label-count', default=2, type=int,
+                     help=('Only propagate image labels with at least this '
+                           'many counts. Images with fewer count as '
+                           'unlabeled.'))
+
+  flags.add_argument('--max-rms-difference', default=16.0, type=float,
+                     help=('Only propagate labels between images whose RMS '
+                           'pixel difference is at most this many grey '
+                           'levels.'))
+
+  flags.add_argument('--neighbours', default=1, type=int,
+                     help=('Only propagate a label to an image if this many '
+                           'of its nearest labeled images are all within '
+                           '--max-rms-difference and all share the label. '
+                           'Larger values are more cautious.'))
+
+  flags.add_argument('--pca-components', default=32, type=int,
+                     help='Reduce images to vectors of this length.')
+
+  flags.add_argument('--pca-sample-size', default=20000, type=int,
+                     help=('Fit the PCA to a random sample of this many '
+                           'images.'))
+
+  flags.add_argument('--seed', default=0, type=int,
+                     help='Random seed for choosing the PCA sample.')
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  if FLAGS.input_label_database == FLAGS.output_label_database:
+    raise ValueError("Input and output label databases can't be the same file.")
+  if FLAGS.neighbours < 1: raise ValueError(
+      'The value of --neighbours must be at least 1.')
+
+  # Create new output label database if it doesn't exist yet.
+  if not pathlib.Path(FLAGS.output_label_database).exists():
+    with open(FLAGS.output_label_database, 'w') as f:
+      f.write('"Filename","Label","Count"\n')
+
+  # Find all images and the labeled images among them.
+  print('Opening input label database...')
+  with label_database.Database(
+      FLAGS.input_label_database, readonly=True) as db_in:
+    all_images = [fn for fn, _ in db_in.all_labels_with_counts_of_at_least(0)]
+    known = dict(
+        db_in.all_labels_with_counts_of_at_least(FLAGS.minimum_label_count))
+  labeled = np.array([i for i, fn in enumerate(all_images) if fn in known],
+                     dtype=np.intp)
+  unlabeled = np.array([i for i, fn in enumerate(all_images)
+                        if fn not in known], dtype=np.intp)
+  print('   ...found', len(all_images), 'images,', len(labeled), 'labeled.')
+  if not len(labeled) or not len(unlabeled): raise ValueError(
+      'Need both labeled and unlabeled images to propagate labels.')
+
+  # Load images and reduce them to PCA vectors.
+  print('Loading images...')
+  images = image_cache.load_images(all_images, FLAGS.image_cache_dir)
+  images = images.reshape((len(all_images), -1))
+  print('Computing PCA vectors...')
+  sample = np.random.RandomState(FLAGS.seed).permutation(len(images))
+  mean, components = fit_pca(images[np.sort(sample[:FLAGS.pca_sample_size])],
+                             FLAGS.pca_components)
+  vectors = project(images, mean, components)
+
+  # Find neighbours and propagate labels.
+  print('Finding neighbours...')
+  max_distance = FLAGS.max_rms_difference * np.sqrt(images.shape[1])
+  neighbours = unanimous_neighbours(
+      images, vectors, labeled, unlabeled,
+      [known[all_images[i]] for i in labeled], FLAGS.neighbours, max_distance)
+  found = neighbours >= 0
+  print('   ...found labels for', np.sum(found), 'of', len(unlabeled),
+        'unlabeled images.')
+
+  # Write labels.
+  print('Opening output label database...')
+  with label_database.Database(
+      FLAGS.output_label_database, save_backups=False) as db_out:
+    for i in labeled:
+      db_out.force(all_images[i], known[all_images[i]], 2)
+    for i, n in zip(unlabeled[found], neighbours[found]):
+      db_out.force(all_images[i], known[all_images[n]], 2)
+    print('Saving output label database...')
+
+  # All done!
+  print('Done.')
+
+
+#### NEIGHBOURS ####
+
+
+def fit_pca(images, num_components):
+  """Find the principal components of a sample of images.
+
+  Args:
+    images: KxP array of linearised images.
+    num_components: number of components to find.
+
+  Returns:
+    A 2-tuple: the P-vector mean of the images, and a NxP array of the N
+    (at most `num_components`) leading principal components, which are
+    orthonormal.
+  """
+  images = images.astype(np.float32)
+  mean = np.mean(images, axis=0)
+  _, _, components = np.linalg.svd(images - mean, full_matrices=False)
+  return mean, components[:num_components]
+
+
+def project(images, mean, components, chunk_size=65536):
+  """Reduce images to PCA vectors.
+
+  Args:
+    images: KxP array of linearised images.
+    mean: P-vector mean from `fit_pca`.
+    components: NxP array of principal components from `fit_pca`.
+    chunk_size: project this many images at a time.
+
+  Returns:
+    A KxN float32 array of PCA vectors.
+  """
+  vectors = np.empty((len(images), len(components)), dtype=np.float32)
+  for i in range(0, len(images), chunk_size):
+    sys.stdout.write('   {}% '.format(round(100 * i / len(images))))
+    sys.stdout.flush()
+    vectors[i:i+chunk_size] = (
+        images[i:i+chunk_size].astype(np.float32) - mean) @ components.T
+    sys.stdout.write('\r\x1b[K')
+    sys.stdout.flush()
+  return vectors
+
+
+def unanimous_neighbours(images, vectors, labeled, unlabeled, labels,
+                         num_neighbours, max_distance, chunk_size=65536):
+  """Find labeled neighbours to propagate labels from.
+
+  Args:
+    images: KxP array of linearised images.
+    vectors: KxN array of PCA vectors for the images, from `project`.
+    labeled: indices of labeled images.
+    unlabeled: indices of unlabeled images.
+    labels: labels of the images in `labeled`.
+    num_neighbours: how many nearest labeled neighbours must agree.
+    max_distance: largest Euclidean distance allowed between the pixels of an
+        image and its neighbours.
+    chunk_size: find neighbours for this many images at a time.
+
+  Returns:
+    For each image in `unlabeled`, the index of its nearest labeled image if
+    the nearest `num_neighbours` labeled images are all within `max_distance`
+    and all have the same label, or else -1. "Nearest" means nearest in pixel
+    distance; ties go to the earlier labeled image.
+  """
+  num_neighbours = min(num_neighbours, len(labeled))
+  _, label_ids = np.unique(np.array(labels), return_inverse=True)
+  tree = scipy.spatial.cKDTree(vectors[labeled])
+  result = np.full(len(unlabeled), -1, dtype=np.intp)
+
+  for start in range(0, len(unlabeled), chunk_size):
+    sys.stdout.write('   {}% '.format(round(100 * start / len(unlabeled))))
+    sys.stdout.flush()
+
+    # Candidates from the tree: every labeled image whose PCA vector is within
+    # max_distance, as pairs of positions in `chunk` and in `labeled`.
+    chunk = unlabeled[start:start+chunk_size]
+    candidates = tree.query_ball_point(vectors[chunk], max_distance,
+                                       workers=-1)
+    counts = np.array([len(c) for c in candidates], dtype=np.intp)
+    queries = np.repeat(np.arange(len(chunk)), counts)
+    others = np.fromiter(itertools.chain.from_iterable(candidates),
+                         dtype=np.intp, count=np.sum(counts))
+
+    # Measure the distances between the images themselves, and keep
+    # candidates within max_distance.
+    distances = np.empty(len(queries), dtype=np.float32)
+    for i in range(0, len(queries), chunk_size):
+      difference = (
+          images[chunk[queries[i:i+chunk_size]]].astype(np.float32) -
+          images[labeled[others[i:i+chunk_size]]].astype(np.float32))
+      distances[i:i+chunk_size] = np.sum(np.square(difference), axis=1)
+    within = distances <= max_distance ** 2
+    queries, others = queries[within], others[within]
+    distances = distances[within]
+
+    # Rank each image's candidates by distance, then check that the nearest
+    # num_neighbours exist and share a label.
+    order = np.lexsort((others, distances, queries))
+    queries, others = queries[order], others[order]
+    rank = np.arange(len(queries)) - np.searchsorted(queries, queries)
+    top = rank < num_neighbours
+    nearest = np.full((len(chunk), num_neighbours), -1, dtype=np.intp)
+    nearest[queries[top], rank[top]] = others[top]
+    ok = np.all(nearest >= 0, axis=1)
+    nearest_ids = label_ids[nearest[ok]]
+    ok[ok] = np.all(nearest_ids == nearest_ids[:, :1], axis=1)
+    result[start + np.flatnonzero(ok)] = labeled[nearest[ok, 0]]
+
+    sys.stdout.write('\r\x1b[K')
+    sys.stdout.flush()
+
+  return result
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
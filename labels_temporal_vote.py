@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+"""Pool classifier evidence across consecutive frames showing the same words.
+
+The video of the DCP1 display often lingers on one screen of 32 bytes for many
+frames, and `assemble_labels.py` counts every word image in every one of those
+frames as a separate vote. This program pools the evidence first: it groups
+consecutive frames whose address words (in positions `0_0` and `1_0`) decode
+to the same addresses, averages the per-digit probabilities for each word
+position over the whole group, and gives every word image in the group the
+label with the highest pooled probability for each digit.
+
+Evidence comes from probability files saved by the classifier programs'
+--probabilities flag, and from label databases, whose labels count as
+probabilities of 1. The ground-truth database counts as one more label
+database, and as in `assemble_labels.py`, frames whose address words it labels
+"XXXX" are left out. For each word image, all of the evidence about it is
+averaged before frames are grouped.
+
+Output is a label database in which every word image of every group has its
+group's label, ready for `assemble_labels.py`: one such database can stand in
+for the votes of many classified label databases. Optionally, a CSV file with
+the header "Address,Label,Frames,Confidence" lists each group's label for
+each address just once, where Confidence is the smallest pooled probability of
+any digit of the label.
+
+Like `assemble_labels.py`, this program assumes that image filenames end with
+the row and column of the word on the display, as in `0123_1_8.png`.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import csv
+import numpy as np
+import os
+import pathlib
+import sys
+
+import label_database
+import probability_store
+
+
+# Word positions in a frame, in display order. Positions 0_0 and 1_0 hold the
+# addresses of the words in their rows.
+POSITIONS = tuple('{}_{}'.format(r, c) for r in range(2) for c in range(9))
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Pool classifier evidence across consecutive frames.')
+
+  flags.add_argument('ground_truth_database', type=str,
+                     help=('A database of presumed ground-truth image labels, '
+                           'and of ambiguous ("XXXX") images. Frames with '
+                           'ambiguous address words will be left out. Will be '
+                           'opened read-only.'))
+
+  flags.add_argument('output_label_database', type=str,
+                     help=('CSV file receiving pooled labels. (File need not '
+                           'exist already.)'))
+
+  flags.add_argument('--probabilities', type=str, nargs='+', default=[],
+                     help=('Probability files (.npy) saved by the classifier '
+                           'programs.'))
+
+  flags.add_argument('--label-databases', type=str, nargs='+', default=[],
+                     help=('Databases of classifier-generated labels. Will be '
+                           'opened read-only.'))
+
+  flags.add_argument('--image-substrings', type=str,
+                     help=('Comma-separated list of path substrings. If given, '
+                           'only images whose paths contain at least one of '
+                           'these substrings are examined.'))
+
+  flags.add_argument('--group-labels', type=str,
+                     help=('Also write one label per address per group to '
+                           'this CSV file.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  if FLAGS.output_label_database in (
+      [FLAGS.ground_truth_database] + FLAGS.label_databases): raise ValueError(
+          "The output label database can't also be an input.")
+  substrings = (FLAGS.image_substrings.split(',') if FLAGS.image_substrings
+                else None)
+
+  # Gather and average the evidence for every word image.
+  evidence = Evidence(substrings)
+  for path in FLAGS.probabilities:
+    sys.stderr.write('Loading {}...\n'.format(path))
+    evidence.add_probabilities(*probability_store.load(path))
+  sys.stderr.write('Loading {}...\n'.format(FLAGS.ground_truth_database))
+  db_truth = label_database.Database(FLAGS.ground_truth_database, readonly=True)
+  evidence.add_labels(db_truth.all_labels_with_counts_of_at_least(2))
+  for dbfile in FLAGS.label_databases:
+    sys.stderr.write('Loading {}...\n'.format(dbfile))
+    with label_database.Database(dbfile, readonly=True) as db:
+      evidence.add_labels(db.all_labels_with_counts_of_at_least(2))
+  filenames, probabilities = evidence.means()
+
+  # Group frames, leaving out frames with ambiguous address words.
+  sys.stderr.write('Grouping frames...\n')
+  def ambiguous(stem):
+    for pos in ('0_0', '1_0'):
+      fn = '{}{}.png'.format(stem, pos)
+      if fn not in db_truth: continue
+      label, count = db_truth[fn]
+      if count >= 2 and label == 'XXXX': return True
+    return False
+  frames = {stem: indices for stem, indices in frame_indices(
+      filenames, probabilities).items() if not ambiguous(stem)}
+  groups = group_frames(frames, probabilities)
+  sys.stderr.write('   ...{} frames in {} groups.\n'.format(
+      sum(len(g) for _, g in groups), len(groups)))
+
+  # Pool evidence across each group and write labels.
+  if not pathlib.Path(FLAGS.output_label_database).exists():
+    with open(FLAGS.output_label_database, 'w') as f:
+      f.write('"Filename","Label","Count"\n')
+  rows = []
+  sys.stderr.write('Pooling evidence...\n')
+  with label_database.Database(
+      FLAGS.output_label_database, save_backups=False) as db_out:
+    for address, stems in groups:
+      indices = np.stack([frames[s] for s in stems])
+      pooled = pool_group(indices, probabilities)
+      for p, pos in enumerate(POSITIONS):
+        if pos in ('0_0', '1_0'):
+          label = '{:04X}'.format(address + (0x10 if pos == '1_0' else 0))
+        elif pooled[p] is None:
+          continue
+        else:
+          label = ''.join('{:X}'.format(d) for d in np.argmax(pooled[p], 1))
+          column = int(pos[2]) - 1
+          word_address = address + 0x10 * int(pos[0]) + 2 * column
+          confidence = np.min(np.max(pooled[p], axis=1))
+          rows.append(['{:04X}'.format(word_address), label, len(stems),
+                       '{:.4f}'.format(confidence)])
+        for stem in stems:
+          if frames[stem][p] >= 0:
+            db_out.force('{}{}.png'.format(stem, pos), label, 2)
+    sys.stderr.write('Saving output label database...\n')
+
+  if FLAGS.group_labels:
+    with open(FLAGS.group_labels, 'w', newline='') as f:
+      writer = csv.writer(f, dialect='unix')
+      writer.writerow(['Address', 'Label', 'Frames', 'Confidence'])
+      writer.writerows(rows)
+
+  # All done!
+  sys.stderr.write('Done.\n')
+
+
+#### EVIDENCE ####
+
+
+class Evidence(object):
+  """Accumulates per-digit probabilities for word images from many sources."""
+
+  def __init__(self, substrings=None):
+    self.substrings = substrings
+    self.indices = {}
+    self.sums = np.zeros((0, 4, 16), dtype=np.float32)
+    self.counts = np.zeros(0, dtype=np.int32)
+
+  def _index(self, filenames):
+    """Indices of `filenames` in the accumulators, or -1 if filtered out."""
+    result = np.full(len(filenames), -1, dtype=np.intp)
+    for i, fn in enumerate(filenames):
+      if self.substrings and not any(s in fn for s in self.substrings):
+        continue
+      result[i] = self.indices.setdefault(fn, len(self.indices))
+    if len(self.indices) > len(self.counts):
+      grow = len(self.indices) - len(self.counts)
+      self.sums = np.concatenate(
+          [self.sums, np.zeros((grow, 4, 16), dtype=np.float32)])
+      self.counts = np.concatenate(
+          [self.counts, np.zeros(grow, dtype=np.int32)])
+    return result
+
+  def add_probabilities(self, filenames, probabilities, chunk_size=65536):
+    """Add a KxDx16 array of probabilities for K `filenames`.
+
+    Rows of all zeros (e.g. for images a probability store has no
+    probabilities for yet) are no evidence, so they're skipped rather than
+    counted: counting them would dilute the means of the other sources.
+    """
+    indices = self._index(filenames)
+    for start in range(0, len(filenames), chunk_size):
+      chunk = indices[start:start+chunk_size]
+      chunk_probabilities = probabilities[start:start+chunk_size]
+      keep = (chunk >= 0) & np.any(chunk_probabilities != 0, axis=(1, 2))
+      self.sums[chunk[keep]] += chunk_probabilities[keep]
+      self.counts[chunk[keep]] += 1
+
+  def add_labels(self, labels):
+    """Add (filename, label) pairs as probabilities of 1; skip non-hex ones."""
+    labels = [(fn, label) for fn, label in labels if _is_hex(label)]
+    indices = self._index([fn for fn, _ in labels])
+    for i, (_, label) in zip(indices, labels):
+      if i < 0: continue
+      self.sums[i, np.arange(4), [int(c, 16) for c in label]] += 1.0
+      self.counts[i] += 1
+
+  def means(self):
+    """A list of filenames, and a Kx4x16 array of mean probabilities."""
+    return list(self.indices), self.sums / np.maximum(
+        self.counts, 1)[:, np.newaxis, np.newaxis]
+
+
+def _is_hex(label):
+  """Whether `label` is four hex digits."""
+  return len(label) == 4 and all(c in '0123456789ABCDEFabcdef' for c in label)
+
+
+#### FRAMES ####
+
+
+def frame_indices(filenames, probabilities):
+  """Find the word images of each frame.
+
+  Args:
+    filenames: list of word image filenames.
+    probabilities: Kx4x16 array of probabilities for the images in
+        `filenames`; images whose probabilities are all 0 have no evidence.
+
+  Returns:
+    A dict mapping frame "stems" (filenames without the trailing `1_8.png`) to
+    an 18-vector of the indices in `filenames` of the frame's word images, in
+    `POSITIONS` order, with -1 for missing images or images with no evidence.
+    Only frames with evidence for both address words are included.
+  """
+  has_evidence = np.any(probabilities > 0, axis=(1, 2))
+  frames = {}
+  for i, fn in enumerate(filenames):
+    stem, pos = fn[:-7], fn[-7:-4]
+    if pos not in POSITIONS or not has_evidence[i]: continue
+    frames.setdefault(stem, np.full(len(POSITIONS), -1, dtype=np.intp))
+    frames[stem][POSITIONS.index(pos)] = i
+  address_positions = [POSITIONS.index('0_0'), POSITIONS.index('1_0')]
+  return {stem: indices for stem, indices in frames.items()
+          if np.all(indices[address_positions] >= 0)}
+
+
+def group_frames(frames, probabilities):
+  """Group consecutive frames showing the same addresses.
+
+  Args:
+    frames: dict of frames from `frame_indices`.
+    probabilities: Kx4x16 array of probabilities for all word images.
+
+  Returns:
+    A list of 2-tuples: the address of the first word in a group of frames,
+    and a list of the stems of the frames in the group. Frames are
+    consecutive if they're adjacent in sorted order in the same directory.
+    Frames whose address words aren't 0x10 apart are left out.
+  """
+  groups = []
+  previous = None
+  for stem in sorted(frames):
+    addresses = [int(''.join('{:X}'.format(d) for d in np.argmax(
+        probabilities[frames[stem][POSITIONS.index(pos)]], axis=1)), 16)
+        for pos in ('0_0', '1_0')]
+    if addresses[1] - addresses[0] != 0x10:
+      previous = None
+      continue
+    key = (os.path.dirname(stem), addresses[0])
+    if key == previous:
+      groups[-1][1].append(stem)
+    else:
+      groups.append((addresses[0], [stem]))
+    previous = key
+  return groups
+
+
+def pool_group(indices, probabilities):
+  """Average probabilities for each word position across a group of frames.
+
+  Args:
+    indices: Fx18 array of word image indices for F frames, from
+        `frame_indices`.
+    probabilities: Kx4x16 array of probabilities for all word images.
+
+  Returns:
+    A list with an entry for each position: a 4x16 array of mean
+    probabilities, or None if no frame in the group has an image there.
+  """
+  pooled = []
+  for p in range(indices.shape[1]):
+    present = indices[:, p][indices[:, p] >= 0]
+    pooled.append(np.mean(probabilities[present], axis=0)
+                  if len(present) else None)
+  return pooled
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -10,6 +10,10 @@ The user interface is simple: user sees an image, user types hex digits. If
 the user doesn't want to label a particular image, then they can type the space
 bar to move on to the next image.
 
+Novel images to label are normally chosen at random. Given a priority file from
+`labels_priority.py`, this program chooses the highest-priority unlabeled image
+instead.
+
 Runs on Unix systems only for now. Sorry, windows...
 
 Licensing:
@@ -20,6 +24,8 @@ warranty. See the LICENSE file for details.
 """
 
 import argparse
+import csv
+import heapq
 import itertools
 import random
 import sys
@@ -51,6 +57,11 @@ def _define_flags():
   flags.add_argument('-s', '--scale', default=3.0, type=float,
                      help='Scale images by this factor when showing them.')
 
+  flags.add_argument('--priority-queue', type=str,
+                     help=('CSV file of image priorities from '
+                           'labels_priority.py. Novel images to label are '
+                           'taken from this file in order of priority.'))
+
   flags.add_argument('--mark-apl-ros-c000-zeros', action='store_true',
                      help=("It's known that the data words in the APL ROS are "
                            'all 0000 from C000 to DFFE. Mark them as such. '
@@ -67,9 +78,15 @@ def main(FLAGS):
       print('Marking APL ROS known-zeros at C000...')
       mark_apl_ros_c000_zeros(db)
 
+    priority_queue = None
+    if FLAGS.priority_queue:
+      print('Loading priority queue...')
+      priority_queue = load_priority_queue(FLAGS.priority_queue)
+
     for act_count in itertools.count():
       filename, image = next_image_and_housekeeping(
-          db, FLAGS.num_labels, FLAGS.label_bias, FLAGS.scale, act_count)
+          db, FLAGS.num_labels, FLAGS.label_bias, FLAGS.scale, act_count,
+          priority_queue)
 
       if filename is None:
         print('You are finished! Thank you for your hard work!')
@@ -141,7 +158,8 @@ def quiz_user_for_label(image):
   return ''.join(label_chars)
 
 
-def next_image_and_housekeeping(db, num_labels, label_bias, scale, act_count):
+def next_image_and_housekeeping(db, num_labels, label_bias, scale, act_count,
+                                priority_queue=None):
   """Retrieve the next image to label, and do some housekeeping.
 
   Args:
@@ -153,6 +171,8 @@ def next_image_and_housekeeping(db, num_labels, label_bias, scale, act_count):
     action_count: how many labeling actions the user has undertaken in this
         session prior to now. This function will save the database to disk after
         every 100 labeling actions.
+    priority_queue: optional heap from `load_priority_queue`. If specified,
+        novel images are popped from here instead of chosen at random.
 
   Returns:
     (None, None) if there are already `num_labels` verified labels in the
@@ -172,7 +192,11 @@ def next_image_and_housekeeping(db, num_labels, label_bias, scale, act_count):
   if num_unverified > 0 and random.random() > novel_image_probability:
     filename = db.random_label_with_count_of(1)  # Choose to verify a label.
   else:
-    filename = db.random_label_with_count_of(0)  # Label a novel image.
+    filename = None
+    if priority_queue is not None:
+      filename = next_prioritised_image(db, priority_queue)
+    if filename is None:
+      filename = db.random_label_with_count_of(0)  # Label a novel image.
 
   # Attempt to load the image, and scale it.
   image = wand.image.Image(filename=filename)
@@ -182,6 +206,46 @@ def next_image_and_housekeeping(db, num_labels, label_bias, scale, act_count):
   return filename, image
 
 
+def load_priority_queue(filename):
+  """Load a priority file from `labels_priority.py` into a heap.
+
+  Args:
+    filename: CSV file with the header "Filename,Priority".
+
+  Returns:
+    A list of (-priority, image filename) tuples arranged as a heap by
+    `heapq`, so that the highest-priority image is popped first.
+  """
+  with open(filename, newline='') as csvfile:
+    reader = csv.reader(csvfile)
+    fieldnames = next(reader)
+    assert fieldnames == ['Filename', 'Priority'], (
+        'Priority file column names must be "Filename,Priority"')
+    heap = [(-float(priority), imgfile) for imgfile, priority in reader]
+  heapq.heapify(heap)
+  return heap
+
+
+def next_prioritised_image(db, priority_queue):
+  """Pop the highest-priority unlabeled image from a priority queue.
+
+  Images that are no longer unlabeled, or that aren't in the database, are
+  discarded along the way.
+
+  Args:
+    db: a label_database.Database object.
+    priority_queue: a heap from `load_priority_queue`.
+
+  Returns:
+    The filename of the highest-priority unlabeled image, or None if there are
+    no unlabeled images left in `priority_queue`.
+  """
+  while priority_queue:
+    _, filename = heapq.heappop(priority_queue)
+    if filename in db and db[filename][1] == 0: return filename
+  return None
+
+
 def mark_apl_ros_c000_zeros(db):
   """Mark APL ROS known-zeros between C000-DFFE."""
   for prefix in ('./APL/APL_LROS_C000/02_words',
@@ -0,0 +1,159 @@
+"""Library for saving and loading trained classifiers.
+
+Classifier programs save the classifiers they train in a model directory, each
+set of classifiers in a subdirectory named for a fingerprint of everything
+that went into training them: the training data, the settings that affect
+training, and the source code of the training functions. When a later run
+would train classifiers with the same fingerprint, it can load the saved ones
+instead.
+
+Each subdirectory holds one file for each classifier plus `metadata.json`,
+which records the fingerprint, when the classifiers were saved, and whatever
+the saving program needs to know to use the classifiers again (e.g. whether
+they expect images with masked digits).
+
+`metadata.json` also records a version: a digest of the saved classifier
+files themselves. Training isn't always repeatable, so classifiers trained
+again with the same fingerprint can differ from the ones they replace, but
+they'll have a different version. Programs record the version with the labels
+that the classifiers give.
+
+This library doesn't know how to save any particular kind of classifier; the
+calling program supplies functions for that. `pickle_classifier` and
+`unpickle_classifier` will do for scikit-learn classifiers.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import shutil
+
+import numpy as np
+
+
+def fingerprint(*parts):
+  """Hex digest of `parts`: numpy arrays or JSON-serialisable values."""
+  digest = hashlib.sha1()
+  for part in parts:
+    if isinstance(part, np.ndarray):
+      digest.update('{}{}'.format(part.dtype.str, part.shape).encode())
+      digest.update(np.ascontiguousarray(part).data)
+    else:
+      digest.update(json.dumps(part, sort_keys=True).encode())
+  return digest.hexdigest()
+
+
+def model_path(model_dir, fp):
+  """Path of the saved classifiers with fingerprint `fp` in `model_dir`."""
+  return pathlib.Path(model_dir) / fp
+
+
+def save(path, classifiers, save_classifier, metadata):
+  """Save classifiers and their metadata.
+
+  Args:
+    path: directory to save classifiers into, e.g. from `model_path`. Any
+        classifiers already there are replaced.
+    classifiers: list of classifiers to save.
+    save_classifier: callable `save_classifier(classifier, filename)` that
+        saves a classifier to a file.
+    metadata: dict of JSON-serialisable information about the classifiers.
+
+  Returns:
+    The metadata as saved, with the fingerprint, version, and other entries
+    that `save` adds.
+  """
+  path = pathlib.Path(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+
+  # Save into a temporary directory and rename it, so that interrupted runs
+  # don't leave incomplete models behind.
+  temp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+  temp_path.mkdir()
+  files = []
+  for n, classifier in enumerate(classifiers):
+    files.append('classifier_{}'.format(n))
+    save_classifier(classifier, str(temp_path / files[-1]))
+  metadata = dict(metadata, fingerprint=path.name, files=files,
+                  version=_digest_files(temp_path),
+                  saved=datetime.datetime.now().isoformat())
+  with open(temp_path / 'metadata.json', 'w') as f:
+    json.dump(metadata, f, indent=2, sort_keys=True)
+
+  if path.exists(): shutil.rmtree(path)
+  os.replace(temp_path, path)
+  return metadata
+
+
+def load(path, load_classifier):
+  """Load classifiers saved by `save`.
+
+  Args:
+    path: directory holding the saved classifiers.
+    load_classifier: callable `load_classifier(filename)` that loads a
+        classifier saved by the `save_classifier` argument to `save`.
+
+  Returns:
+    A 2-tuple: a list of the classifiers, and their metadata dict.
+  """
+  path = pathlib.Path(path)
+  with open(path / 'metadata.json') as f:
+    metadata = json.load(f)
+  # Classifiers saved before versions were recorded get theirs now.
+  if 'version' not in metadata: metadata['version'] = _digest_files(path)
+  return [load_classifier(str(path / fn)) for fn in metadata['files']], metadata
+
+
+def _digest_files(path):
+  """Hex digest of the names and contents of the classifier files in `path`."""
+  digest = hashlib.sha1()
+  for filename in sorted(pathlib.Path(path).glob('classifier_*')):
+    digest.update(filename.name.encode())
+    with open(filename, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''): digest.update(chunk)
+  return digest.hexdigest()
+
+
+def latest(model_dir, **criteria):
+  """Path of the classifiers saved most recently in `model_dir`.
+
+  Args:
+    model_dir: directory holding saved classifiers.
+    **criteria: only consider classifiers whose metadata have these values.
+
+  Returns:
+    The path of the most recently saved classifiers meeting `criteria`.
+
+  Raises:
+    FileNotFoundError: there are no such classifiers.
+  """
+  candidates = []
+  for metadata_file in pathlib.Path(model_dir).glob('*/metadata.json'):
+    with open(metadata_file) as f:
+      metadata = json.load(f)
+    if all(metadata.get(k) == v for k, v in criteria.items()):
+      candidates.append((metadata['saved'], metadata_file.parent))
+  if not candidates: raise FileNotFoundError(
+      'Found no saved classifiers in {}.'.format(model_dir))
+  return max(candidates)[1]
+
+
+def pickle_classifier(classifier, filename):
+  """Save a classifier by pickling it to `filename`.pkl."""
+  with open(filename + '.pkl', 'wb') as f:
+    pickle.dump(classifier, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unpickle_classifier(filename):
+  """Load a classifier saved by `pickle_classifier`."""
+  with open(filename + '.pkl', 'rb') as f:
+    return pickle.load(f)
@@ -0,0 +1,53 @@
+"""A scikit-learn-style classifier that labels all digits in a word at once.
+
+`labels_classification.py` normally trains a separate classifier for each digit
+of a word image. With --shared-model it trains a `MultiDigitClassifier`
+instead. This class lives in its own library so that pickled instances can be
+loaded by any program, not just the one that trained them.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import numpy as np
+
+
+class MultiDigitClassifier(object):
+  """Classifies all of the digits in a word image with one model.
+
+  Wraps a scikit-learn classifier that supports multilabel classification (like
+  `MLPClassifier`), training it to predict a one-hot encoding of every digit at
+  once. The classifier's hidden layers are shared by all of the digits, and a
+  single forward pass labels a whole word.
+  """
+
+  def __init__(self, classifier, num_digits=4, num_classes=16):
+    self.classifier = classifier
+    self.num_digits = num_digits
+    self.num_classes = num_classes
+
+  def fit(self, inputs, labels):
+    """Train on Kx`num_digits` integer `labels`."""
+    onehot = np.zeros((len(labels), self.num_digits * self.num_classes),
+                      dtype=np.int32)
+    offsets = self.num_classes * np.arange(self.num_digits)
+    np.put_along_axis(onehot, labels + offsets, 1, axis=1)
+    self.classifier.fit(inputs, onehot)
+    return self
+
+  def predict_proba(self, inputs):
+    """Kx`num_digits`x`num_classes` array of class probabilities."""
+    proba = self.classifier.predict_proba(inputs).reshape(
+        (-1, self.num_digits, self.num_classes))
+    return proba / np.maximum(proba.sum(axis=2, keepdims=True), 1e-12)
+
+  def predict(self, inputs):
+    """Kx`num_digits` array of integer labels."""
+    return np.argmax(self.predict_proba(inputs), axis=2)
+
+  def score(self, inputs, labels):
+    """Fraction of words whose digits are all labeled correctly."""
+    return np.mean(np.all(self.predict(inputs) == labels, axis=1))
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""Correct camera shutter banding in coarsely-cropped grayscale images.
+
+A library and program for evening out the brightness of the cropped .png files
+created by steps 2-3. Owing to camera shutter/5100 display synchronisation
+issues, horizontal bands of the screen are sometimes much dimmer than the rest.
+We estimate a row-wise gain profile from the brightness of the pixels that make
+up the hex digits in each row, then scale every row so that its digits are as
+bright as the brightest digits in the frame.
+
+The top and bottom rows of each digit are dimmer than its middle rows even
+when there's no banding at all, so each row takes the brightest digit
+brightness within a few rows of it. Banding spans many rows, so this loses
+little of it, while dim digit edges no longer look like dim bands.
+
+All of the functions here operate on single images or on stacks of images
+(with the rows and columns in the last two dimensions) alike.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import logging
+
+import imageio
+import numpy as np
+from scipy import ndimage
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Correct brightness banding in a grayscale .png')
+
+  flags.add_argument('input_image', type=str,
+                     help='Image to correct: filename or URI')
+  flags.add_argument('output_image', type=str,
+                     help='Write output here: filename or URI')
+
+  flags.add_argument('--percentile', default=99.0, type=float,
+                     help=('Percentile of pixel values in each row taken to '
+                           'be the brightness of the digits in that row.'))
+  flags.add_argument('--min-level', default=40.0, type=float,
+                     help=('Rows whose digit brightness is below this level '
+                           'are taken to contain no digits at all.'))
+  flags.add_argument('--band-rows', default=7, type=int,
+                     help=('Take the digit brightness of each row to be the '
+                           'greatest within a window of this many rows, so '
+                           'that the dim edges of digits are not mistaken for '
+                           'banding.'))
+  flags.add_argument('--smoothing', default=3, type=int,
+                     help='Median-filter the gain profile over this many rows.')
+  flags.add_argument('--target', type=float,
+                     help=('Scale digits to this brightness. By default, '
+                           'each frame is scaled to match its own brightest '
+                           'rows.'))
+  flags.add_argument('--max-gain', default=2.0, type=float,
+                     help='Never scale any row by more than this factor.')
+
+  flags.add_argument('-v', '--verbose', action='store_true',
+                     help='Log debug information')
+
+  return flags
+
+
+def main(FLAGS):
+  # Verbose logging if desired.
+  if FLAGS.verbose: logging.getLogger().setLevel(logging.INFO)
+
+  # Perform the correction.
+  image = imageio.imread(FLAGS.input_image, ignoregamma=True)
+  gain = estimate_gain(image, FLAGS.percentile, FLAGS.min_level,
+                       FLAGS.smoothing, FLAGS.target, FLAGS.max_gain,
+                       FLAGS.band_rows)
+  logging.info('Row gains: {}'.format(np.array2string(gain, precision=2)))
+  imageio.imwrite(FLAGS.output_image, apply_gain(image, gain))
+
+
+def estimate_gain(images, percentile=99.0, min_level=40.0, smoothing=3,
+                  target=None, max_gain=2.0, band_rows=7):
+  """Estimate row-wise gains that undo brightness banding.
+
+  Args:
+    images: an ...xRxC array of grayscale images with pixel values in [0, 255].
+    percentile: percentile of pixel values in each row taken to be the
+        brightness of the digits in that row.
+    min_level: rows whose digit brightness falls below this level are assumed
+        to contain no digits; their gains are copied from the nearest row that
+        does contain digits.
+    smoothing: size of the median filter applied to the brightness profile
+        along the rows (1 disables smoothing).
+    target: brightness that the digits in every row should have after
+        correction. If None, each image is scaled to match its brightest row.
+    max_gain: gains are clipped to [1 / max_gain, max_gain].
+    band_rows: the digit brightness of each row is the greatest in a window of
+        this many rows centred on it, so that the dim top and bottom rows of
+        the digits aren't taken for banding (1 uses each row on its own).
+
+  Returns:
+    An ...xR array of gains.
+  """
+  images = np.asarray(images, dtype=np.float32)
+
+  # Brightness profile: how bright are the digits in each row?
+  profile = np.percentile(images, percentile, axis=-1)
+  if band_rows > 1:
+    profile = ndimage.maximum_filter1d(profile, band_rows, axis=-1,
+                                       mode='nearest')
+  if smoothing > 1:
+    size = (1,) * (profile.ndim - 1) + (smoothing,)
+    profile = ndimage.median_filter(profile, size=size, mode='nearest')
+
+  # Rows without digits in them tell us nothing, so they borrow their values
+  # from the nearest row above (or failing that, below) that does. Indices of
+  # informative rows are carried downward and then upward through the stack.
+  informative = profile >= min_level
+  rows = np.arange(profile.shape[-1])
+  above = np.maximum.accumulate(np.where(informative, rows, -1), axis=-1)
+  below = np.flip(np.minimum.accumulate(
+      np.flip(np.where(informative, rows, rows.size), axis=-1), axis=-1),
+      axis=-1)
+  nearest = np.where(above >= 0, above, np.minimum(below, rows.size - 1))
+  profile = np.take_along_axis(profile, nearest, axis=-1)
+
+  # Frames with no digits at all are left alone.
+  any_informative = np.any(informative, axis=-1, keepdims=True)
+  if target is None:
+    target = np.max(profile, axis=-1, keepdims=True)
+  gain = np.where(any_informative,
+                  target / np.maximum(profile, 1.0), 1.0)
+  return np.clip(gain, 1.0 / max_gain, max_gain).astype(np.float32)
+
+
+def apply_gain(images, gain):
+  """Scale the rows of `images` by `gain`, returning uint8 images."""
+  corrected = np.asarray(images, dtype=np.float32) * gain[..., np.newaxis]
+  return np.uint8(np.clip(np.round(corrected), 0, 255))
+
+
+def normalise_banding(images, **kwargs):
+  """Correct brightness banding in `images`; see `estimate_gain` for kwargs."""
+  return apply_gain(images, estimate_gain(images, **kwargs))
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
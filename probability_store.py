@@ -0,0 +1,105 @@
+"""Library for storing classifiers' per-digit probabilities for word images.
+
+Classifier programs reduce their classifiers' outputs to labels, but the
+probabilities the classifiers assign to each possible value of each digit can
+be useful later: to weight votes, or to find images the classifiers weren't
+sure about. This library saves them in a KxDx16 float16 .npy file (K images, D
+digits, 16 hex values) that's memory-mapped while it's written and read. The
+K filenames of the images go in a text file alongside, one per line, in the
+same order as the rows of the array, and the version of the classifiers that
+wrote the probabilities goes in another, so that probabilities from different
+classifiers are never mixed in one store.
+
+Labels are chosen from probabilities before they're rounded to float16, so in
+rare near-ties the largest stored probability may not match an image's label.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import os
+import pathlib
+
+import numpy as np
+
+
+def open_for_writing(path, filenames, num_digits=4, model_version=None):
+  """Open a probability store for writing, reusing an existing one if possible.
+
+  Args:
+    path: path of the .npy file.
+    filenames: list of the images whose probabilities will be stored.
+    num_digits: number of digits in each image.
+    model_version: string identifying the classifiers whose probabilities will
+        be stored, e.g. their `model_store` version. An existing store is
+        reused only if it was written by classifiers with the same version;
+        if None, it's never reused.
+
+  Returns:
+    A 2-tuple: a writable KxDx16 float16 memory map, and whether it is an
+    existing store with rows for the same `filenames` and `model_version` (in
+    which case rows not written again keep their old values).
+  """
+  path = pathlib.Path(path)
+  shape = (len(filenames), num_digits, 16)
+  if (model_version and path.exists() and filenames_path(path).exists() and
+      _read_model_version(path) == model_version):
+    if _read_filenames(path) == list(filenames):
+      probabilities = np.load(path, mmap_mode='r+')
+      if probabilities.shape == shape and probabilities.dtype == np.float16:
+        return probabilities, True
+      del probabilities
+
+  # Make a new store. The filename list is written only after the array file
+  # and model version exist, so a store with a filename list is complete.
+  for p in (filenames_path(path), model_version_path(path)):
+    if p.exists(): os.remove(p)
+  probabilities = np.lib.format.open_memmap(
+      path, mode='w+', dtype=np.float16, shape=shape)
+  if model_version:
+    with open(model_version_path(path), 'w') as f:
+      f.write('{}\n'.format(model_version))
+  with open(filenames_path(path), 'w') as f:
+    f.writelines('{}\n'.format(fn) for fn in filenames)
+  return probabilities, False
+
+
+def load(path):
+  """Load a probability store for reading.
+
+  Args:
+    path: path of the .npy file.
+
+  Returns:
+    A 2-tuple: the list of K image filenames, and a read-only KxDx16 float16
+    memory map of their per-digit probabilities.
+  """
+  return _read_filenames(path), np.load(path, mmap_mode='r')
+
+
+def filenames_path(path):
+  """Path of the list of filenames alongside the store at `path`."""
+  path = pathlib.Path(path)
+  return path.with_name(path.name + '.filenames.txt')
+
+
+def model_version_path(path):
+  """Path of the model version alongside the store at `path`."""
+  path = pathlib.Path(path)
+  return path.with_name(path.name + '.model_version.txt')
+
+
+def _read_model_version(path):
+  """Read the model version alongside the store at `path`, or None."""
+  if not model_version_path(path).exists(): return None
+  with open(model_version_path(path)) as f:
+    return f.read().strip()
+
+
+def _read_filenames(path):
+  """Read the list of filenames alongside the store at `path`."""
+  with open(filenames_path(path)) as f:
+    return [line.rstrip('\n') for line in f]
@@ -0,0 +1,210 @@
+"""Post-training int8 quantisation of the MLP and convnet classifiers.
+
+Word images are 8-bit greyscale, but the classifiers compute with 32- or 64-bit
+floating-point numbers. `quantise` converts a trained MLP (from
+`labels_classification.py`) or an exported convnet (see `keras_numpy`) into a
+classifier whose weights are rounded to 8-bit integers, with a separate scale
+for each output channel (each neuron or convolution filter). Each dense or
+convolutional layer computes
+
+    y = s_x * s_w * (q(x) @ W_q) + b
+
+where q(x) rounds the layer's inputs x to integers in [-127, 127] in steps of
+s_x, W_q holds the quantised weights, and s_w their per-channel scales. The
+step s_x for each layer is calibrated by running the original classifier on a
+sample of word images and finding the largest input the layer receives.
+
+NumPy has no fast integer matrix product, so the quantised weights and
+activations are kept as whole numbers in float32 arrays, and `int_matmul`
+multiplies them with float32 arithmetic. When a layer has at most
+`_EXACT_TERMS` inputs, every sum is an integer that float32 represents exactly,
+and one matrix product suffices; layers with more inputs are multiplied in
+pieces of that size. Either way, the products are the same as int32 arithmetic
+would give. The kernels are converted to float32 once, when they're quantised.
+
+This doesn't make the classifiers faster: the matrix products cost what the
+original classifiers' float32 products cost, and rounding the activations
+adds some work to every layer. Quantisation is a way to see how much
+precision the classifiers need, not a faster way to run them.
+
+Quantised classifiers work like the classifiers they came from: a
+`QuantisedMLP` like a scikit-learn `MLPClassifier`, and a `QuantisedConvnet`
+like a `keras_numpy.NumpyModel`. A `MultiDigitClassifier` gets a `QuantisedMLP`
+inside. All of them can be pickled and used by `labels_classification.py`.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import copy
+import numpy as np
+
+import keras_numpy
+import multi_digit_classifier
+
+
+def quantise(classifier, calibration_inputs):
+  """Quantise a classifier, calibrating it with sample inputs.
+
+  Args:
+    classifier: a scikit-learn `MLPClassifier`, a `MultiDigitClassifier`
+        wrapping one, or a `keras_numpy.NumpyModel`.
+    calibration_inputs: a KxP array of linearised word images, prepared as the
+        classifier expects them (e.g. with masked digits).
+
+  Returns:
+    The quantised classifier.
+
+  Raises:
+    ValueError: `classifier` isn't a kind that can be quantised.
+  """
+  if isinstance(classifier, (QuantisedMLP, QuantisedConvnet)):
+    raise ValueError('The classifier is quantised already.')
+
+  inputs = np.asarray(calibration_inputs, dtype=np.float32)
+  if isinstance(classifier, multi_digit_classifier.MultiDigitClassifier):
+    quantised = copy.copy(classifier)
+    quantised.classifier = quantise(classifier.classifier, inputs)
+    return quantised
+  elif isinstance(classifier, keras_numpy.NumpyModel):
+    images = inputs.reshape((-1,) + classifier.input_shape) * np.float32(
+        classifier.input_scale)
+    layers, x = _quantise_layers(classifier.layers, images)
+    outputs = [_quantise_layers([o], x)[0][0] for o in classifier.outputs]
+    return QuantisedConvnet(classifier.input_shape, layers, outputs,
+                            classifier.input_scale)
+  elif hasattr(classifier, 'coefs_'):
+    layers, _ = _quantise_layers(_mlp_layers(classifier), inputs)
+    return QuantisedMLP(layers, classifier.classes_, classifier.n_outputs_)
+  else:
+    raise ValueError("Can't quantise {} classifiers.".format(
+        type(classifier).__name__))
+
+
+def _mlp_layers(mlp):
+  """`keras_numpy` layer specs for a scikit-learn `MLPClassifier`."""
+  names = dict(identity='linear', logistic='sigmoid', tanh='tanh', relu='relu',
+               softmax='softmax')
+  activations = [names[mlp.activation]] * (len(mlp.coefs_) - 1) + [
+      names[mlp.out_activation_]]
+  return [dict(type='dense', kernel=np.float32(w), bias=np.float32(b),
+               activation=a)
+          for w, b, a in zip(mlp.coefs_, mlp.intercepts_, activations)]
+
+
+def _quantise_layers(layers, x):
+  """Quantise the weights of a chain of layer specs, calibrating with `x`.
+
+  Returns:
+    A 2-tuple: the quantised layer specs, and the outputs of the original
+    layers for `x`.
+  """
+  quantised = []
+  for spec in layers:
+    if spec['type'] in ('conv2d', 'dense'):
+      kernel = spec['kernel']
+      scale = np.max(np.abs(kernel.reshape((-1, kernel.shape[-1]))), axis=0)
+      scale = np.maximum(scale, 1e-12) / 127
+      quantised.append(dict(
+          spec, kernel=np.round(kernel / scale).astype(np.float32),
+          kernel_scale=np.float32(scale),
+          input_scale=float(max(np.max(np.abs(x)), 1e-12) / 127)))
+    else:
+      quantised.append(spec)
+    x = keras_numpy.forward([spec], x)
+  return quantised, x
+
+
+def forward(layers, x):
+  """Like `keras_numpy.forward`, for quantised layers as well.
+
+  Args:
+    layers: list of layer specs, some quantised by `quantise`.
+    x: a batch of activations for the first layer.
+
+  Returns:
+    The activations the last layer outputs.
+  """
+  for spec in layers:
+    if 'kernel_scale' not in spec:
+      x = keras_numpy.forward([spec], x)
+      continue
+
+    q = quantise_activations(x, spec['input_scale'])
+    kernel = spec['kernel']
+    if spec['type'] == 'conv2d':
+      columns = keras_numpy.patches(q, *kernel.shape[:2], spec['padding'])
+      products = int_matmul(
+          columns.reshape((-1, columns.shape[-1])),
+          kernel.reshape((-1, kernel.shape[-1]))).reshape(
+              columns.shape[:3] + kernel.shape[-1:])
+    else:
+      products = int_matmul(q, kernel)
+    x = products * (np.float32(spec['input_scale']) * spec['kernel_scale'])
+    if 'bias' in spec: x = x + spec['bias']
+    x = keras_numpy.ACTIVATIONS[spec['activation']](x)
+  return x
+
+
+def quantise_activations(x, scale):
+  """Round `x` to whole numbers in [-127, 127], in steps of `scale`.
+
+  Returns:
+    A float32 array of the rounded values, ready for `int_matmul`.
+  """
+  q = np.round(np.asarray(x, dtype=np.float32) / np.float32(scale))
+  return np.clip(q, -127, 127, out=q)
+
+
+def int_matmul(a, b):
+  """Exact matrix product of KxN `a` and NxM `b`, both holding whole numbers.
+
+  Args:
+    a: a KxN float32 array, with whole-number values in [-127, 127].
+    b: a NxM float32 array, with whole-number values in [-127, 127].
+
+  Returns:
+    A KxM array: the exact matrix product of `a` and `b`, as float32 if N is
+    at most `_EXACT_TERMS` and as int32 otherwise.
+  """
+  if a.shape[1] <= _EXACT_TERMS: return a @ b
+  result = np.zeros((a.shape[0], b.shape[1]), dtype=np.int32)
+  for start in range(0, a.shape[1], _EXACT_TERMS):
+    result += (a[:, start:start+_EXACT_TERMS] @
+               b[start:start+_EXACT_TERMS]).astype(np.int32)
+  return result
+
+
+# Sums of this many products of values in [-127, 127] never exceed 2**24, so
+# float32 computes them exactly.
+_EXACT_TERMS = 2 ** 24 // (127 * 127)
+
+
+class QuantisedMLP(object):
+  """A quantised `MLPClassifier`, with its `predict_proba` and `classes_`."""
+
+  def __init__(self, layers, classes, n_outputs):
+    self.layers = layers
+    self.classes_ = classes
+    self.n_outputs_ = n_outputs
+
+  def predict_proba(self, inputs):
+    """Class probabilities for linearised images, as `MLPClassifier` gives."""
+    outputs = forward(self.layers, np.asarray(inputs, dtype=np.float32))
+    if self.n_outputs_ == 1: outputs = outputs.ravel()
+    if outputs.ndim == 1: return np.stack([1 - outputs, outputs], axis=1)
+    return outputs
+
+  def predict(self, inputs):
+    """The most probable class for each linearised image (not multilabel)."""
+    return self.classes_[np.argmax(self.predict_proba(inputs), axis=1)]
+
+
+class QuantisedConvnet(keras_numpy.NumpyModel):
+  """A quantised `keras_numpy.NumpyModel`."""
+
+  def _forward(self, layers, x):
+    return forward(layers, x)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+"""Quantise saved MLP or convnet classifiers to 8-bit integers.
+
+This program loads classifiers saved by `labels_classification.py` (MLPs) or by
+`labels_classification_keras.py` (convnets, via their `keras_numpy` exports),
+quantises them with `quantisation`, calibrating them with a random sample of
+the word images in a label database, and reports how the quantised
+classifiers compare with the originals on a sample of labeled images: the
+accuracy for each digit and for whole words, how often the two agree, and how
+fast each classifies.
+
+Quantised classifiers are no faster than the originals: NumPy has no fast
+integer matrix product, so `quantisation` does the same float32 arithmetic and
+also rounds every layer's activations. On a (50, 40, 30) MLP, classifying
+200,000 images took 15% to 55% longer quantised than with the original
+classifier. Quantising shows how much precision the classifiers need; it isn't
+a faster way to classify word images.
+
+The quantised classifiers are saved in the model directory like any that
+`labels_classification.py` trains, with "quantised" set in their metadata, so
+that `labels_classification.py --load-model` can classify all of the word
+images with them. Programs that pick the most recent classifiers themselves
+(`labels_classification.py --classify-only`, `labels_from_screens.py`) pass
+over quantised ones.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import argparse
+import inspect
+import json
+import numpy as np
+import pathlib
+import time
+
+import digit_masking
+import image_cache
+import label_database
+import labels_classification
+import labels_classification_numpy
+import model_store
+import quantisation
+
+
+def _define_flags():
+  """Defines an `ArgumentParser` for command-line flags used by this program."""
+  flags = argparse.ArgumentParser(
+      description='Quantise saved classifiers to 8-bit integers.')
+
+  flags.add_argument('input_label_database', type=str,
+                     help=('CSV file containing image paths, labels, and '
+                           'the number of times a particular label was '
+                           'supplied for an image. The CSV header should be '
+                           '"Filename,Label,Count". Images for calibration '
+                           'and comparison are drawn from this file.'))
+
+  flags.add_argument('--model-dir', default='models', type=str,
+                     help=('Quantise the unquantised classifiers saved most '
+                           'recently in this directory, and save the '
+                           'quantised classifiers here. An empty value '
+                           'disables saving.'))
+
+  flags.add_argument('--load-model', type=str,
+                     help='Quantise the classifiers saved in this directory.')
+
+  flags.add_argument('--calibration-images', default=2000, type=int,
+                     help=('Calibrate the quantised classifiers with this '
+                           'many randomly chosen word images.'))
+
+  flags.add_argument('--comparison-images', default=10000, type=int,
+                     help=('Compare quantised and original classifiers on '
+                           'this many randomly chosen labeled word images.'))
+
+  flags.add_argument('--minimum-label-count', default=2, type=int,
+                     help=('Only use image labels with at least this many '
+                           'counts for comparing classifiers.'))
+
+  flags.add_argument('--seed', default=0, type=int,
+                     help='Random seed for choosing images.')
+
+  flags.add_argument('--image-cache-dir', default='image_cache', type=str,
+                     help=('Keep decoded word images in this directory so '
+                           'that later runs can skip decoding them. An empty '
+                           'value disables caching.'))
+
+  return flags
+
+
+#### MAIN PROGRAM ####
+
+
+def main(FLAGS):
+  # Load classifiers. Quantised classifiers have "quantised" in their metadata,
+  # so requiring it to be absent finds the latest unquantised ones.
+  path = FLAGS.load_model or model_store.latest(FLAGS.model_dir,
+                                                quantised=None)
+  print('Loading classifiers from {}...'.format(path))
+  classifiers, metadata = load_classifiers(path)
+
+  # Choose calibration and comparison images.
+  print('Opening input label database...')
+  with label_database.Database(
+      FLAGS.input_label_database, readonly=True) as db_in:
+    all_images = [fn for fn, _ in db_in.all_labels_with_counts_of_at_least(0)]
+    labeled = [(fn, label) for fn, label in
+               db_in.all_labels_with_counts_of_at_least(
+                   FLAGS.minimum_label_count) if _is_hex(label)]
+  rng = np.random.RandomState(FLAGS.seed)
+  calibration = [all_images[i] for i in np.sort(rng.permutation(
+      len(all_images))[:FLAGS.calibration_images])]
+  comparison = [labeled[i] for i in np.sort(rng.permutation(
+      len(labeled))[:FLAGS.comparison_images])]
+  if not calibration or not comparison: raise ValueError(
+      'Need images to calibrate with and labeled images to compare with.')
+
+  print('Loading', len(calibration), 'calibration images and',
+        len(comparison), 'comparison images...')
+  images = image_cache.load_images(
+      calibration + [fn for fn, _ in comparison], FLAGS.image_cache_dir)
+  calibration_images, comparison_images = np.split(images, [len(calibration)])
+  labels = np.array([[int(c, 16) for c in label] for _, label in comparison])
+
+  # Quantise classifiers.
+  print('Quantising classifiers...')
+  inputs = classifier_inputs(calibration_images, len(classifiers),
+                             metadata['mask_digits'], metadata['segmenter'])
+  quantised = [quantisation.quantise(c, i) for c, i in zip(classifiers, inputs)]
+
+  # Compare them with the originals.
+  print('Comparing classifiers on', len(comparison), 'labeled images...')
+  segments = (digit_masking.segment(comparison_images, metadata['segmenter'])
+              if metadata['mask_digits'] else None)
+  results = []
+  for cfiers in (classifiers, quantised):
+    t0 = time.perf_counter()
+    probabilities = labels_classification.classify_probabilities(
+        cfiers, metadata['mask_digits'], comparison_images, segments)
+    results.append((np.argmax(probabilities, axis=2),
+                    len(comparison) / (time.perf_counter() - t0)))
+  print_comparison(results, labels)
+
+  # Save the quantised classifiers.
+  if FLAGS.model_dir:
+    fp = model_store.fingerprint(metadata['fingerprint'], calibration,
+                                 inspect.getsource(quantisation))
+    path = model_store.model_path(FLAGS.model_dir, fp)
+    print('Saving quantised classifiers to {}...'.format(path))
+    model_store.save(path, quantised, model_store.pickle_classifier, dict(
+        program='labels_classification', mask_digits=metadata['mask_digits'],
+        segmenter=metadata['segmenter'],
+        shared_model=metadata.get('shared_model', False),
+        classifier_type=metadata.get('classifier_type', 'convnet'),
+        quantised=True, quantised_from=metadata['fingerprint']))
+
+  # All done!
+  print('Done.')
+
+
+def load_classifiers(path):
+  """Load MLPs or exported convnets saved in `path` by a classifier program."""
+  with open(pathlib.Path(path) / 'metadata.json') as f:
+    program = json.load(f).get('program')
+  if program == 'labels_classification_keras':
+    return labels_classification_numpy.load_classifiers(path)
+  return labels_classification.load_classifiers(path)
+
+
+def classifier_inputs(images, num_classifiers, do_masking, segmenter):
+  """Linearised inputs for each classifier, masked if necessary.
+
+  Args:
+    images: KxRxC array of word images.
+    num_classifiers: number of classifiers: four, or one for a shared model.
+    do_masking: whether the classifiers expect images with masked digits.
+    segmenter: which `digit_masking` segmenter to find digits with.
+
+  Returns:
+    A list of KxRC float32 arrays, one for each classifier.
+  """
+  flat = images.reshape((len(images), -1)).astype(np.float32)
+  if not do_masking: return [flat] * num_classifiers
+  return labels_classification.mask_digits_in_images(
+      flat, digit_masking.segment(images, segmenter))
+
+
+def print_comparison(results, labels):
+  """Print a report comparing original and quantised classifiers.
+
+  Args:
+    results: a 2-tuple of 2-tuples, for the original and then the quantised
+        classifiers: a Kx4 array of predicted digit values, and the number of
+        images classified per second.
+    labels: a Kx4 array of the correct digit values.
+  """
+  (original, original_rate), (quantised, quantised_rate) = results
+  print('              original      int8')
+  for d in range(labels.shape[1]):
+    print('   Digit {}: {:10.4f} {:9.4f}'.format(
+        d + 1, np.mean(original[:, d] == labels[:, d]),
+        np.mean(quantised[:, d] == labels[:, d])))
+  print('     Words: {:10.4f} {:9.4f}'.format(
+      np.mean(np.all(original == labels, axis=1)),
+      np.mean(np.all(quantised == labels, axis=1))))
+  print('  Images/s: {:10.0f} {:9.0f}'.format(original_rate, quantised_rate))
+  print('   ...int8 labels match original labels for {:.2%} of images.'.format(
+      np.mean(np.all(original == quantised, axis=1))))
+
+
+def _is_hex(label):
+  """Whether `label` is four hex digits."""
+  return len(label) == 4 and all(c in '0123456789ABCDEFabcdef' for c in label)
+
+
+if __name__ == '__main__':
+  flags = _define_flags()
+  FLAGS = flags.parse_args()
+  main(FLAGS)
@@ -12,12 +12,13 @@ import argparse
 import numpy as np
 import os
 import skimage
+import skimage.color
 import skimage.io
 import sys
 import tempfile
 import wand.image
 
-import labels_classification
+import digit_masking
 
 
 def _define_flags():
@@ -26,6 +27,9 @@ def _define_flags():
       description='Show how our image masking segments digits.')
 
   flags.add_argument('image', type=str, help='Image file to segment.')
+  flags.add_argument('--segmenter', default='dp',
+                     choices=digit_masking.SEGMENTERS,
+                     help='Which digit segmenter to use.')
 
   return flags
 
@@ -36,8 +40,19 @@ def main(FLAGS):
       skimage.io.imread(FLAGS.image)).astype(np.float32)
 
   # Obtain versions with the four digits masked.
-  masked = [labels_classification.mask_nth_digit_in_image(image, n)
-            for n in range(4)]
+  segmentation = digit_masking.segment(image[np.newaxis, ...], FLAGS.segmenter)
+  masked = [m[0] for m in digit_masking.mask_all_digits(
+      image[np.newaxis, ...], segmentation)]
+
+  # Report where the digit boundaries are and whether they're doubtful.
+  segmentation = segmentation[0]
+  print('Digit boundaries at columns', *segmentation[:3])
+  for flag, description in (
+      (digit_masking.AMBIGUOUS_FEW_MINIMA, 'fewer than three minima found'),
+      (digit_masking.AMBIGUOUS_CROWDED, 'two boundaries in one allowed range'),
+      (digit_masking.AMBIGUOUS_CLOSE_CALL, 'other boundaries nearly as good'),
+      (digit_masking.AMBIGUOUS_INKY_CUT, 'a boundary cuts a bright column')):
+    if segmentation[3] & flag: print('Ambiguous segmentation:', description)
 
   # Create temporary files for the masked images.
   t_masked = [tempfile.mkstemp(suffix='.png')[1] for _ in masked]
@@ -0,0 +1,185 @@
+"""A classifier that matches digits in word images against font templates.
+
+The DCP1 display draws every digit in the same fixed font, and in a word image
+digit n (counting from 0) sits in a cell occupying columns 7n to 7n+5 and rows
+2 to 13. A `TemplateClassifier` learns the mean appearance of each of the 16
+hex values in each of the four cells, then labels a digit by the normalised
+cross-correlation (NCC) between its cell and each template. Cells may sit a
+pixel or so away from where they should, so templates are also tried at small
+shifts, and the best shift wins.
+
+All of the templates, at all of their shifts, are laid out as columns of one
+big matrix, so correlating a batch of images against all of them is one matrix
+multiplication. Training takes a few passes over the labeled images, and the
+templates are aligned on each pass to the shifts where they match best.
+
+Like `multi_digit_classifier`, this class lives in its own library so that
+pickled instances can be loaded by any program.
+
+Licensing:
+
+This program and any supporting programs, software libraries, and documentation
+distributed alongside it are released into the public domain without any
+warranty. See the LICENSE file for details.
+"""
+
+import numpy as np
+
+
+# Digit n's cell begins at column CELL_PITCH * n. Templates cover the rows in
+# WINDOW_ROWS and, relative to the start of the cell, the columns in
+# WINDOW_COLUMNS: the cell plus a margin of one pixel.
+CELL_PITCH = 7
+WINDOW_ROWS = (1, 15)
+WINDOW_COLUMNS = (-1, 7)
+
+# Candidate values for `TemplateClassifier.sharpness`.
+_SHARPNESS_GRID = np.geomspace(1.0, 1000.0, 61)
+
+
+class TemplateClassifier(object):
+  """Classifies all of the digits in a word image by template matching.
+
+  Has the same interface as `MultiDigitClassifier`: `fit` takes Kx4 labels,
+  and `predict_proba` returns Kx4x16 probabilities. Probabilities are the
+  softmax of the best NCC for each value, multiplied by `sharpness`, which is
+  chosen during training to fit the training data.
+  """
+
+  def __init__(self, image_shape=(16, 29), num_digits=4, num_classes=16,
+               max_shift=1, alignment_passes=2):
+    self.image_shape = tuple(image_shape)
+    self.num_digits = num_digits
+    self.num_classes = num_classes
+    self.max_shift = max_shift
+    self.alignment_passes = alignment_passes
+
+  def fit(self, inputs, labels):
+    """Train on Kx`image_shape` or linearised images and Kx4 integer `labels`.
+
+    Args:
+      inputs: KxRxC array of word images, or a KxRC array of linearised ones.
+      labels: Kx`num_digits` array of integer labels.
+
+    Returns:
+      This classifier.
+    """
+    padded = self._pad(inputs)
+    labels = np.asarray(labels)
+    windows = self._window_indices()  # Shape: [digit, shift, pixel].
+    centre = len(self._shifts()) // 2
+    onehot = np.stack([labels == v for v in range(self.num_classes)], axis=2)
+    self.classes_present_ = onehot.any(axis=0)
+    counts = np.maximum(onehot.sum(axis=0), 1)[..., np.newaxis]
+
+    # Start with the mean of every unshifted cell, then re-average cells at
+    # the shifts that best match the templates for their labels.
+    shifts = np.full(labels.shape, centre)
+    for _ in range(self.alignment_passes + 1):
+      cells = np.stack([padded[np.arange(len(padded))[:, np.newaxis],
+                               windows[n][shifts[:, n]]]
+                        for n in range(self.num_digits)], axis=1)
+      self.templates_ = np.einsum('kdv,kdp->dvp', onehot, cells) / counts
+      self._build()
+      ncc = self._correlate(padded)  # Shape: [image, digit, value, shift].
+      shifts = np.argmax(
+          np.take_along_axis(ncc, labels[:, :, np.newaxis, np.newaxis], 2)[
+              :, :, 0], axis=2)
+
+    # Choose the sharpness that best fits the training labels.
+    best = self._best_ncc(ncc)
+    best_true = np.take_along_axis(best, labels[..., np.newaxis], 2)[..., 0]
+    losses = [np.mean(_log_sum_exp(s * best) - s * best_true)
+              for s in _SHARPNESS_GRID]
+    self.sharpness = _SHARPNESS_GRID[int(np.argmin(losses))]
+    return self
+
+  def predict_proba(self, inputs):
+    """Kx`num_digits`x`num_classes` array of class probabilities."""
+    ncc = self._correlate(self._pad(inputs))
+    scores = self.sharpness * self._best_ncc(ncc)
+    scores = np.exp(scores - np.max(scores, axis=2, keepdims=True))
+    return scores / np.sum(scores, axis=2, keepdims=True)
+
+  def predict(self, inputs):
+    """Kx`num_digits` array of integer labels."""
+    return np.argmax(self.predict_proba(inputs), axis=2)
+
+  def score(self, inputs, labels):
+    """Fraction of words whose digits are all labeled correctly."""
+    return np.mean(np.all(self.predict(inputs) == labels, axis=1))
+
+  def _shifts(self):
+    """All (row, column) shifts of the templates, the unshifted one central."""
+    r = range(-self.max_shift, self.max_shift + 1)
+    return [(dy, dx) for dy in r for dx in r]
+
+  def _pad(self, inputs):
+    """Linearised float32 copies of `inputs` with room around the edges."""
+    images = np.asarray(inputs, dtype=np.float32).reshape(
+        (-1,) + self.image_shape)
+    p = self.max_shift - min(0, WINDOW_ROWS[0], WINDOW_COLUMNS[0])
+    padded = np.pad(images, ((0, 0), (p, p), (p, p)))
+    return padded.reshape((len(padded), -1))
+
+  def _window_indices(self):
+    """Indices of template pixels in padded images for each digit and shift."""
+    p = self.max_shift - min(0, WINDOW_ROWS[0], WINDOW_COLUMNS[0])
+    width = self.image_shape[1] + 2 * p
+    rows = np.arange(*WINDOW_ROWS)[:, np.newaxis]
+    cols = np.arange(*WINDOW_COLUMNS)[np.newaxis, :]
+    return np.array([
+        [((rows + dy + p) * width + cols + CELL_PITCH * n + dx + p).ravel()
+         for dy, dx in self._shifts()]
+        for n in range(self.num_digits)])
+
+  def _build(self):
+    """Lay out normalised templates and window indicators as matrix columns."""
+    windows = self._window_indices()
+    num_shifts, num_pixels = windows.shape[1:]
+    padded_size = self._pad(np.zeros((1,) + self.image_shape)).shape[1]
+
+    # Zero-mean, unit-norm templates, so that an NCC is a dot product divided
+    # by the norm of the zero-mean window it's taken over.
+    templates = self.templates_ - np.mean(self.templates_, axis=2,
+                                          keepdims=True)
+    templates /= np.maximum(
+        np.linalg.norm(templates, axis=2, keepdims=True), 1e-6)
+
+    # Template columns are ordered [digit, value, shift]; then come indicator
+    # columns for the windows, ordered [digit, shift], for summing pixels.
+    matrix = np.zeros((padded_size, self.num_digits, self.num_classes,
+                       num_shifts), dtype=np.float32)
+    indicators = np.zeros((padded_size, self.num_digits, num_shifts),
+                          dtype=np.float32)
+    for n in range(self.num_digits):
+      for s in range(num_shifts):
+        matrix[windows[n, s], n, :, s] = templates[n].T
+        indicators[windows[n, s], n, s] = 1.0
+    self.num_template_columns_ = matrix[0].size
+    self.matrix_ = np.concatenate([matrix.reshape((padded_size, -1)),
+                                   indicators.reshape((padded_size, -1))],
+                                  axis=1)
+    self.window_size_ = num_pixels
+
+  def _correlate(self, padded):
+    """NCC of linearised padded images with every template at every shift."""
+    split = self.num_template_columns_
+    products = padded @ self.matrix_
+    sum_squares = np.square(padded) @ self.matrix_[:, split:]
+    sums = products[:, split:]
+    norms = np.sqrt(np.maximum(
+        sum_squares - np.square(sums) / self.window_size_, 1e-6))
+    norms = norms.reshape((len(padded), self.num_digits, 1, -1))
+    return products[:, :split].reshape(
+        (len(padded), self.num_digits, self.num_classes, -1)) / norms
+
+  def _best_ncc(self, ncc):
+    """Best NCC over all shifts, or -1 for values absent from training."""
+    return np.where(self.classes_present_, np.max(ncc, axis=3), -1.0)
+
+
+def _log_sum_exp(scores):
+  """Log of the sum of the exponentials of `scores` along their last axis."""
+  top = np.max(scores, axis=-1, keepdims=True)
+  return top[..., 0] + np.log(np.sum(np.exp(scores - top), axis=-1))